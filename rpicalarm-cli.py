@@ -2,11 +2,24 @@
 
 import argparse
 import logging
+import os
+import signal
+import time
+from threading import Event, Thread
 
 #import logging.handlers
 from configparser import SafeConfigParser
-from rpicalarm import Alarm, getLogger, WebServer
-from rpicalarm.agents import Telegram, Camera, PirSensor, Backuper, Twilio, Emailer
+from rpicalarm import Alarm, events, getLogger, SensorFusion, StorageManager, parse_duration, tracer, log_ring
+from rpicalarm.logs import LOG_FORMAT, LOG_DATE_FORMAT, setup_queue_logging
+from rpicalarm.agents import AGENTS, get_agent_class, get_agent_config, get_camera_configs, import_agents
+
+# agents not created when the agent they depend on is disabled
+AGENTS_REQUIREMENTS = {
+    "backup": "camera",
+}
+
+# agents authenticating or notifying the user, created on the cluster leader only
+LEADER_AGENTS = ("telegram", "twilio", "email")
 
 
 def parse_arguments():
@@ -16,6 +29,8 @@ def parse_arguments():
     arg_parser.add_argument('-s', '--data_file', help='Path the data file.',
                             default='/var/lib/rpicalarm/data.json')
     arg_parser.add_argument('-v', '--verbose', help='Enable verbose mode', default=False)
+    arg_parser.add_argument('--soak', help='Run intrusion scenarios for the given duration (ex: 8h) '
+                            'and exit, requires a [simulation] section with gpio enabled.')
     return arg_parser.parse_args()
 
 
@@ -29,8 +44,7 @@ def setup_logging(debug_mode):
     # syslog_handler.setFormatter(syslog_format)
     # if log_to_stdout:
     #stdout_level = logging.DEBUG
-    stdout_format = logging.Formatter(
-        "%(asctime)s %(levelname)-7s %(filename)s:%(lineno)-12s %(threadName)-25s %(message)s", "%Y-%m-%d %H:%M:%S")
+    stdout_format = logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT)
     # else:
     #     stdout_level = logging.CRITICAL
     #     stdout_format = logging.Formatter("ERROR: %(message)s")
@@ -46,6 +60,13 @@ def setup_logging(debug_mode):
     return root_logger
 
 
+def dump_log_ring(dump_dir):
+    try:
+        logger.info("Dumped latest log records to %s", log_ring.dump_to_dir(dump_dir))
+    except Exception:
+        logger.exception("Failed dumping latest log records to %s", dump_dir)
+
+
 #pylint: disable=invalid-name
 if __name__ == "__main__":
     args = parse_arguments()
@@ -58,18 +79,156 @@ if __name__ == "__main__":
     except Exception as e:
         logger.fatal("Failed reading configuration, got exception {0}".format(e))
 
-    log_level = cfg.get('logging', 'level', fallback='info')
-    if not args.verbose:
-        logger.setLevel(getattr(logging, log_level.upper()))
+    # until now records were output synchronously, configuration errors being reported
+    logging_cfg = dict(cfg['logging']) if cfg.has_section('logging') else {}
+    if args.verbose:
+        logging_cfg['level'] = 'debug'
+    log_dump_dir = logging_cfg.pop('dump_dir', '/var/log/rpicalarm')
+    log_listener = setup_queue_logging(**logging_cfg)
+    # kill -USR1 <pid> dumps the latest records kept in memory
+    signal.signal(signal.SIGUSR1, lambda *_: dump_log_ring(log_dump_dir))
+
+    if cfg.has_section('tracing'):
+        tracer.configure(**cfg['tracing'])
+
+    simulation = None
+    if cfg.has_section('simulation'):
+        # imported here so that simulators are only loaded when configured
+        from rpicalarm.simulators import Simulation
+        simulation = Simulation(**cfg['simulation'])
+        simulation.apply(cfg)
+
+    start_time = time.monotonic()
+    camera_cfgs = get_camera_configs(cfg)
+    # [camera:<id>] sections enable the camera agent even if the [camera] camera is disabled
+    enabled_agents = [name for name in AGENTS
+                      if (camera_cfgs if name == "camera" else get_agent_config(cfg, name) is not None)]
+    for name, required_name in AGENTS_REQUIREMENTS.items():
+        if name in enabled_agents and required_name not in enabled_agents:
+            logger.error("Agent %s requires agent %s, it is disabled", name, required_name)
+            enabled_agents.remove(name)
+    # agents modules are imported while the alarm gets armed
+    import_agents(enabled_agents)
+
+    def create_agent(name, *agent_args, **kwargs):
+        if name not in enabled_agents:
+            return None
+        try:
+            return get_agent_class(name)(*agent_args, **kwargs)
+        except Exception:
+            # the alarm and the other agents keep running
+            logger.exception("Failed creating agent %s", name)
+            return None
 
-    camera = Camera(**cfg['camera'])
     alarm = Alarm(args.data_file, **cfg['alarm'])
-    telegram = Telegram(alarm, camera, **cfg['telegram'])
-    pir_sensor = PirSensor(**cfg['pirsensor'])
-    backuper = Backuper(cfg['camera'].get("save_path"), cloudinary_cfg=cfg['cloudinary'])
-    web_server = WebServer(**cfg['webServer'])
-    twilio = Twilio(alarm, web_server, **cfg['twilio'])
-    emailer = Emailer(**cfg['email'])
-
-    web_server.start()
+    fusion = SensorFusion(**(cfg['fusion'] if cfg.has_section('fusion') else {}))
+    pir_sensor = create_agent("pirsensor", gpio=simulation and simulation.gpio,
+                              **(get_agent_config(cfg, "pirsensor") or {}))
+    known_state_handlers = alarm.get_state_handlers()
     alarm.start()
+    logger.info("Alarm started in %.2fs", time.monotonic() - start_time)
+
+    def start_agents():
+        """
+        Creates the slow network bound agents once the alarm is armed
+        """
+        from rpicalarm import WebServer
+        web_server = WebServer(**cfg['webServer'])
+        # the cameras files are saved in the [camera] save_path, their names suffixed by the camera id
+        save_path = cfg.get("camera", "save_path", fallback="/var/tmp/images")
+        storage = None
+        if "camera" in enabled_agents:
+            try:
+                storage = StorageManager(save_path,
+                                         **(cfg['storage'] if cfg.has_section('storage') else {}))
+            except Exception:
+                logger.exception("Failed creating storage manager")
+        if storage is not None and cfg.has_section('evidence') and \
+                cfg['evidence'].get('enabled', 'true').lower() == 'true':
+            from rpicalarm import EvidenceIndex
+            evidence_cfg = {k: v for k, v in cfg['evidence'].items() if k != 'enabled'}
+            try:
+                EvidenceIndex(storage, web_server=web_server, **evidence_cfg)
+            except Exception:
+                logger.exception("Failed creating evidence index")
+        cameras = []
+        if camera_cfgs:
+            # the motion detectors of all the cameras share a frame rate budget
+            from rpicalarm.motion import FrameBudget
+            frame_budget = FrameBudget(float(cfg.get("camera", "motion_budget_fps", fallback="10")))
+            for camera_id, camera_cfg in camera_cfgs.items():
+                camera_cfg.pop("motion_budget_fps", None)
+                camera_cfg["save_path"] = save_path
+                camera = create_agent("camera", camera_id=camera_id, storage=storage, frame_budget=frame_budget,
+                                      device=simulation and simulation.get_camera(camera_id), **camera_cfg)
+                if camera is not None:
+                    cameras.append(camera)
+        camera = cameras[0] if cameras else None
+        if cfg.has_section('api') and cfg['api'].get('enabled', 'true').lower() == 'true':
+            from rpicalarm import StateApi
+            api_cfg = {k: v for k, v in cfg['api'].items() if k != 'enabled'}
+            try:
+                StateApi(alarm, web_server, cameras=cameras, **api_cfg)
+            except Exception:
+                logger.exception("Failed creating state api")
+
+        def create_leader_agents():
+            create_agent("telegram", alarm, camera, web_server=web_server, cameras=cameras,
+                         **(get_agent_config(cfg, "telegram") or {}))
+            create_agent("twilio", alarm, web_server, http_client=simulation and simulation.twilio_http_client,
+                         **(get_agent_config(cfg, "twilio") or {}))
+            create_agent("email", **(get_agent_config(cfg, "email") or {}))
+
+        cluster = None
+        if cfg.has_section('cluster') and cfg['cluster'].get('enabled', 'true').lower() == 'true':
+            from rpicalarm import ClusterNode
+            cluster_cfg = {k: v for k, v in cfg['cluster'].items() if k != 'enabled'}
+            try:
+                cluster = ClusterNode(alarm, web_server, **cluster_cfg)
+            except Exception:
+                logger.exception("Failed creating cluster node, running standalone")
+        if cluster is None:
+            create_leader_agents()
+        else:
+            leader_agents_started = Event()
+
+            def start_leader_agents():
+                handlers = alarm.get_state_handlers()
+                create_leader_agents()
+                alarm.replay_state(handlers)
+                logger.info("Agents %s started", ", ".join(n for n in LEADER_AGENTS if n in enabled_agents))
+
+            def on_cluster_leader_changed(node, _leader_id):
+                # kept once created, a leader only steps down when two leaders meet after a network partition
+                if node.is_leader and not leader_agents_started.is_set():
+                    leader_agents_started.set()
+                    Thread(name="leader_agents_startup", target=start_leader_agents).start()
+
+            events.cluster_leader_changed += on_cluster_leader_changed
+        create_agent("backup", save_path, cloudinary_cfg=get_agent_config(cfg, "backup"), storage=storage)
+        web_server.start()
+        # the agents missed the state set when the alarm started
+        alarm.replay_state(known_state_handlers)
+        if cluster is not None:
+            cluster.start()
+        logger.info("Agents %s started in %.2fs", ", ".join(enabled_agents), time.monotonic() - start_time)
+
+    agents_thread = Thread(name="agents_startup", target=start_agents)
+    agents_thread.start()
+    if simulation is not None:
+        simulation.start()
+
+    if args.soak:
+        from rpicalarm.simulators import SoakTest
+        if simulation is None or simulation.gpio is None or pir_sensor is None:
+            logger.error("Soak test requires a simulated gpio")
+            log_listener.stop()
+            os._exit(1)
+        agents_thread.join()
+        pattern = pir_sensor.analyzer.pattern
+        soak_test = SoakTest(alarm, simulation.gpio, pir_sensor.pin_num, camera=simulation.camera,
+                             pulses=pattern.min_pulses, pulse_high_time=max(0.5, pattern.min_high_duration + 0.2))
+        soak_test.run(parse_duration(args.soak).total_seconds())
+        # agents threads are not daemons, exit without waiting for them once the logs are output
+        log_listener.stop()
+        os._exit(0)
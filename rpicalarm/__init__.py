@@ -1,5 +1,27 @@
-from .event import events
-from .util import run_async, parse_duration, getLogger, human_time
+import importlib
+
+from .event import events, emit_published
+from .util import run_async, parse_duration, getLogger, human_time, TokenBucket
+from .tracing import tracer
+from .metrics import metrics
+from .logs import log_ring
 from .alarm import AuthFailureReason, Alarm, AlarmState
-from .web_server import WebServer
-from . import network_utils
+from .fusion import SensorFusion
+from .storage import StorageManager
+
+# flask and urllib3 are only imported once the web server is used, the alarm is armed first
+_LAZY_ATTRIBUTES = {
+    "WebServer": ("web_server", "WebServer"),
+    "EvidenceIndex": ("evidence", "EvidenceIndex"),
+    "ClusterNode": ("cluster", "ClusterNode"),
+    "StateApi": ("state_api", "StateApi"),
+    "network_utils": ("network_utils", None),
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError("module {0} has no attribute {1}".format(__name__, name))
+    module_name, attribute = _LAZY_ATTRIBUTES[name]
+    module = importlib.import_module("." + module_name, __name__)
+    return module if attribute is None else getattr(module, attribute)
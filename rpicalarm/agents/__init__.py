@@ -1,6 +1,96 @@
-from .camera import Camera
-from .telegram import Telegram
-from .pirsensor import PirSensor
-from .backup import Backuper
-from .twilio import Twilio
-from .email import Emailer
+# -*- coding: utf-8 -*-
+import importlib
+from collections import OrderedDict
+from threading import Thread
+
+from .. import getLogger
+
+LOGGER = getLogger(__name__)
+
+# agent name: (module, class name, config section). Agents modules are only imported when
+# used so that the dependencies of disabled agents (numpy, cv2, flask, twilio...) are not loaded
+AGENTS = OrderedDict([
+    ("pirsensor", ("pirsensor", "PirSensor", "pirsensor")),
+    ("camera", ("camera", "Camera", "camera")),
+    ("telegram", ("telegram", "Telegram", "telegram")),
+    ("backup", ("backup", "Backuper", "cloudinary")),
+    ("twilio", ("twilio", "Twilio", "twilio")),
+    ("email", ("email", "Emailer", "email")),
+])
+
+# camera dependencies (numpy, cv2) and the network agents ones (flask, telegram, twilio,
+# cloudinary) are imported concurrently, the agents of a lane share modules and are
+# imported one after the other
+IMPORT_LANES = (("camera",), ("telegram", "backup", "twilio", "email"))
+
+
+def get_agent_config(cfg, name):
+    """
+    Returns the config options of the agent, None if it is disabled, that is if its section
+    is missing or its enabled option is false
+    """
+    section = AGENTS[name][2]
+    if not cfg.has_section(section):
+        return None
+    options = dict(cfg[section])
+    if options.pop("enabled", "true").lower() != "true":
+        return None
+    return options
+
+
+def get_camera_configs(cfg):
+    """
+    Returns the config options of the enabled cameras by camera id: None for the [camera]
+    section, <id> for the [camera:<id>] sections. Options missing from a [camera:<id>]
+    section are the [camera] ones, whether the [camera] camera is enabled or not.
+    """
+    base_options = dict(cfg["camera"]) if cfg.has_section("camera") else {}
+    configs = OrderedDict()
+    if base_options.pop("enabled", "true").lower() == "true" and cfg.has_section("camera"):
+        configs[None] = dict(base_options)
+    for section in cfg.sections():
+        if section.startswith("camera:"):
+            options = dict(base_options)
+            options.update(cfg[section])
+            if options.pop("enabled", "true").lower() == "true":
+                configs[section.split(":", 1)[1]] = options
+    return configs
+
+
+def get_agent_class(name):
+    module_name, class_name, _ = AGENTS[name]
+    module = importlib.import_module("." + module_name, __name__)
+    return getattr(module, class_name)
+
+
+def import_agents(names):
+    """
+    Imports the agents modules in the background, one thread per import lane.
+    Returns the threads.
+    """
+    threads = []
+    for lane in IMPORT_LANES:
+        lane_names = [n for n in lane if n in names]
+        if not lane_names:
+            continue
+
+        def import_lane(lane_names=lane_names):
+            for name in lane_names:
+                try:
+                    get_agent_class(name)
+                except Exception:
+                    # raised again when the agent is created
+                    LOGGER.exception("Failed importing agent %s", name)
+
+        thread = Thread(name="import_" + lane_names[0], target=import_lane, daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
+
+
+def __getattr__(name):
+    # from rpicalarm.agents import Camera keeps working, importing the agent module on access
+    for agent_name, (_, class_name, _) in AGENTS.items():
+        if class_name == name:
+            return get_agent_class(agent_name)
+    raise AttributeError("module {0} has no attribute {1}".format(__name__, name))
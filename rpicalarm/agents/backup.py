@@ -4,17 +4,25 @@ from pathlib import Path
 import os
 from os import path
 import logging
+import time
 
 from watchdog.observers import Observer
 from watchdog.events import PatternMatchingEventHandler, EVENT_TYPE_MOVED, EVENT_TYPE_MODIFIED
 import cloudinary
+import cloudinary.api
 import cloudinary.uploader
 
-from .. import events, run_async, getLogger
+from .. import events, run_async, getLogger, tracer, metrics
 
 getLogger("watchdog").setLevel(logging.ERROR)
 LOGGER = getLogger(__name__)
 
+UPLOAD_SECONDS = metrics.histogram("rpicalarm_backup_upload_seconds", "Upload time of a file by backuper.", ("backuper",))
+UPLOAD_BYTES = metrics.counter("rpicalarm_backup_upload_bytes", "Bytes uploaded by backuper.", ("backuper",))
+UPLOAD_FAILURES = metrics.counter("rpicalarm_backup_upload_failures", "Failed uploads by backuper.", ("backuper",))
+# seconds the pending files count is cached for
+PENDING_FILES_TTL = 30
+
 
 def extract_metatada(src_path):
     base_name = path.basename(src_path)
@@ -63,14 +71,19 @@ class CloudinaryBackuper(object):
 
 class Backuper(PatternMatchingEventHandler):
 
-    def __init__(self, sync_dir, cloudinary_cfg=None):
+    def __init__(self, sync_dir, cloudinary_cfg=None, storage=None):
         self.backupers = []
         self.observer = None
+        self.storage = storage
 
         if cloudinary_cfg:
             self.backupers.append(CloudinaryBackuper(**cloudinary_cfg))
 
         self.sync_dir = sync_dir
+        self.pending_files = 0
+        self.pending_files_time = None
+        metrics.gauge("rpicalarm_backup_pending_files", "Files waiting in the sync dir to be backed up.",
+                      func=self._count_pending_files)
         super().__init__(patterns=["**/camera*.jpg"], ignore_directories=True)
 
         self._register_events_handlers()
@@ -92,21 +105,42 @@ class Backuper(PatternMatchingEventHandler):
 
         LOGGER.debug("Got file creation event %s", file_path)
         file_metadata = extract_metatada(file_path)
-        has_at_least_one_succeeded = True
+        # files failing to be backed up are kept, the storage quotas bound them
+        has_at_least_one_succeeded = not self.backupers
         if file_metadata:
             for backuper in self.backupers:
                 try:
-                    backuper.backup(file_path, file_metadata)
+                    with tracer.span(file_metadata.session_id, "backup.upload", backuper=backuper.name), \
+                            UPLOAD_SECONDS.labels(backuper=backuper.name).time():
+                        backuper.backup(file_path, file_metadata)
+                    UPLOAD_BYTES.labels(backuper=backuper.name).inc(os.path.getsize(file_path))
                     has_at_least_one_succeeded = True
+                    events.file_backed_up(self, file_metadata.base_name, backuper.name)
                 except Exception:
+                    UPLOAD_FAILURES.labels(backuper=backuper.name).inc()
                     LOGGER.exception("Failed backing up %s with backuper %s",
                                      file_path, backuper.name)
         if has_at_least_one_succeeded:
             try:
-                os.unlink(file_path)
+                self._remove(file_path)
             except Exception:
                 LOGGER.exception("Failed deleting file %s", file_path)
 
+    def _remove(self, file_path):
+        if self.storage is not None:
+            self.storage.remove(file_path)
+        else:
+            os.unlink(file_path)
+
+    def _count_pending_files(self):
+        # scrapes do not rescan the sync dir each time
+        now = time.monotonic()
+        if self.pending_files_time is None or now - self.pending_files_time >= PENDING_FILES_TTL:
+            self.pending_files = sum(1 for f in os.scandir(self.sync_dir)
+                                     if f.name.startswith("camera") and f.name.endswith(".jpg"))
+            self.pending_files_time = now
+        return self.pending_files
+
     def _sync(self):
         sync_dir_path = Path(self.sync_dir)
         if not sync_dir_path.exists():
@@ -138,4 +172,4 @@ class Backuper(PatternMatchingEventHandler):
 
         for file in os.scandir(self.sync_dir):
             if file.name.startswith("camera_"+session.id) and file.name.endswith(".jpg"):
-                os.unlink(file.path)
+                self._remove(file.path)
@@ -1,58 +1,70 @@
 # -*- coding: utf-8 -*-
 
 import datetime
-from enum import Enum
 import time
 import io
 import os
 import subprocess
-from threading import Event, Thread, RLock
+from threading import Event, Thread, Lock
 
 import numpy as np
 import cv2
-import imutils
 
-
-# pylint: disable=E0401
-import picamera
-from picamera.array import PiMotionAnalysis
-from .. import events, getLogger
-
-TIMELAPSE_WAIT_EVENT = Event()
+from .. import events, emit_published, getLogger, parse_duration, tracer, metrics
+from ..camera_resources import CameraResources, CameraPort, CameraError
+from ..frame_source import CameraFrameSource
+from ..motion import MotionDetector
+from ..storage import StorageManager
+from ..dedup import FrameDeduplicator
+from ..classifier import ObjectClassifier, ClassifierStage
 
 LOGGER = getLogger(__name__)
 
+FRAMES_CAPTURED = metrics.counter("rpicalarm_camera_frames", "Frames captured by camera and use.", ("camera", "use"))
 
-class CameraError(Exception):
-    pass
-
+# jpeg decoding downscales by these factors for a fraction of the cost of a full decode
+REDUCED_COLOR_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                       (2, cv2.IMREAD_REDUCED_COLOR_2))
 
-class CameraAlreadyInStateError(CameraError):
-    pass
 
+# cameras by id, the latest created one of an id is reported
+CAMERAS = {}
 
-class CameraBusyError(CameraError):
-    pass
+metrics.gauge("rpicalarm_camera_port_in_use", "Camera ports leased (1) or free (0).", ("camera", "port"),
+              func=lambda: {(camera_id or "", port): in_use for camera_id, camera in list(CAMERAS.items())
+                            for port, in_use in camera.resources.get_ports_usage().items()})
 
 
-class CameraFlags(Enum):
-    TAKING_PICTURE = 1
-    STREAMING = 2
-    MOTION_DETECTING = 4
-    TIMELAPSING = 8
+def get_default_camera(camera_num=0):
+    # disable pylint for module for development on non-arm machine
+    # pylint: disable=E0401
+    import picamera
+    return picamera.PiCamera(camera_num=camera_num)
 
 
-class CameraPort(Enum):
-    STILL = 1
-    VIDEO = 2
+def create_device(backend, camera_num=0, video_device="/dev/video0"):
+    """
+    Returns a picamera CSI camera, camera_num of a Compute Module, or an OpenCV capture
+    of a V4L2 device, e.g. a USB webcam
+    """
+    if backend == "picamera":
+        return get_default_camera(camera_num)
+    if backend == "v4l2":
+        from ..video_capture import VideoCaptureCamera
+        return VideoCaptureCamera(video_device)
+    raise Exception("Unknown camera backend {0}".format(backend))
 
 
-def bit_count(int_type):
-    count = 0
-    while int_type:
-        int_type &= int_type - 1
-        count += 1
-    return count
+def decode_frame(data, frame_size, size):
+    """
+    Decodes a jpeg frame of frame_size to a BGR frame of size
+    """
+    flag = next((f for factor, f in REDUCED_COLOR_FLAGS
+                 if frame_size[0] // factor >= size[0] and frame_size[1] // factor >= size[1]), cv2.IMREAD_COLOR)
+    frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+    if frame is not None and (frame.shape[1], frame.shape[0]) != tuple(size):
+        frame = cv2.resize(frame, tuple(size), interpolation=cv2.INTER_AREA)
+    return frame
 
 
 def print_proc_stdout(aproc):
@@ -90,248 +102,322 @@ def print_proc_stdout(aproc):
     print_thread.start()
 
 
+class SnapshotService(object):
+    """
+    Keeps the most recent JPEG encoded frame of a shared stream at preview resolution,
+    so photos can be served without waiting for a capture.
+    """
+
+    def __init__(self, resources, size, interval, name=""):
+        self.resources = resources
+        self.name = name
+        self.size = size
+        self.interval = interval
+        self.frame = None
+        self.frame_time = None
+        self.stop_event = Event()
+        self.thread = None
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = Thread(name="snapshot_" + self.name if self.name else "snapshot", target=self._capture_loop,
+                             daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def get_latest(self, max_age=None):
+        """
+        Returns the latest encoded frame or None if there is none fresher than max_age seconds
+        """
+        frame, frame_time = self.frame, self.frame_time
+        if frame is None or (max_age is not None and time.monotonic() - frame_time > max_age):
+            return None
+        return frame
+
+    def _capture_loop(self):
+        LOGGER.debug("Starting snapshot capture at %s every %ss", self.size, self.interval)
+        subscription = None
+        while not self.stop_event.is_set():
+            try:
+                if subscription is None:
+                    # served as is, a larger stream such as the timelapse one would make them heavy
+                    subscription = self.resources.subscribe("snapshot", self.size, exact=True)
+                # a frame encoded meanwhile for another reader of the stream is as good,
+                # immutable bytes are handed out as is, readers never copy them
+                self.frame = subscription.next_frame(max_age=self.interval / 2)
+                FRAMES_CAPTURED.labels(camera=self.name, use="snapshot").inc()
+                self.frame_time = time.monotonic()
+            except Exception:
+                LOGGER.exception("Snapshot capture failed, retrying")
+                if subscription is not None:
+                    subscription.close()
+                    subscription = None
+            self.stop_event.wait(self.interval)
+        if subscription is not None:
+            subscription.close()
+
+
 class Camera(object):
+    """
+    Camera agent, camera_id identifies one of several cameras. Its files are suffixed with
+    it and it is set in the details of its events.
+    """
+
     def __init__(self, vflip="True", hflip="False", save_path="/var/tmp/images",
                  motion_size="320x230", stream_size="320x230", video_quality="24",
-                 video_bitrate="600000", youtube_stream_key=None, youtube_url=None):
+                 video_bitrate="600000", youtube_stream_key=None, youtube_url=None,
+                 snapshot_size="640x480", snapshot_interval="2s", motion_detection="false",
+                 motion_idle_size="160x120", motion_interval="0.3s", motion_idle_interval="2s",
+                 motion_wake_ratio="0.005", motion_escalation_time="30s", motion_min_area="500",
+                 motion_workers="0", dedup="true", dedup_threshold="3", dedup_keyframe_interval="30s",
+                 classifier_model=None, classifier_config=None, classifier_labels="person",
+                 classifier_min_confidence="0.5", classifier_input_size="300x300", port_timeout="10s", camera_id=None,
+                 backend="picamera", camera_num="0", video_device="/dev/video0", resolution="1920x1080",
+                 framerate="30", motion_max_fps="0", device=None, storage=None, frame_budget=None):
+        if camera_id is not None and (not camera_id or "_" in camera_id):
+            # file names fields are separated by _
+            raise Exception("Invalid camera id '{0}'".format(camera_id))
+        self.camera_id = camera_id
+        name = camera_id or ""
         self.motion_size = tuple([int(x) for x in motion_size.split('x')])
         self.stream_size = tuple([int(x) for x in stream_size.split('x')])
         self.video_quality = int(video_quality)
         self.video_bitrate = int(video_bitrate)
-        self.camera = picamera.PiCamera()
+        self.camera = device or create_device(backend, int(camera_num), video_device)
         self.camera.vflip = vflip.lower() == "true"
         self.camera.hflip = hflip.lower() == "true"
         self.camera.led = False
-        self.camera.resolution = (1920, 1080)
-        self.camera.framerate = 30
+        self.camera.resolution = tuple([int(x) for x in resolution.split('x')])
+        self.camera.framerate = int(framerate)
         self.camera.awb_mode = 'auto'
         self.camera.exposure_mode = 'auto'
+        self.resources = CameraResources(self.camera, parse_duration(port_timeout).total_seconds(), name)
         self.image_save_path = save_path
+        self.storage = storage or StorageManager(save_path)
         self.youtube_url = "{}/{}".format(youtube_url, youtube_stream_key)
         self.motion_detector = None
+        if motion_detection.lower() == "true":
+            self.motion_detector = MotionDetector(
+                CameraFrameSource(self, self.motion_size), self.on_motion,
+                active_size=self.motion_size,
+                idle_size=tuple([int(x) for x in motion_idle_size.split('x')]),
+                active_interval=parse_duration(motion_interval).total_seconds(),
+                idle_interval=parse_duration(motion_idle_interval).total_seconds(),
+                wake_ratio=float(motion_wake_ratio),
+                escalation_time=parse_duration(motion_escalation_time).total_seconds(),
+                min_area=int(motion_min_area),
+                workers=int(motion_workers),
+                name=name, max_fps=float(motion_max_fps), budget=frame_budget)
+        self.classifier_stage = None
+        if self.motion_detector is not None and classifier_model:
+            self.classifier_stage = self._create_classifier_stage(
+                classifier_model, classifier_config, classifier_labels, classifier_min_confidence,
+                classifier_input_size)
+        self.deduplicator = None
+        if dedup.lower() == "true":
+            self.deduplicator = FrameDeduplicator(
+                threshold=int(dedup_threshold),
+                keyframe_interval=parse_duration(dedup_keyframe_interval).total_seconds(), name=name)
         self.encode_proc = None
+        self.recording_lease = None
+        self.motion_subscription = None
+        self.timelapse_stop_event = None
+        events.alarm_armed += self.start_motion_detection
+        events.alarm_disarmed += self.stop_motion_detection
+        events.alarm_disabled += self.stop_motion_detection
+        events.sensor_triggered += self.on_sensor_triggered
         events.alarm_authenticating += self.on_authentication_required
         events.authentication_succeeded += self._stop_timelapse_from_event
         events.alarm_disarmed += self._stop_timelapse_from_event
         events.alarm_disabled += self._stop_timelapse_from_event
-        self.flags = 0
-        self.still_port_in_use = 0
-        self.lock = RLock()
-
-    def _acquire_flag(self, a_flag, port=None):
-
-        with self.lock:
-            if self._is_flag_set(a_flag):
-                raise CameraAlreadyInStateError("Flag {} is already set".format(a_flag.name))
-
-            # Limit operations to 2
-            if bit_count(self.flags) >= 2:
-                raise CameraBusyError("Cannot set flag {}, camera has already {} flags set".format(
-                    a_flag.name, self.get_state()))
-
-            self.flags |= a_flag.value
-
-            if port is None:
-                if self.still_port_in_use == 0:
-                    self.still_port_in_use = a_flag.value
-                    return CameraPort.STILL
-                else:
-                    return CameraPort.VIDEO
-            elif port == CameraPort.STILL:
-                if self.still_port_in_use != 0:
-                    raise CameraBusyError("Still port is in use cannot continue")
-                self.still_port_in_use = a_flag.value
-                return CameraPort.STILL
-            else:
-                return CameraPort.VIDEO
-
-    def _unset_flag(self, a_flag):
-        with self.lock:
-            if self.still_port_in_use & a_flag.value == a_flag.value:
-                self.still_port_in_use = 0
-                LOGGER.debug("self.still_port_in_use=%d", self.still_port_in_use)
-            self.flags ^= a_flag.value
-            LOGGER.debug("Unset flag %s self.flags=%d", a_flag.name, self.flags)
-
-    def _is_flag_set(self, a_flag):
-        is_flag_set = (a_flag.value & self.flags) == a_flag.value
-        LOGGER.debug("Flag %s is_set=%s, flags=%d", a_flag.name, is_flag_set, self.flags)
-        return is_flag_set
+        CAMERAS[camera_id] = self
+        self.lock = Lock()
+        self.snapshot = None
+        snapshot_interval = parse_duration(snapshot_interval).total_seconds()
+        if snapshot_interval > 0:
+            self.snapshot = SnapshotService(
+                self.resources, tuple([int(x) for x in snapshot_size.split('x')]), snapshot_interval, name)
+            self.snapshot.start()
+
+    def _create_classifier_stage(self, model, config, labels, min_confidence, input_size):
+        try:
+            classifier = ObjectClassifier(
+                model, config, labels=[x.strip() for x in labels.split(",") if x.strip()],
+                min_confidence=float(min_confidence), input_size=tuple([int(x) for x in input_size.split('x')]))
+        except Exception:
+            # motion alone still raises intrusions
+            LOGGER.exception("Could not load classifier model %s, motion is not classified", model)
+            return None
+        LOGGER.info("Motion classified by %s for %s", model, labels)
+        return ClassifierStage(classifier, self.on_motion_classified)
+
+    @property
+    def file_suffix(self):
+        return "_" + self.camera_id if self.camera_id else ""
 
     def take_photo_io(self):
-        port = self._acquire_flag(CameraFlags.TAKING_PICTURE)
-        try:
+        # waits for a photo in progress, the still port being free otherwise
+        with self.resources.acquire("photo", CameraPort.STILL):
             osw = io.BytesIO()
-            self.camera.capture(osw, format='jpeg', use_video_port=port == CameraPort.VIDEO)
+            self.camera.capture(osw, format='jpeg', use_video_port=False)
             osw.seek(0)
             return osw
-        finally:
-            self._unset_flag(CameraFlags.TAKING_PICTURE)
+
+    def take_snapshot(self):
+        """
+        Returns the latest preview frame as JPEG bytes without waiting for the camera,
+        raises an exception when the snapshot service has no recent frame. Full resolution
+        photos are taken with take_photo_io.
+        """
+        frame = None
+        if self.snapshot is not None:
+            frame = self.snapshot.get_latest(max_age=self.snapshot.interval * 3)
+        if frame is None:
+            raise Exception("No recent preview frame of camera {0}".format(self.camera_id or "default"))
+        return frame
 
     def on_authentication_required(self, _, session):
-        try:
-            port = self._acquire_flag(CameraFlags.TIMELAPSING)
-            self.start_timelapse(file_prefix="camera_{0}".format(session.id), port=port)
-        except CameraAlreadyInStateError:
-            return
+        self.start_timelapse(file_prefix="camera_{0}".format(session.id), session_id=session.id)
 
     def _stop_timelapse_from_event(self, *_):
         self.stop_timelapse()
 
     def start_timelapse(self, **kwargs):
-        TIMELAPSE_WAIT_EVENT.clear()
-        bg_thread = Thread(
-            name="timelapse", target=self._take_timelapse, kwargs=kwargs)
-        bg_thread.daemon = True
-        bg_thread.start()
-
-    def start_motion_detection(self):
+        """
+        Returns False if a timelapse is already in progress
+        """
+        with self.lock:
+            if self.timelapse_stop_event is not None:
+                return False
+            # each timelapse has its own stop event, a stopping one never resumes
+            self.timelapse_stop_event = Event()
+            bg_thread = Thread(
+                name="timelapse_" + self.camera_id if self.camera_id else "timelapse", target=self._take_timelapse,
+                args=(self.timelapse_stop_event,), kwargs=kwargs)
+            bg_thread.daemon = True
+            bg_thread.start()
+            return True
 
+    def capture_frame(self, size):
+        """
+        Returns a BGR frame of size, read by the motion detection thread from a shared stream
+        """
+        if self.motion_subscription is None:
+            self.motion_subscription = self.resources.subscribe("motion", self.motion_size)
         try:
-            self._acquire_flag(CameraFlags.MOTION_DETECTING, port=CameraPort.STILL)
-        except CameraAlreadyInStateError:
+            data = self.motion_subscription.next_frame()
+        except CameraError:
+            # subscribed again for the next frame
+            self._close_motion_subscription()
+            raise
+        FRAMES_CAPTURED.labels(camera=self.resources.name, use="motion").inc()
+        return decode_frame(data, self.motion_subscription.size, size)
+
+    def _close_motion_subscription(self):
+        subscription, self.motion_subscription = self.motion_subscription, None
+        if subscription is not None:
+            subscription.close()
+
+    def start_motion_detection(self, *_):
+        if self.motion_detector is None or self.motion_detector.is_running:
             return
+        if self.classifier_stage is not None:
+            self.classifier_stage.start()
+        self.motion_detector.start()
 
-        min_area = 500
-        past_frame = None
-        LOGGER.debug("Starting motion detection")
-        while self._is_flag_set(CameraFlags.MOTION_DETECTING):
-            stream = io.BytesIO()
-            self.camera.capture(stream, format='jpeg', use_video_port=False,
-                                resize=self.motion_size)
-            data = np.fromstring(stream.getvalue(), dtype=np.uint8)
-            frame = cv2.imdecode(data, 1)
-
-            # if frame is initialized, we have not reach the end of the video
-            if frame is not None:
-                past_frame = self.handle_new_frame(frame, past_frame, min_area)
-            else:
-                LOGGER.error("No more frame")
-            # rpis.state.check()
-            time.sleep(0.3)
-            # self.stop_motion_detection()
-        LOGGER.debug("motion detection started")
-
-    # def stop_motion_detection(self):
-    #     if self.motion_detector:
-    #         try:
-    #             self.motion_detector.close()
-    #         except Exception as ex:
-    #             LOGGER.error("Could not close motion_detector %s", repr(ex))
-    #         self.motion_detector = None
-    #     try:
-    #         self.camera.stop_recording(splitter_port=2)
-    #     finally:
-    #         self.is_motion_detecting = False
-
-    def handle_new_frame(self, frame, past_frame, min_area):
-        #cv2.imwrite("raw_frame_%d.jpg" % i, frame)
-        (height, width) = frame.shape[:2]
-        ratio = 500 / float(width)
-        dim = (500, int(height * ratio))
-
-        frame = cv2.resize(frame, dim, cv2.INTER_AREA)  # We resize the frame
-        # We apply a black & white filter
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        gray = cv2.GaussianBlur(gray, (21, 21), 0)  # Then we blur the picture
-
-        #cv2.imwrite("gray_frame_%d.jpg" % i, gray)
-
-        # if the first frame is None, initialize it because there is no frame for comparing the current one with a previous one
-        if past_frame is None:
-            past_frame = gray
-            return past_frame
-
-        # check if past_frame and current have the same sizes
-        (h_past_frame, w_past_frame) = past_frame.shape[:2]
-        (h_current_frame, w_current_frame) = gray.shape[:2]
-        # This shouldnt occur but this is error handling
-        if h_past_frame != h_current_frame or w_past_frame != w_current_frame:
-            LOGGER.error('Past frame and current frame do not have the same sizes {0} {1} {2} {3}'.format(
-                h_past_frame, w_past_frame, h_current_frame, w_current_frame))
+    def stop_motion_detection(self, *_):
+        if self.motion_detector is None or not self.motion_detector.is_running:
+            return
+        self.motion_detector.stop()
+        if self.classifier_stage is not None:
+            self.classifier_stage.stop()
+        self._close_motion_subscription()
+
+    def on_motion(self, motion_result, frame=None):
+        if self.classifier_stage is not None and frame is not None:
+            # triggers once the moving objects are classified, if any is of interest
+            self.classifier_stage.submit(frame, motion_result)
             return
+        # the bigger the moving area the more confident
+        confidence = min(1.0, motion_result.largest_area / (self.motion_detector.active_analyzer.min_area * 10.0))
+        emit_published("sensor_triggered", self, confidence,
+                       {"boxes": motion_result.boxes, "camera_id": self.camera_id})
+
+    def on_motion_classified(self, motion_result, detections):
+        if not detections:
+            LOGGER.debug("No object of interest in motion boxes %s", motion_result.boxes)
+            return
+        emit_published("sensor_triggered", self, detections[0].confidence, {
+            "boxes": motion_result.boxes, "labels": [d.to_dict() for d in detections], "camera_id": self.camera_id})
 
-        # compute the absolute difference between the current frame and first frame
-        frame_detla = cv2.absdiff(past_frame, gray)
-        # then apply a threshold to remove camera motion and other false positives (like light changes)
-        thresh = cv2.threshold(frame_detla, 50, 255, cv2.THRESH_BINARY)[1]
-
-        # dilate the thresholded image to fill in holes, then find contours on thresholded image
-        thresh = cv2.dilate(thresh, None, iterations=2)
-        #cv2.imwrite("thresh_frame_%d.jpg" % i, thresh)
-        cnts = cv2.findContours(
-            thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        cnts = cnts[0] if imutils.is_cv2() else cnts[1]
-
-        # loop over the contours
-        for c in cnts:
-            # print(cv2.contourArea(c))
-            # if the contour is too small, ignore it
-            if cv2.contourArea(c) < min_area:
-                continue
-
-            LOGGER.debug("Motion detected!")
-            # Motion detected because there is a contour that is larger than the specified min_area
-            # compute the bounding box for the contour, draw it on the frame,
-            (x, y, w, h) = cv2.boundingRect(c)
-            cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
-            # TODO pass frame
-            events.intrusion_detected(self)
-            #cv2.imwrite("motion_%d.jpg" % i, frame)
+    def on_sensor_triggered(self, sensor, *_):
+        if sensor is not self and self.motion_detector is not None and self.motion_detector.is_running:
+            self.motion_detector.escalate()
 
     def get_state(self):
-        states = []
-        for flag in CameraFlags:
-            if self._is_flag_set(flag):
-                states.append(flag.name.lower())
-
-        return ",".join(states)
-
-    def _take_timelapse(self, timelapse=5, file_prefix="camera", port=CameraPort.VIDEO):
+        state = self.resources.describe()
+        return "{0}: {1}".format(self.camera_id, state) if self.camera_id else state
+
+    def get_status(self):
+        return {
+            "id": self.camera_id,
+            "users": self.resources.get_users(),
+            "ports": self.resources.get_ports_usage(),
+            "motion_detection": self.motion_detector is not None and self.motion_detector.is_running,
+            "motion_active": self.motion_detector is not None and self.motion_detector.is_active,
+            "timelapse": self.timelapse_stop_event is not None and not self.timelapse_stop_event.is_set(),
+        }
+
+    def _take_timelapse(self, stop_event, timelapse=5, file_prefix="camera", session_id=None):
         LOGGER.debug("starting timelapse")
+        trace = tracer.get_trace(session_id)
+        capture_start = time.monotonic()
         try:
-            # Camera warm-up time
-            time.sleep(1)
-
-            stream = io.BytesIO()
-
-            for _ in self.camera.capture_continuous(
-                    stream, format="jpeg", use_video_port=port == CameraPort.VIDEO):
-
+            subscription = self.resources.subscribe("timelapse")
+        except Exception as ex:
+            LOGGER.error("Could not start timelapse, got exception %s", repr(ex))
+            return
+        try:
+            # the video port is always running, its frames need no warm-up
+            while not stop_event.is_set():
+                frame_data = subscription.next_frame()
                 now_string = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
-                file_name = "{0}_{1}.jpg".format(file_prefix, now_string)
-                stream.seek(0)
-
-                tmp_file_path = os.path.join(
-                    self.image_save_path, "_{0}".format(file_name))
-
-                with open(tmp_file_path, 'wb') as tmp_file:
-                    tmp_file.write(stream.read())
+                file_name = "{0}_{1}{2}.jpg".format(file_prefix, now_string, self.file_suffix)
+                FRAMES_CAPTURED.labels(camera=self.resources.name, use="timelapse").inc()
 
-                os.rename(tmp_file_path, os.path.join(
-                    self.image_save_path, file_name))
+                if trace is not None:
+                    trace.record("camera.frame", capture_start, size=len(frame_data))
+                    trace.mark("camera.first_frame", once=True)
 
-                LOGGER.debug('written picture %s', os.path.join(
-                    self.image_save_path, file_name))
+                # near duplicates of the previous frame are neither stored, uploaded nor sent
+                if self.deduplicator is None or self.deduplicator.keep(session_id, frame_data):
+                    self.storage.save(file_name, frame_data)
 
-                stream.seek(0)
-                stream.truncate()
+                    LOGGER.debug('written picture %s', os.path.join(
+                        self.image_save_path, file_name))
 
-                TIMELAPSE_WAIT_EVENT.wait(timelapse)
+                    if session_id is not None:
+                        events.frame_captured(self, session_id, frame_data)
 
-                if not self._is_flag_set(CameraFlags.TIMELAPSING):
-                    LOGGER.debug("not continuing capture_continuous")
-                    break
+                stop_event.wait(timelapse)
+                capture_start = time.monotonic()
 
         except Exception as ex:
             LOGGER.error("Got exception %s", repr(ex))
+        finally:
+            subscription.close()
+            if self.deduplicator is not None:
+                self.deduplicator.end_session()
 
     def stop_timelapse(self):
         LOGGER.debug("Stopping timelapse")
-        if not self._is_flag_set(CameraFlags.TIMELAPSING):
+        with self.lock:
+            stop_event, self.timelapse_stop_event = self.timelapse_stop_event, None
+        if stop_event is None:
             return
-        self._unset_flag(CameraFlags.TIMELAPSING)
-        TIMELAPSE_WAIT_EVENT.set()
+        stop_event.set()
         LOGGER.debug("Stopped timelapse")
 
     def _stream_to_url(self, url):
@@ -352,7 +438,8 @@ class Camera(object):
                 profile="main",
                 resize=self.stream_size,
                 quality=self.video_quality,
-                bitrate=self.video_bitrate)
+                bitrate=self.video_bitrate,
+                splitter_port=self.recording_lease.splitter_port)
             print_proc_stdout(self.encode_proc)
         except Exception as ex:
             if self.encode_proc and self.encode_proc.poll() is None:
@@ -363,17 +450,21 @@ class Camera(object):
             raise ex
 
     def toggle_web_stream(self):
-        if self._is_flag_set(CameraFlags.STREAMING):
+        if self.recording_lease is not None:
             self._stop_web_stream()
             return False
-        else:
-            self._acquire_flag(CameraFlags.STREAMING, port=CameraPort.VIDEO)
+        self.recording_lease = self.resources.acquire("streaming", CameraPort.VIDEO)
+        try:
             self._stream_to_url(self.youtube_url)
-            return True
+        except Exception:
+            self.recording_lease.release()
+            self.recording_lease = None
+            raise
+        return True
 
     def _stop_web_stream(self):
         try:
-            self.camera.stop_recording()
+            self.camera.stop_recording(splitter_port=self.recording_lease.splitter_port)
             if self.encode_proc and self.encode_proc.poll() is None:
                 try:
                     self.encode_proc.kill()
@@ -381,4 +472,5 @@ class Camera(object):
                     LOGGER.debug("Could not kill video encoding %s", repr(ex))
             self.encode_proc = None
         finally:
-            self._unset_flag(CameraFlags.STREAMING)
+            self.recording_lease.release()
+            self.recording_lease = None
@@ -1,67 +1,215 @@
-
 # -*- coding: utf-8 -*-
 
+import io
 import smtplib
 import datetime
+import time
+from collections import deque
+from string import Template
+from threading import Condition, Event, Lock, Thread
 from urllib.parse import urlparse, unquote
 
 from email.message import EmailMessage
-from .. import events, run_async, getLogger
+from PIL import Image
+from .. import events, getLogger, parse_duration, metrics
 
 
 LOGGER = getLogger(__name__)
 
+SEND_SECONDS = metrics.histogram("rpicalarm_email_send_seconds", "Warning email sending time.")
+EMAILS = metrics.counter("rpicalarm_emails", "Warning emails by outcome.", ("outcome",))
+
+SUBJECT = "[rpicalarm] Intrusion detected"
+DIGEST_SUBJECT_TEMPLATE = Template("[rpicalarm] $count intrusions detected")
+TEXT_TEMPLATE = Template("Intrusion detected at $times")
+HTML_TEMPLATE = Template("""\
+<html>
+<head></head>
+<body>
+   <p> <b>Intrusion detected at $times</b></p>
+   $images
+</body>
+</html>
+""")
+HTML_IMAGE_TEMPLATE = Template('<p><img src="cid:$cid"/></p>')
+
+
+class SmtpConnection(object):
+    """
+    Keeps a logged in SMTP connection open, checks it with NOOP before use and
+    periodically while idle, and reconnects when it is broken.
+    """
+
+    def __init__(self, host, port=None, is_ssl=False, username=None, password=None,
+                 keepalive_interval=60, timeout=20):
+        self.host = host
+        self.port = port
+        self.is_ssl = is_ssl
+        self.username = username
+        self.password = password
+        self.keepalive_interval = keepalive_interval
+        self.timeout = timeout
+        self.smtp = None
+        self.lock = Lock()
+        self.stop_event = Event()
+        if keepalive_interval > 0:
+            Thread(name="smtp_keepalive", target=self._keepalive, daemon=True).start()
+
+    def _connect(self):
+        smtp_func = smtplib.SMTP_SSL if self.is_ssl else smtplib.SMTP
+        smtp_opts = {
+            'host': self.host,
+            'timeout': self.timeout
+        }
+        if self.port:
+            smtp_opts['port'] = self.port
+        smtp = smtp_func(**smtp_opts)
+        if self.username:
+            LOGGER.debug("login in with username=%s", self.username)
+            smtp.login(self.username, self.password)
+        LOGGER.debug("Connected to smtp server %s", self.host)
+        return smtp
+
+    def _is_alive(self):
+        if self.smtp is None:
+            return False
+        try:
+            return self.smtp.noop()[0] == 250
+        except smtplib.SMTPException:
+            return False
+        except OSError:
+            return False
+
+    def _close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.close()
+            except Exception:
+                LOGGER.debug("Failed closing smtp connection")
+            self.smtp = None
+
+    def send_message(self, msg):
+        with self.lock:
+            if not self._is_alive():
+                self._close()
+                self.smtp = self._connect()
+            try:
+                self.smtp.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                LOGGER.debug("Smtp server disconnected, reconnecting")
+                self.smtp = self._connect()
+                self.smtp.send_message(msg)
+
+    def _keepalive(self):
+        while not self.stop_event.wait(self.keepalive_interval):
+            with self.lock:
+                if self.smtp is not None and not self._is_alive():
+                    LOGGER.debug("Smtp connection is broken, closing it")
+                    self._close()
+
+    def close(self):
+        self.stop_event.set()
+        with self.lock:
+            self._close()
+
 
 class Emailer(object):
 
-    def __init__(self, from_email=None, to_email=None, smtp_server_url=None):
+    def __init__(self, from_email=None, to_email=None, smtp_server_url=None, digest_window="2m",
+                 keepalive_interval="1m", attached_frames="3", attached_frame_size="640x480"):
         self.from_email = from_email
         self.to_email = to_email
+        self.digest_window = parse_duration(digest_window).total_seconds()
+        self.attached_frame_size = tuple([int(x) for x in attached_frame_size.split('x')])
+        self.frames = deque(maxlen=int(attached_frames))
+        self.frames_lock = Lock()
+        self.alarm_times = []
+        self.last_sent_time = None
+        self.cond = Condition()
         self._register_events_handlers()
         url_parse_res = urlparse(smtp_server_url)
-        self.smtp_host = url_parse_res.hostname
-        self.smtp_port = url_parse_res.port
-        self.smtp_username = unquote(url_parse_res.username)
-        self.smtp_password = unquote(url_parse_res.password)
-        self.smtp_is_ssl = url_parse_res.scheme == "smtps"
+        self.connection = SmtpConnection(
+            url_parse_res.hostname,
+            port=url_parse_res.port,
+            is_ssl=url_parse_res.scheme == "smtps",
+            username=unquote(url_parse_res.username) if url_parse_res.username else None,
+            password=unquote(url_parse_res.password) if url_parse_res.password else None,
+            keepalive_interval=parse_duration(keepalive_interval).total_seconds())
+        self.thread = Thread(name="emailer", target=self._run, daemon=True)
+        self.thread.start()
 
     def _register_events_handlers(self):
         events.alarm_alarming += self.send_warning_email
+        events.frame_captured += self.on_frame_captured
+
+    def on_frame_captured(self, _camera, session_id, frame_data):
+        with self.frames_lock:
+            if self.frames and self.frames[-1][0] != session_id:
+                self.frames.clear()
+            self.frames.append((session_id, frame_data))
 
-    @run_async
     def send_warning_email(self, *_):
-        try:
-            smtp_func = smtplib.SMTP_SSL if self.smtp_is_ssl else smtplib.SMTP
-            smtp_opts = {
-                'host': self.smtp_host,
-                'timeout': 20
-            }
-            if self.smtp_port:
-                smtp_opts['port'] = self.smtp_port
-
-            with smtp_func(**smtp_opts) as smtp:
-                msg = EmailMessage()
-                msg['Subject'] = '[rpicalarm] Intrusion detected'
-                msg['From'] = self.from_email
-                msg['To'] = self.to_email
-                msg_text = "Intrusion detected at {}".format(
-                    datetime.datetime.now().strftime('%H:%M:%S %d/%m/%Y'))
-                msg.set_content(msg_text)
-                msg.add_alternative("""\
-                <html>
-                <head></head>
-                <body>
-                   <p> <b>{}</b></p>
-                </body>
-                </html>
-                """.format(msg_text), subtype='html')
-
-                if self.smtp_username:
-                    LOGGER.debug("login in with username=%s,password=%s",
-                                 self.smtp_username, self.smtp_password)
-                    smtp.login(self.smtp_username, self.smtp_password)
-                smtp.send_message(msg)
-                LOGGER.debug("message sent")
-
-        except Exception:
-            LOGGER.exception("Failed sending warning email")
+        """
+        Queues a warning email, alarms raised within the digest window are sent as one email
+        """
+        with self.cond:
+            self.alarm_times.append((datetime.datetime.now(), time.monotonic()))
+            self.cond.notify()
+
+    def _next_digest(self):
+        with self.cond:
+            while not self.alarm_times:
+                self.cond.wait()
+            # The first alarm goes out immediately, the following ones within the window are digested
+            if self.last_sent_time is not None:
+                window_end = self.last_sent_time + self.digest_window
+                while time.monotonic() < window_end:
+                    self.cond.wait(window_end - time.monotonic())
+            alarm_times, self.alarm_times = self.alarm_times, []
+            return alarm_times
+
+    def _run(self):
+        while True:
+            alarm_times = self._next_digest()
+            self.last_sent_time = time.monotonic()
+            try:
+                message = self._build_message(alarm_times)
+                with SEND_SECONDS.time():
+                    self.connection.send_message(message)
+                EMAILS.labels(outcome="sent").inc()
+                LOGGER.info("Warning email delivered %.3fs after alarm", time.monotonic() - alarm_times[0][1])
+            except Exception:
+                EMAILS.labels(outcome="failed").inc()
+                LOGGER.exception("Failed sending warning email")
+
+    def _resize_frame(self, frame_data):
+        image = Image.open(io.BytesIO(frame_data))
+        image.thumbnail(self.attached_frame_size)
+        out = io.BytesIO()
+        image.save(out, format="jpeg", quality=80)
+        return out.getvalue()
+
+    def _build_message(self, alarm_times):
+        times = ", ".join(t.strftime('%H:%M:%S %d/%m/%Y') for t, _ in alarm_times)
+        with self.frames_lock:
+            frames = [f for _, f in self.frames]
+
+        msg = EmailMessage()
+        if len(alarm_times) == 1:
+            msg['Subject'] = SUBJECT
+        else:
+            msg['Subject'] = DIGEST_SUBJECT_TEMPLATE.substitute(count=len(alarm_times))
+        msg['From'] = self.from_email
+        msg['To'] = self.to_email
+        msg.set_content(TEXT_TEMPLATE.substitute(times=times))
+
+        cids = ["frame{0}".format(i) for i in range(len(frames))]
+        images = "".join(HTML_IMAGE_TEMPLATE.substitute(cid=cid) for cid in cids)
+        msg.add_alternative(HTML_TEMPLATE.substitute(times=times, images=images), subtype='html')
+        html_part = msg.get_payload()[1]
+        for cid, frame in zip(cids, frames):
+            try:
+                html_part.add_related(self._resize_frame(frame), 'image', 'jpeg', cid="<{0}>".format(cid))
+            except Exception:
+                LOGGER.exception("Failed attaching frame %s", cid)
+        return msg
@@ -1,48 +1,65 @@
 # -*- coding: utf-8 -*-
-from time import time
 
-# disable pylint for module for development on non-arm machine
-# pylint: disable=E0401
-import RPi.GPIO as GPIO
-
-from .. import events, getLogger
+from .. import events, emit_published, getLogger, parse_duration
+from ..pulse_analyzer import PulsePattern, PulseTrainAnalyzer
 
 
 LOGGER = getLogger(__name__)
 
 
+def get_default_gpio():
+    # disable pylint for module for development on non-arm machine
+    # pylint: disable=E0401
+    import RPi.GPIO as GPIO
+    return GPIO
+
+
 class PirSensor(object):
 
-    def __init__(self, pin_num):
+    def __init__(self, pin_num, min_pulses="2", pulse_window="15s", min_high_duration="0s", gpio=None):
         self.pin_num = int(pin_num)
+        self.gpio = gpio or get_default_gpio()
         LOGGER.debug("GPIO numbering mode is %s (GPIO.BOARD=%s,GPIO.BCM=%s)",
-                     GPIO.getmode(), GPIO.BOARD, GPIO.BCM)
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.pin_num, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+                     self.gpio.getmode(), self.gpio.BOARD, self.gpio.BCM)
+        self.gpio.setmode(self.gpio.BCM)
+        self.gpio.setup(self.pin_num, self.gpio.IN, pull_up_down=self.gpio.PUD_DOWN)
+        self.analyzer = PulseTrainAnalyzer(
+            PulsePattern(min_pulses=int(min_pulses),
+                         window=parse_duration(pulse_window).total_seconds(),
+                         min_high_duration=parse_duration(min_high_duration).total_seconds()),
+            self.on_motion_detected)
+        self.is_started = False
         self._register_events_handlers()
-        self.last_event = None
 
     def _register_events_handlers(self):
         events.alarm_disabled += self._stop
         events.alarm_disarmed += self._stop
         events.alarm_armed += self._start
 
-    def on_pin_event(self, _channel):
-        LOGGER.debug("pin event")
-        last_event = self.last_event
-        current_event = time()
-        self.last_event = current_event
-        if last_event is not None and current_event - last_event < 15:
-            LOGGER.debug("detected motion")
-            events.intrusion_detected(self)
+    def on_pin_event(self, channel):
+        # Runs in the GPIO callback thread, only record the edge
+        self.analyzer.record_edge(self.gpio.input(channel))
+
+    def on_motion_detected(self):
+        LOGGER.debug("detected motion")
+        emit_published("sensor_triggered", self, 1.0, {"first_edge_time": self.analyzer.match_start_time})
 
     def _start(self, *_):
-        GPIO.add_event_detect(self.pin_num, GPIO.RISING, callback=self.on_pin_event, bouncetime=200)
+        # armed again after alarming, the pin is still monitored
+        if self.is_started:
+            return
+        self.is_started = True
+        self.analyzer.start()
+        self.gpio.add_event_detect(self.pin_num, self.gpio.BOTH, callback=self.on_pin_event, bouncetime=200)
         events.sensor_started(self)
         LOGGER.debug("Started monitoring events on pin %s", self.pin_num)
 
     def _stop(self, *_):
-        GPIO.remove_event_detect(self.pin_num)
+        if not self.is_started:
+            return
+        self.is_started = False
+        self.gpio.remove_event_detect(self.pin_num)
+        self.analyzer.stop()
         events.sensor_stopped(self)
         LOGGER.debug("Stopped monitoring events on pin %s", self.pin_num)
 
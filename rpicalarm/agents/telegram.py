@@ -1,37 +1,268 @@
 # -*- coding: utf-8 -*-
 import logging
 import datetime
-
-from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+import hashlib
+import io
+import time
+from collections import deque
+from concurrent.futures import Future
+from threading import Condition, Event, Thread
+
+from flask import request
+from PIL import Image
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, Update
+from telegram.error import RetryAfter, TimedOut, NetworkError
 from telegram.ext import Updater, CommandHandler, RegexHandler, DispatcherHandlerStop, ConversationHandler
+from telegram.utils.request import Request
 
 from rpicalarm.util import getLogger
-from .. import events, run_async, AuthFailureReason, AlarmState
+from .. import events, run_async, parse_duration, AuthFailureReason, AlarmState, TokenBucket, tracer, metrics
 
 LOGGER = getLogger(__name__)
 getLogger("telegram").setLevel(logging.ERROR)
 
 AUTH_MSG = "Intrusion detected. What is your password ?"
 
+NO_CAMERA_MSG = "No camera"
+
 CONV_AUTH, CONV_SET_DISARM_TIME = range(2)
 
+STATUS_MSG_KEY = "status"
+
+API_SECONDS = metrics.histogram("rpicalarm_telegram_api_seconds", "Telegram send API call time.")
+API_ERRORS = metrics.counter("rpicalarm_telegram_api_errors", "Telegram send API errors by kind.", ("kind",))
+
+
+class OutgoingMessage(object):
+
+    def __init__(self, send_func, coalesce_key=None):
+        self.send_func = send_func
+        self.coalesce_key = coalesce_key
+        self.future = Future()
+        self.tries = 0
+
+    def __repr__(self):
+        return str(self.__dict__)
+
+
+class ChatSendQueue(object):
+    """
+    Ordered outbound queue of a chat. Messages sharing a coalesce key supersede the
+    pending one, sending is rate limited and retried on flood control errors.
+    """
+
+    def __init__(self, chat_id, rate=1.0, burst=3, max_tries=5):
+        self.chat_id = chat_id
+        self.bucket = TokenBucket(rate, burst)
+        self.max_tries = max_tries
+        self.pending = deque()
+        self.cond = Condition()
+        self.stop_event = Event()
+        self.thread = Thread(name="telegram_send_{0}".format(chat_id), target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, send_func, coalesce_key=None):
+        message = OutgoingMessage(send_func, coalesce_key)
+        with self.cond:
+            if coalesce_key is not None:
+                # the message being sent, if any, is left to complete
+                for superseded in [m for m in self.pending
+                                   if m.coalesce_key == coalesce_key and not m.future.running()]:
+                    self.pending.remove(superseded)
+                    if not superseded.future.cancelled():
+                        superseded.future.set_result(None)
+                    LOGGER.debug("Coalesced pending %s message", coalesce_key)
+            self.pending.append(message)
+            self.cond.notify()
+        return message.future
+
+    def stop(self):
+        self.stop_event.set()
+        with self.cond:
+            self.cond.notify()
+
+    def _next_message(self):
+        with self.cond:
+            while not self.pending and not self.stop_event.is_set():
+                self.cond.wait()
+            return self.pending[0] if self.pending else None
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            message = self._next_message()
+            if message is None:
+                return
+            with self.cond:
+                # might have been coalesced while waiting for a token
+                if not self.pending or self.pending[0] is not message:
+                    continue
+                if message.tries == 0 and message.future.cancelled():
+                    LOGGER.debug("Dropping cancelled message")
+                    self.pending.popleft()
+                    continue
+                # only messages actually sent take a token, not the coalesced ones
+                wait_time = self.bucket.try_consume()
+                if not wait_time and message.tries == 0 and not message.future.set_running_or_notify_cancel():
+                    LOGGER.debug("Dropping cancelled message")
+                    self.pending.popleft()
+                    continue
+            if wait_time:
+                self.stop_event.wait(wait_time)
+                continue
+            retry_delay = self._deliver(message)
+            if retry_delay is None:
+                with self.cond:
+                    if self.pending and self.pending[0] is message:
+                        self.pending.popleft()
+            else:
+                self.stop_event.wait(retry_delay)
+
+    def _deliver(self, message):
+        """
+        Returns the delay before retrying the message or None if it is done with
+        """
+        message.tries += 1
+        try:
+            with API_SECONDS.time():
+                result = message.send_func()
+            message.future.set_result(result)
+            return None
+        except RetryAfter as ex:
+            LOGGER.warning("Telegram flood control, retrying in %ss", ex.retry_after)
+            API_ERRORS.labels(kind="flood_control").inc()
+            retry_delay = ex.retry_after
+        except (TimedOut, NetworkError) as ex:
+            LOGGER.warning("Telegram network error %s", repr(ex))
+            API_ERRORS.labels(kind="network").inc()
+            retry_delay = message.tries
+        except Exception as ex:
+            LOGGER.exception("Failed sending Telegram message")
+            API_ERRORS.labels(kind="other").inc()
+            message.future.set_exception(ex)
+            return None
+
+        if message.tries >= self.max_tries:
+            LOGGER.error("Giving up sending Telegram message after %d tries", message.tries)
+            message.future.set_exception(Exception("Max tries reached"))
+            return None
+        return retry_delay
+
+
+class SessionFrameSender(object):
+    """
+    Delivers the frames captured during an authentication session as albums.
+    Frames are downscaled in the sender thread and grouped by up to MAX_GROUP_SIZE,
+    the first frame of a session is sent on its own as soon as it is available.
+    """
+
+    MAX_GROUP_SIZE = 10
+
+    def __init__(self, telegram_agent, size=(640, 480), interval=5, max_pending=30):
+        self.telegram_agent = telegram_agent
+        self.size = size
+        self.interval = interval
+        self.session_id = None
+        self.sent_count = 0
+        self.frames = deque(maxlen=max_pending)
+        self.cond = Condition()
+        self.thread = Thread(name="telegram_frames", target=self._run, daemon=True)
+        self.thread.start()
+
+    def start_session(self, session_id):
+        with self.cond:
+            self.session_id = session_id
+            self.sent_count = 0
+            self.frames.clear()
+
+    def end_session(self):
+        with self.cond:
+            self.session_id = None
+            self.frames.clear()
+
+    def add_frame(self, session_id, frame_data):
+        with self.cond:
+            if session_id != self.session_id:
+                return
+            self.frames.append(frame_data)
+            self.cond.notify()
+
+    def _take_frames(self):
+        with self.cond:
+            while not self.frames:
+                self.cond.wait()
+            group_size = 1 if self.sent_count == 0 else SessionFrameSender.MAX_GROUP_SIZE
+            frames = [self.frames.popleft() for _ in range(min(group_size, len(self.frames)))]
+            self.sent_count += len(frames)
+            return self.session_id, frames
+
+    def _downscale(self, frame_data):
+        image = Image.open(io.BytesIO(frame_data))
+        if image.size[0] <= self.size[0] and image.size[1] <= self.size[1]:
+            return frame_data
+        image.thumbnail(self.size)
+        out = io.BytesIO()
+        image.save(out, format="jpeg", quality=80)
+        return out.getvalue()
+
+    def _run(self):
+        while True:
+            session_id, frames = self._take_frames()
+            try:
+                with tracer.span(session_id, "telegram.frames_upload", count=len(frames)):
+                    frames = [self._downscale(f) for f in frames]
+                    sent = self.telegram_agent.send_frames(frames)
+                    # Wait for the upload so that frames keep accumulating into the next album
+                    sent.result()
+            except Exception:
+                LOGGER.exception("Failed sending frames of session %s", session_id)
+            with self.cond:
+                if self.session_id == session_id:
+                    self.cond.wait(self.interval)
+
 
 class Telegram(object):
     """
     Performs end-user interaction.
     """
 
-    def __init__(self, alarm, camera, **cfg):
+    def __init__(self, alarm, camera, web_server=None, cameras=None, **cfg):
         self.bot_name = cfg["bot_name"]
         self.user_id = int(cfg["user_id"])
         self.user_name = cfg["user_name"]
         self.channel = cfg["channel"]
-        self.bot = Bot(cfg["bot_token"])
+        self.mode = cfg.get("mode", "polling")
+        self.workers = int(cfg.get("workers", 4))
+        self.webhook_url = cfg.get("webhook_url")
+        self.webhook_secret = cfg.get("webhook_secret") or hashlib.sha256(
+            cfg["bot_token"].encode("utf-8")).hexdigest()[:32]
+        self.web_server = web_server
+        # Polling or dispatching, worker threads, send queues all share the same keep-alive pool
+        # api_url points the bot to another Bot API server, e.g. a local stand-in
+        self.bot = Bot(cfg["bot_token"], base_url=cfg.get("api_url"),
+                       request=Request(con_pool_size=self.workers + 4))
+        self.send_rate = float(cfg.get("send_rate", 1))
+        self.send_burst = int(cfg.get("send_burst", 3))
+        self.send_queues = {}
+        metrics.gauge("rpicalarm_telegram_send_queue_depth", "Messages waiting to be sent to Telegram.",
+                      func=lambda: sum(len(q.pending) for q in list(self.send_queues.values())))
         self.alarm = alarm
+        # None when the camera agent is disabled, the camera commands answer NO_CAMERA_MSG
         self.camera = camera
+        # commands may name one of the cameras by id, camera being the default one
+        self.cameras = cameras or ([camera] if camera is not None else [])
         self.chat_id = None
         self.session = None
         self.conv_handler = None
+        self.updater = None
+        self.auth_message = None
+        self.auth_delay = parse_duration(cfg.get("auth_delay", "0s")).total_seconds()
+        self.auth_deadline = parse_duration(cfg.get("auth_deadline", "0s")).total_seconds()
+        self.frame_sender = None
+        if cfg.get("album_enabled", "true").lower() == "true":
+            self.frame_sender = SessionFrameSender(
+                self,
+                size=tuple([int(x) for x in cfg.get("album_size", "640x480").split('x')]),
+                interval=parse_duration(cfg.get("album_interval", "5s")).total_seconds())
         self._start()
         self._register_events_handlers()
 
@@ -46,6 +277,7 @@ class Telegram(object):
         events.alarm_disabled += self._send_status
         events.alarm_disarmed += self._send_status
         events.alarm_armed += self._send_status
+        events.frame_captured += self.on_frame_captured
 
     def handle_save_chat_id(self, _, update):
         from_user_id = update.message.from_user.id
@@ -59,21 +291,40 @@ class Telegram(object):
         LOGGER.debug("Received Telegram bot message: %s", update.message.text)
 
     def handle_get_status(self, *_):
+        self._send_message(self._get_status_text(), coalesce_key=STATUS_MSG_KEY)
+
+    def _get_status_text(self):
         msg = "status: {0}".format(self.alarm.state)
         if self.alarm.state == AlarmState.DISARMED:
             msg += "\nWill be re-armed in {0}".format(self.alarm.get_readable_disarm_time())
-        self._send_message(msg)
-
-    def handle_take_photo(self, *_):
-        photo = None
+        return msg
+
+    def _get_camera(self, update):
+        args = update.message.text.split()[1:]
+        return next((c for c in self.cameras if c.camera_id in args), self.camera)
+
+    def handle_take_photo(self, _, update):
+        received_time = time.monotonic()
+        camera = self._get_camera(update)
+        if camera is None:
+            self._send_message(NO_CAMERA_MSG)
+            return
         try:
-            with self.camera.take_photo_io() as photo:
-                self._send_message("sending your file...")
-                self.bot.send_photo(self.chat_id, photo, timeout= 60,
-                                    caption=datetime.datetime.now().strftime('%H:%M:%S %d/%m/%Y'))
+            if "full" in update.message.text.split()[1:]:
+                with camera.take_photo_io() as photo:
+                    photo_data = photo.getvalue()
+            else:
+                photo_data = camera.take_snapshot()
+            caption = datetime.datetime.now().strftime('%H:%M:%S %d/%m/%Y')
+            chat_id = self.chat_id
+
+            def send_photo():
+                LOGGER.info("Photo upload starting %.3fs after command receipt", time.monotonic() - received_time)
+                return self.bot.send_photo(chat_id, io.BytesIO(photo_data), timeout=60, caption=caption)
+            self._get_send_queue(chat_id).put(send_photo)
         except Exception:
             LOGGER.exception("Failed taking photo")
-            self._send_message("Failed taking photo")
+            self._send_message("Failed taking photo, /photo full takes a full resolution one")
 
     def handle_enable(self, *_):
         self._update_state(AlarmState.ARMED)
@@ -106,9 +357,13 @@ class Telegram(object):
             self._send_message("Invalid duration format")
             return None
 
-    def handle_cam(self, *_):
+    def handle_cam(self, _, update):
+        camera = self._get_camera(update)
+        if camera is None:
+            self._send_message(NO_CAMERA_MSG)
+            return
         try:
-            if self.camera.toggle_web_stream():
+            if camera.toggle_web_stream():
                 self._send_message(
                     "Live stream started, check out https://www.youtube.com/live_dashboard")
             else:
@@ -119,8 +374,11 @@ class Telegram(object):
 
     def handle_cam_status(self, *_):
         LOGGER.debug("Executing handle_cam_status")
+        if not self.cameras:
+            self._send_message(NO_CAMERA_MSG)
+            return
         try:
-            status = self.camera.get_state()
+            status = "\n".join(c.get_state() for c in self.cameras)
             self._send_message("Camera is {}".format(status))
         except Exception:
             LOGGER.exception("Failed getting camera status")
@@ -131,7 +389,7 @@ class Telegram(object):
             self.alarm.update_state(new_state)
         except Exception:
             LOGGER.exception("Failed updating state to %s", new_state)
-            self._send_message("Failed updating state, current state is %s", self.alarm.state)
+            self._send_message("Failed updating state, current state is {0}".format(self.alarm.state))
 
     def _get_conv_key(self):
         return (self.chat_id,)
@@ -143,27 +401,78 @@ class Telegram(object):
                 LOGGER.debug("No chat id present, sending invite to join to chat")
                 mark_up = InlineKeyboardMarkup([[InlineKeyboardButton(
                     text="Authenticate", url="telegram.me/{0}?start={1}".format(self.bot_name, session.id))]])
-                self._send_message("", reply_markup=mark_up)
+                sent = self._send_message("", reply_markup=mark_up)
             else:
                 self.conv_handler.update_state(CONV_AUTH, self._get_conv_key())
-                self._send_message(AUTH_MSG)
+                sent = self._send_message(AUTH_MSG)
         except Exception:
             events.authentication_failed(self, session, AuthFailureReason.AUTHENTICATOR_FAILURE)
             LOGGER.exception("Failed sending authentication message")
+            return
 
-    @run_async
-    def _send_status(self, *_):
-        if self.chat_id is not None and self.bot is not None:
-            self.handle_get_status()
+        self.auth_message = sent
 
-    @run_async
-    def _send_message_async(self, *args, **kwargs):
-        return self._send_message(*args, **kwargs)
+        def on_sent(future):
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                LOGGER.error("Failed sending authentication message")
+                events.authentication_failed(self, session, AuthFailureReason.AUTHENTICATOR_FAILURE)
+            else:
+                session.trace.mark("telegram.prompt_sent")
+        sent.add_done_callback(on_sent)
 
-    def _send_message(self, text, reply_markup=None):
-        LOGGER.debug("Chat id is #%s#", self.chat_id)
-        self.bot.send_message(self.chat_id,
-                              "[Alarm] {0}".format(text), reply_markup=reply_markup)
+    def _send_status(self, *_):
+        if self.chat_id is not None and self.bot is not None:
+            self._send_message(self._get_status_text(), coalesce_key=STATUS_MSG_KEY)
+
+    def _get_send_queue(self, chat_id):
+        send_queue = self.send_queues.get(chat_id)
+        if send_queue is None:
+            send_queue = self.send_queues.setdefault(
+                chat_id, ChatSendQueue(chat_id, rate=self.send_rate, burst=self.send_burst))
+        return send_queue
+
+    def _send_message(self, text, reply_markup=None, coalesce_key=None):
+        """
+        Queues the message for the current chat and returns a future of the sent message
+        """
+        chat_id = self.chat_id
+        LOGGER.debug("Chat id is #%s#", chat_id)
+        return self._get_send_queue(chat_id).put(
+            lambda: self.bot.send_message(chat_id, "[Alarm] {0}".format(text), reply_markup=reply_markup),
+            coalesce_key=coalesce_key)
+
+    def _pooled(self, handler):
+        """
+        Runs the handler in the dispatcher worker pool so slow commands do not
+        hold up the processing of following updates
+        """
+
+        def pooled_handler(*args, **kwargs):
+            self.updater.dispatcher.run_async(handler, *args, **kwargs)
+        return pooled_handler
+
+    def handle_webhook_update(self):
+        update = Update.de_json(request.get_json(force=True), self.bot)
+        self.updater.update_queue.put(update)
+        return ('', 200)
+
+    def send_frames(self, frames):
+        """
+        Queues the frames to the current chat as a photo or an album and returns the future of the upload
+        """
+        chat_id = self.chat_id
+        if len(frames) == 1:
+            return self._get_send_queue(chat_id).put(
+                lambda: self.bot.send_photo(chat_id, io.BytesIO(frames[0]), timeout=60))
+        return self._get_send_queue(chat_id).put(
+            lambda: self.bot.send_media_group(
+                chat_id, [InputMediaPhoto(io.BytesIO(f)) for f in frames], timeout=60))
+
+    def on_frame_captured(self, _camera, session_id, frame_data):
+        if self.frame_sender is not None:
+            self.frame_sender.add_frame(session_id, frame_data)
 
     def error_callback(self, _, update, error):
         LOGGER.error("Update \"%s\" caused error \"%s\"", update, error)
@@ -171,39 +480,67 @@ class Telegram(object):
     def handle_chat_start(self, _, update):
         LOGGER.debug("starting chat %s", repr(update))
         if self.session is not None:
-            self._send_message_async(AUTH_MSG)
+            self._send_message(AUTH_MSG)
             return CONV_AUTH
         return None
 
-    @run_async
-    def on_authentication_required(self, _, session):
+    @property
+    def name(self):
+        return "telegram"
+
+    def start_authentication(self, session):
         self.session = session
         self._authenticate(session)
 
+    def cancel_authentication(self, session):
+        if self.session is not session:
+            return
+        self.session = None
+        if self.auth_message is not None:
+            self.auth_message.cancel()
+
     @run_async
-    def on_authentication_successful(self, *_):
+    def on_authentication_required(self, _, session):
+        if self.frame_sender is not None:
+            if self.camera is None:
+                # no frames will follow the password prompt
+                self._send_message(NO_CAMERA_MSG)
+                return
+            self.frame_sender.start_session(session.id)
+            try:
+                # Timelapse is warming up, the preview frame makes the first delivery immediate
+                self.frame_sender.add_frame(session.id, self.camera.take_snapshot())
+            except Exception as ex:
+                # the timelapse frames follow
+                LOGGER.warning("No first frame for session %s: %s", session.id, ex)
+
+    def on_authentication_successful(self, origin, _session):
+        if origin is not self:
+            return
         self._send_message(
             "You have been authenticated. Enter the disarm time (ex: 4h for 4 hours) or just type 0 to disable the alarm.")
 
-    @run_async
     def on_authentication_failed(self, _origin, _session, reason):
         if reason == AuthFailureReason.TIMEOUT:
             self._send_message("Authentication timed-out")
 
     def on_authentication_ended(self, *_):
         self.session = None
+        if self.frame_sender is not None:
+            self.frame_sender.end_session()
 
     def _start(self):
         try:
-            updater = Updater(bot=self.bot)
+            updater = Updater(bot=self.bot, workers=self.workers)
+            self.updater = updater
             dispatcher = updater.dispatcher
             dispatcher.add_handler(RegexHandler('.*', self.handle_debug), group=1)
             dispatcher.add_handler(RegexHandler('.*', self.handle_save_chat_id), group=2)
             dispatcher.add_handler(CommandHandler("status", self.handle_get_status), group=3)
-            dispatcher.add_handler(CommandHandler("photo", self.handle_take_photo), group=3)
+            dispatcher.add_handler(CommandHandler("photo", self._pooled(self.handle_take_photo)), group=3)
             dispatcher.add_handler(CommandHandler("disable", self.handle_disable), group=3)
             dispatcher.add_handler(CommandHandler("enable", self.handle_enable), group=3)
-            dispatcher.add_handler(CommandHandler("cam", self.handle_cam), group=3)
+            dispatcher.add_handler(CommandHandler("cam", self._pooled(self.handle_cam)), group=3)
             dispatcher.add_handler(CommandHandler("camstatus", self.handle_cam_status), group=3)
 
             self.conv_handler = ConversationHandler(
@@ -218,8 +555,23 @@ class Telegram(object):
             dispatcher.add_handler(self.conv_handler, group=4)
 
             dispatcher.add_error_handler(self.error_callback)
-            updater.start_polling(timeout=10)
+            if self.mode == "webhook":
+                self._start_webhook()
+            else:
+                updater.start_polling(timeout=10)
         except Exception:
             LOGGER.exception('Telegram Updater failed to start with error')
         else:
             LOGGER.info("thread running")
+
+    def _start_webhook(self):
+        if self.web_server is None or not self.webhook_url:
+            raise Exception("Webhook mode requires a web server and a webhook_url")
+        route = "/telegram/{0}".format(self.webhook_secret)
+        # Telegram can not authenticate, the secret route path is the credential
+        self.web_server.add_route(route, "telegram_webhook", self.handle_webhook_update,
+                                  basic_auth=False, methods=["POST"])
+        dispatcher_thread = Thread(name="telegram_dispatcher", target=self.updater.dispatcher.start, daemon=True)
+        dispatcher_thread.start()
+        self.bot.set_webhook(url="{0}{1}".format(self.webhook_url.rstrip("/"), route))
+        LOGGER.info("Telegram webhook registered on route /telegram/<secret>")
@@ -1,20 +1,88 @@
 # -*- coding: utf-8 -*-
 
-from threading import Timer
+import time
+from enum import Enum
+from string import Template
+from threading import Lock
+from xml.sax.saxutils import escape
 
 from flask import abort, request
-from twilio.twiml.voice_response import VoiceResponse, Gather
+from twilio.twiml.voice_response import VoiceResponse
 from twilio.request_validator import RequestValidator
 from twilio.rest import Client
 
-from .. import events, getLogger, AuthFailureReason, AlarmState, parse_duration
+from .. import events, getLogger, AuthFailureReason, AlarmState, parse_duration, metrics
 
 LOGGER = getLogger(__name__)
 
-GENERIC_ERROR = VoiceResponse()
-GENERIC_ERROR.say("An error occurred")
-GENERIC_ERROR.say("Goodbye")
-GENERIC_ERROR.hangup()
+ACTION_PLACEHOLDER = "${action}"
+DISARM_PROMPT_TEXT = "Enter disarm time, last digit is the unit followed by the pound key. Or, hang-up now to disable the alarm."
+# calls without request for that long are forgotten, Twilio requests them every gather timeout
+CALL_IDLE_TIMEOUT = 300
+
+
+def build_twiml_template(*steps):
+    """
+    Renders the TwiML once, with placeholders such as ${action}, ${tries} or ${text}
+    substituted on each request
+    """
+    voice_response = VoiceResponse()
+    for verb, arg in steps:
+        if verb == "gather":
+            voice_response.gather(action=ACTION_PLACEHOLDER, timeout=30, finishOnKey="#").say(arg)
+        elif verb == "hangup":
+            voice_response.hangup()
+        else:
+            voice_response.say(arg)
+    return Template(str(voice_response))
+
+
+def render_twiml(template, **kwargs):
+    return template.substitute({k: escape(str(v), {'"': "&quot;"}) for k, v in kwargs.items()})
+
+
+GENERIC_ERROR = build_twiml_template(("say", "An error occurred"), ("say", "Goodbye"), ("hangup", None))
+GREETING = build_twiml_template(("say", "Hi this is your alarm speaking."),
+                                ("gather", "Please enter your password followed by the pound key."))
+PASSWORD_PROMPT = build_twiml_template(("gather", "Please enter your password followed by the pound key."))
+AUTH_FAILED_RETRY = build_twiml_template(("say", "Authentication failed"), ("say", "You have ${tries} tries remaining"),
+                                         ("gather", "Enter your password followed by the pound key"))
+AUTH_FAILED_HANGUP = build_twiml_template(("say", "Authentication failed"), ("say", "Goodbye"), ("hangup", None))
+AUTHENTICATED = build_twiml_template(("say", "You have been authenticated"), ("gather", DISARM_PROMPT_TEXT))
+DISARM_PROMPT = build_twiml_template(("gather", DISARM_PROMPT_TEXT))
+DISARM_TIME_SET = build_twiml_template(("say", "Disarm time set for ${text}"), ("hangup", None))
+DISARM_TIME_FAILED = build_twiml_template(("say", "The disarm time could not be set, current state is ${text}"),
+                                          ("say", "Goodbye"), ("hangup", None))
+ALREADY_AUTHENTICATED = build_twiml_template(("say", "You already have been authenticated. current state is ${text}"),
+                                             ("say", "Goodbye"), ("hangup", None))
+ALARM_BLARING = build_twiml_template(("say", "Alarm is blaring. Goodbye."), ("hangup", None))
+GOODBYE = build_twiml_template(("say", "Goodbye"), ("hangup", None))
+
+
+class CallState(Enum):
+    GREETING = 1
+    AWAITING_PASSWORD = 2
+    AWAITING_DISARM_TIME = 3
+    COMPLETED = 4
+
+
+class CallFlow(object):
+    """
+    State of an authentication call, with the last response kept to answer Twilio retries
+    """
+
+    def __init__(self, call_sid, session):
+        self.call_sid = call_sid
+        self.session = session
+        self.state = CallState.GREETING
+        self.lock = Lock()
+        self.last_request_key = None
+        self.last_response = None
+        self.last_request_time = time.monotonic()
+
+    def __repr__(self):
+        return "CallFlow(call_sid={0}, session={1}, state={2})".format(self.call_sid, self.session.id, self.state)
+
 
 DIGITS_TO_UNIT = {
     "4": "h",
@@ -24,11 +92,15 @@ DIGITS_TO_UNIT = {
 }
 
 
+API_SECONDS = metrics.histogram("rpicalarm_twilio_api_seconds", "Twilio API call time by operation.", ("operation",))
+WEBHOOK_REQUESTS = metrics.counter("rpicalarm_twilio_webhook_requests", "Twilio webhook requests by route.", ("route",))
+
+
 def twilio_validation_decorate(func, token):
-    def twilio_validation_decorated(*args, **kwargs):
-        # Create an instance of the RequestValidator class
-        validator = RequestValidator(token)
+    # Create an instance of the RequestValidator class
+    validator = RequestValidator(token)
 
+    def twilio_validation_decorated(*args, **kwargs):
         # Validate the request using its URL, POST data,
         # and X-TWILIO-SIGNATURE header
         request_valid = validator.validate(
@@ -52,15 +124,15 @@ class TwilioServer(object):
         self.alarm = twilio_agent.alarm
         self.web_server = twilio_agent.web_server
         self.twilio_agent = twilio_agent
+        self.calls_lock = Lock()
+        # per call state, keyed by CallSid
+        self.calls = {}
         self.web_server.add_route(
             "/twilio/auth/<session_id>", "auth", twilio_validation_decorate(self.auth_request, self.twilio_agent.auth_token), methods=["POST"])
 
         self.web_server.add_route(
             "/twilio/callback/<session_id>", "callback", twilio_validation_decorate(self.callback_request, self.twilio_agent.auth_token), methods=["POST"])
 
-    def get_gather(self, session_id):
-        return {"action":self.get_auth_action_url(session_id), "timeout":30, "finishOnKey":"#"}
-
     def get_auth_action_url(self, session_id):
         return "{}/twilio/auth/{}".format(self.web_server.auth_base_url, session_id)
 
@@ -68,18 +140,25 @@ class TwilioServer(object):
         return "{}/twilio/callback/{}".format(self.web_server.auth_base_url, session_id)
 
     def callback_request(self, session_id=None):
-        session = self.alarm.current_session
+        WEBHOOK_REQUESTS.labels(route="callback").inc()
+        call_sid = request.form.get("CallSid")
+        with self.calls_lock:
+            call = self.calls.pop(call_sid, None)
+        self.twilio_agent.on_call_completed(session_id, call_sid)
+        session = call.session if call else self.alarm.current_session
         try:
-            if not session:
+            if not session or session is not self.alarm.current_session:
                 LOGGER.debug("Not authenticating anymore for session id is %s", session_id,)
-                return ('', 200)
             elif session.id != session_id:
                 LOGGER.debug("Got invalid session id %s, current session id is %s",
                              session_id, session.id)
             elif session.is_authenticated:
-                self.alarm.set_disarm_time(0)
-            elif not session.is_authenticated:
-                events.on_authentication_failed(self.twilio_agent)
+                if self.twilio_agent.name in session.auth_times:
+                    self.alarm.set_disarm_time(0)
+            elif session.is_cancelled():
+                LOGGER.debug("Call of session %s was cancelled", session_id)
+            else:
+                events.authentication_failed(self.twilio_agent, session, AuthFailureReason.AUTHENTICATOR_FAILURE)
         except Exception as ex:
             LOGGER.exception("Failed procession callback for session %s", session_id)
             raise ex
@@ -87,121 +166,156 @@ class TwilioServer(object):
         return ('', 200)
 
     def auth_request(self, session_id=None):
+        WEBHOOK_REQUESTS.labels(route="auth").inc()
         try:
             return self.do_auth_request(session_id)
         except Exception as ex:
             LOGGER.exception("Failed procession authentication for session %s", session_id)
             raise ex
 
-    def do_auth_request(self, session_id=None):
+    def _expire_calls(self):
+        # the status callback of a call may never come
+        now = time.monotonic()
+        for call_sid, call in list(self.calls.items()):
+            if now - call.last_request_time > CALL_IDLE_TIMEOUT:
+                LOGGER.debug("Forgetting idle call %s", call)
+                del self.calls[call_sid]
+
+    def _get_call(self, call_sid, session_id):
+        with self.calls_lock:
+            self._expire_calls()
+            call = self.calls.get(call_sid)
+            if call is None:
+                session = self.alarm.current_session
+                if session is None or session.id != session_id:
+                    return None
+                call = CallFlow(call_sid, session)
+                self.calls[call_sid] = call
+            call.last_request_time = time.monotonic()
+            return call
 
-        LOGGER.debug("Inside authenticated request %s", str(request.form))
-        session = self.alarm.current_session
-        LOGGER.debug("Session is %s", str(session))
+    def do_auth_request(self, session_id=None):
         digits = request.form.get("Digits")
-        LOGGER.debug("Got digits %s", str(digits))
-        voice_response = VoiceResponse()
-
-        if not session and self.alarm.state != AlarmState.ALARMING:
-            # TODO if disarmed get enable time
-            voice_response.say(
-                "You already have been authenticated. current state is {}".format(self.alarm.state))
-            voice_response.say("Goodbye")
-            voice_response.hangup()
-
-        elif not session:
-            voice_response.say("Alarm is blaring. Goodbye.")
-            voice_response.hangup()
-            return str(voice_response)
-
-        elif session.id != session_id:
+        call = self._get_call(request.form.get("CallSid"), session_id)
+        LOGGER.debug("Got digits %s for call %s", digits, call)
+
+        if call is None:
+            return self._render_no_session(session_id)
+
+        # Twilio retries carry the same idempotency token, answer them without replaying the transition
+        request_key = request.headers.get("I-Twilio-Idempotency-Token")
+        with call.lock:
+            if request_key is not None and request_key == call.last_request_key:
+                LOGGER.debug("Replaying response to retried request of call %s", call.call_sid)
+                return call.last_response
+            response = self._advance(call, digits)
+            call.last_request_key = request_key
+            call.last_response = response
+            return response
+
+    def _render_no_session(self, session_id):
+        if self.alarm.current_session is not None:
             LOGGER.error("No session found for session id %s", session_id)
-            voice_response = GENERIC_ERROR
-
-        elif not session.is_authenticated and not digits:
-            voice_response.say("Hi this is your alarm speaking.")
-            voice_response.gather(**self.get_gather(session.id)).say(
-                "Please enter your password followed by the pound key.")
-
-        elif not session.is_authenticated and digits:
+            return render_twiml(GENERIC_ERROR)
+        if self.alarm.state == AlarmState.ALARMING:
+            return render_twiml(ALARM_BLARING)
+        # TODO if disarmed get enable time
+        return render_twiml(ALREADY_AUTHENTICATED, text=self.alarm.state)
+
+    def _advance(self, call, digits):
+        session = call.session
+        action = self.get_auth_action_url(session.id)
+
+        if call.state == CallState.COMPLETED:
+            return render_twiml(GOODBYE)
+
+        if session is not self.alarm.current_session and call.state != CallState.AWAITING_DISARM_TIME:
+            call.state = CallState.COMPLETED
+            return self._render_no_session(session.id)
+
+        if call.state == CallState.GREETING and not digits:
+            call.state = CallState.AWAITING_PASSWORD
+            return render_twiml(GREETING, action=action)
+
+        if call.state in (CallState.GREETING, CallState.AWAITING_PASSWORD):
+            call.state = CallState.AWAITING_PASSWORD
+            if not digits:
+                return render_twiml(PASSWORD_PROMPT, action=action)
             if session.authenticate(self.twilio_agent, digits):
-                voice_response.say("You have been authenticated")
-                voice_response.gather(**self.get_gather(session.id)).say(
-                    "Enter disarm time, last digit is the unit followed by the pound key. Or, hang-up now to disable the alarm.")
-            else:
-                if self.alarm.state != AlarmState.ALARMING:
-                    voice_response.say("Authentication failed")
-                    voice_response.say(
-                        "You have {} tries remaining".format(session.remaining_tries))
-                    voice_response.gather(**self.get_gather(session.id)).say(
-                        "Enter your password followed by the pound key")
-                else:
-                    voice_response.say("Authentication failed")
-                    voice_response.say("Goodbye")
-                    voice_response.hangup()
-
-        elif session.is_authenticated and (not digits or len(digits) == 1):
-            voice_response.gather(**self.get_gather(session.id)).say(
-                "Enter disarm time, last digit is the unit followed by the pound key. Or, hang-up now to disable the alarm.")
-
-        elif session.is_authenticated and digits:
-            try:
-                unit = DIGITS_TO_UNIT[digits[-1]]
-                if not unit:
-                    voice_response.gather(**self.get_gather(session.id)).say(
-                        "Enter disarm time, last digit is the unit followed by the pound key. Or, hang-up now to disable the alarm.")
-                else:
-                    self.alarm.set_disarm_time(digits[:-1]+unit)
-                    voice_response.say("Disarm time set for "+self.alarm.get_readable_disarm_time())
-                    voice_response.hangup()
-
-            except Exception:
-                LOGGER.exception("Failed setting the disarm time")
-                voice_response.gather(**self.get_gather(session.id)).say(
-                    "Enter disarm time, last digit is the unit followed by the pound key. Or, hang-up now to disable the alarm.")
-        else:
-            voice_response = GENERIC_ERROR
-
-        return str(voice_response)
+                call.state = CallState.AWAITING_DISARM_TIME
+                return render_twiml(AUTHENTICATED, action=action)
+            if self.alarm.state == AlarmState.ALARMING:
+                call.state = CallState.COMPLETED
+                return render_twiml(AUTH_FAILED_HANGUP)
+            return render_twiml(AUTH_FAILED_RETRY, action=action, tries=session.remaining_tries)
+
+        # AWAITING_DISARM_TIME
+        unit = DIGITS_TO_UNIT.get(digits[-1]) if digits and len(digits) > 1 else None
+        if not unit:
+            return render_twiml(DISARM_PROMPT, action=action)
+        call.state = CallState.COMPLETED
+        try:
+            self.alarm.set_disarm_time(digits[:-1]+unit)
+        except Exception:
+            # e.g. the disarm time got set through another channel meanwhile, prompting again would loop
+            LOGGER.exception("Failed setting the disarm time")
+            return render_twiml(DISARM_TIME_FAILED, text=self.alarm.state)
+        return render_twiml(DISARM_TIME_SET, text=self.alarm.get_readable_disarm_time())
 
 
 class Twilio(object):
 
-    def __init__(self, alarm, web_server, auth_delay="0s", account_sid=None, auth_token=None, landline_phone_number=None, mobile_phone_number=None):
+    def __init__(self, alarm, web_server, auth_delay="0s", auth_deadline="0s", account_sid=None, auth_token=None,
+                 landline_phone_number=None, mobile_phone_number=None, http_client=None):
         self.auth_delay = parse_duration(auth_delay).total_seconds()
+        self.auth_deadline = parse_duration(auth_deadline).total_seconds()
         self.landline_phone_number = landline_phone_number
         self.mobile_phone_number = mobile_phone_number
         self.web_server = web_server
         self.alarm = alarm
-        self.client = Client(account_sid, auth_token)
+        self.client = Client(account_sid, auth_token, http_client=http_client)
         self.auth_token = auth_token
+        self.calls_lock = Lock()
+        self.session_calls = {}
 
         self.twilio_server = TwilioServer(self)
 
-        self._register_events_handlers()
-
         events.authenticator_started(self)
 
-    def _register_events_handlers(self):
-        events.alarm_authenticating += self.on_authentication_required
+    @property
+    def name(self):
+        return "twilio"
 
-    def on_authentication_required(self, _, session):
-        timer = Timer(self.auth_delay, self.trigger_authentication_call, args=[session.id])
-        timer.start()
-
-    def trigger_authentication_call(self, session_id):
-        # Might check the session_id
-        if not self.alarm.current_session:
-            LOGGER.debug("Already authenticated, not making the call")
+    def start_authentication(self, session):
+        with self.calls_lock:
+            if session.is_authenticated or session.is_cancelled():
+                LOGGER.debug("Already authenticated, not making the call")
+                return
+            try:
+                with session.trace.span("twilio.call_create"), API_SECONDS.labels(operation="create").time():
+                    call = self.client.calls.create(
+                        to=self.mobile_phone_number,
+                        from_=self.landline_phone_number,
+                        url=self.twilio_server.get_auth_action_url(session.id),
+                        status_callback=self.twilio_server.get_status_callback_url(session.id),
+                        status_callback_event=["completed"]
+                    )
+                # a single session authenticates at a time, the calls of the previous ones are over
+                self.session_calls = {session.id: call.sid}
+            except Exception:
+                LOGGER.exception("Failed making call for authentication")
+                events.authentication_failed(self, session, AuthFailureReason.AUTHENTICATOR_FAILURE)
+
+    def on_call_completed(self, session_id, call_sid):
+        with self.calls_lock:
+            if self.session_calls.get(session_id) == call_sid:
+                del self.session_calls[session_id]
+
+    def cancel_authentication(self, session):
+        with self.calls_lock:
+            call_sid = self.session_calls.pop(session.id, None)
+        if call_sid is None:
             return
-        try:
-            self.client.calls.create(
-                to=self.mobile_phone_number,
-                from_=self.landline_phone_number,
-                url=self.twilio_server.get_auth_action_url(session_id),
-                status_callback=self.twilio_server.get_status_callback_url(session_id),
-                status_callback_event=["completed"]
-            )
-        except Exception:
-            LOGGER.exception("Failed making call for authentication")
-            events.authentication_failed(self, session_id, AuthFailureReason.AUTHENTICATOR_FAILURE)
+        LOGGER.debug("Hanging up call %s of session %s", call_sid, session.id)
+        with API_SECONDS.labels(operation="hang_up").time():
+            self.client.calls(call_sid).update(status="completed")
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import time
+from collections import deque
 from enum import Enum
 from threading import RLock, Timer
 import uuid
@@ -9,11 +10,17 @@ from pathlib import Path
 
 
 from .util import getLogger, human_time
+from .tracing import tracer
+from .metrics import metrics
 from . import events, parse_duration
 
 
 LOGGER = getLogger()
 
+STATE_CHANGES = metrics.counter("rpicalarm_alarm_state_changes", "Alarm state changes by new state.", ("state",))
+AUTHENTICATIONS = metrics.counter(
+    "rpicalarm_authentications", "Authentication outcomes by authenticator.", ("authenticator", "outcome"))
+
 
 def current_milli_time():
     return int(round(time.time() * 1000))
@@ -58,10 +65,168 @@ class AuthFailureReason(Enum):
     MAX_AUTH_TRIES = 3
 
 
+def get_authenticator_name(authenticator):
+    return getattr(authenticator, "name", type(authenticator).__name__.lower())
+
+
+class AuthOrchestrator(object):
+    """
+    Launches the authenticators of a session in escalation order, each one after its
+    auth_delay, and fails the ones that do not succeed before their auth_deadline.
+    A failure escalates to the next authenticator not launched yet right away and the
+    first success cancels all the others. Launches are decided under the lock but the
+    authenticators are called outside of it: starting one may block, e.g. on a Twilio
+    call request, and its failure reaches the alarm, which holds its own lock while
+    cancelling the session.
+    """
+
+    def __init__(self, session, authenticators):
+        self.session = session
+        self.authenticators = list(authenticators)
+        self.lock = RLock()
+        self.timers = {}
+        # ever launched, and launched but not cancelled
+        self.started = []
+        self.launched = []
+        # being started outside the lock, cancelled once started if the session was meanwhile
+        self.starting = []
+        self.cancel_pending = []
+        self.cancelled = False
+
+    def start(self):
+        with self.lock:
+            for authenticator in self.authenticators:
+                delay = getattr(authenticator, "auth_delay", 0)
+                self._schedule(authenticator, "launch", delay, self._launch_from_timer, authenticator)
+
+    def _schedule(self, authenticator, kind, delay, func, *args):
+        timer = Timer(delay, func, args=args)
+        timer.daemon = True
+        self.timers[(id(authenticator), kind)] = timer
+        timer.start()
+
+    def _cancel_timer(self, authenticator, kind):
+        timer = self.timers.pop((id(authenticator), kind), None)
+        if timer is not None:
+            timer.cancel()
+
+    def add_authenticator(self, authenticator):
+        """
+        Adds an authenticator started while the session is running, launched after its auth_delay
+        """
+        with self.lock:
+            if self.cancelled or authenticator in self.authenticators:
+                return
+            self.authenticators.append(authenticator)
+            delay = getattr(authenticator, "auth_delay", 0)
+            self._schedule(authenticator, "launch", delay, self._launch_from_timer, authenticator)
+
+    def _launch_from_timer(self, authenticator):
+        with self.lock:
+            if not self._book_launch(authenticator):
+                return
+        self._launch(authenticator)
+
+    def _book_launch(self, authenticator):
+        """
+        Records the launch of the authenticator, returns False if it was already launched
+        or the session is cancelled. Called with the lock held.
+        """
+        if self.cancelled or authenticator in self.started:
+            return False
+        self._cancel_timer(authenticator, "launch")
+        name = get_authenticator_name(authenticator)
+        self.session.trace.mark("auth.launch." + name)
+        self.session.launch_times[name] = time.monotonic() - self.session.start_time
+        self.started.append(authenticator)
+        self.launched.append(authenticator)
+        self.starting.append(authenticator)
+        deadline = getattr(authenticator, "auth_deadline", None)
+        if deadline:
+            self._schedule(authenticator, "deadline", deadline, self._on_deadline_expired, authenticator)
+        return True
+
+    def _launch(self, authenticator):
+        name = get_authenticator_name(authenticator)
+        LOGGER.debug("Launching authenticator %s", name)
+        try:
+            authenticator.start_authentication(self.session)
+        except Exception:
+            LOGGER.exception("Authenticator %s failed to start", name)
+            with self.lock:
+                self.starting.remove(authenticator)
+            events.authentication_failed(authenticator, self.session, AuthFailureReason.AUTHENTICATOR_FAILURE)
+            return
+        with self.lock:
+            self.starting.remove(authenticator)
+            cancel = authenticator in self.cancel_pending
+        if cancel:
+            self._call_cancel(authenticator)
+
+    def _on_deadline_expired(self, authenticator):
+        with self.lock:
+            if self.cancelled:
+                return
+            LOGGER.info("Authenticator %s deadline expired", get_authenticator_name(authenticator))
+            cancel = self._cancel_authenticator(authenticator)
+        if cancel:
+            self._call_cancel(authenticator)
+        events.authentication_failed(authenticator, self.session, AuthFailureReason.AUTHENTICATOR_FAILURE)
+
+    def on_authenticator_failed(self, authenticator):
+        with self.lock:
+            if self.cancelled or authenticator not in self.authenticators:
+                return
+            self._cancel_timer(authenticator, "deadline")
+            next_authenticator = next((a for a in self.authenticators if a not in self.started), None)
+            if next_authenticator is None or not self._book_launch(next_authenticator):
+                return
+            LOGGER.debug("Escalating to authenticator %s", get_authenticator_name(next_authenticator))
+        self._launch(next_authenticator)
+
+    def _cancel_authenticator(self, authenticator):
+        """
+        Cancels the timers of the authenticator, returns whether it was launched and is to
+        be cancelled. Called with the lock held.
+        """
+        self._cancel_timer(authenticator, "launch")
+        self._cancel_timer(authenticator, "deadline")
+        if authenticator not in self.launched:
+            return False
+        self.launched.remove(authenticator)
+        if authenticator in self.starting:
+            self.cancel_pending.append(authenticator)
+            return False
+        return True
+
+    def _call_cancel(self, authenticator):
+        if not hasattr(authenticator, "cancel_authentication"):
+            return
+        try:
+            authenticator.cancel_authentication(self.session)
+        except Exception:
+            LOGGER.exception("Failed cancelling authenticator %s", get_authenticator_name(authenticator))
+
+    def cancel(self, except_for=None):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            to_cancel = [a for a in self.authenticators
+                         if a is not except_for and self._cancel_authenticator(a)]
+            for timer in self.timers.values():
+                timer.cancel()
+            self.timers.clear()
+        for authenticator in to_cancel:
+            self._call_cancel(authenticator)
+
+
 class AuthSession(object):
 
-    def __init__(self, password, max_tries):
-        self.id = str(uuid.uuid4())
+    def __init__(self, password, max_tries, trace=None):
+        # the session is identified by its intrusion trace
+        self.trace = trace or tracer.start_trace()
+        self.id = self.trace.id
         self.lock = RLock()
         self.tries = 0
         self.password = password
@@ -70,6 +235,21 @@ class AuthSession(object):
         self.disarm_time = 0
         self.is_authenticated = False
         self.last_error = None
+        self.start_time = time.monotonic()
+        self.launch_times = {}
+        self.auth_times = {}
+        self.orchestrator = None
+
+    def start_authenticators(self, authenticators):
+        self.orchestrator = AuthOrchestrator(self, authenticators)
+        self.orchestrator.start()
+
+    def cancel_authenticators(self):
+        if self.orchestrator is not None:
+            self.orchestrator.cancel()
+
+    def is_cancelled(self):
+        return self.orchestrator is not None and self.orchestrator.cancelled
 
     def authenticate(self, origin, pwd):
         with self.lock:
@@ -80,19 +260,39 @@ class AuthSession(object):
                 return False
             elif pwd == self.password:
                 self.is_authenticated = True
+                name = get_authenticator_name(origin)
+                self.auth_times[name] = time.monotonic() - self.start_time
+                LOGGER.info("Authenticated through %s in %.1fs", name, self.auth_times[name])
+                self.trace.mark("auth.succeeded." + name)
+                AUTHENTICATIONS.labels(authenticator=name, outcome="succeeded").inc()
+                if self.orchestrator is not None:
+                    self.orchestrator.cancel(except_for=origin)
                 events.authentication_succeeded(origin, self)
                 events.authentication_ended(origin, self)
                 return True
             else:
                 return False
 
+    def to_dict(self):
+        with self.lock:
+            return {
+                "id": self.id,
+                "age_s": round(time.monotonic() - self.start_time, 3),
+                "tries": self.tries,
+                "remaining_tries": max(0, self.max_tries - self.tries),
+                "is_authenticated": self.is_authenticated,
+                "launched": list(self.launch_times),
+                "auth_times": dict(self.auth_times),
+            }
+
     def __repr__(self):
-        return str(self.__dict__)
+        return str({k: v for k, v in self.__dict__.items() if k not in ("password", "orchestrator")})
 
 
 class Alarm(object):
 
-    def __init__(self, data_file_path, password=None, max_auth_time="30s", default_disarm_time="1h"):
+    def __init__(self, data_file_path, password=None, max_auth_time="30s", default_disarm_time="1h",
+                 auth_order=""):
         self.password = password
         self.max_auth_time = parse_duration(max_auth_time).total_seconds()
         self.default_disarm_time = parse_duration(default_disarm_time).total_seconds()
@@ -106,6 +306,17 @@ class Alarm(object):
         self.current_session = None
         self.data_file_path = Path(data_file_path)
         self.disarm_timeout_thread = None
+        self.auth_order = [x.strip() for x in auth_order.split(",") if x.strip()]
+        # time to authenticate per channel of the latest sessions, to tune auth delays
+        self.auth_times = {}
+        # in a cluster, only the leader authenticates. Followers mirror its state and hand
+        # it their intrusions through intrusion_forwarder, which returns whether it took them
+        self.is_leader = True
+        self.intrusion_forwarder = None
+        # whether the state is the leader one rather than the outcome of a local session
+        self.followed = False
+        metrics.gauge("rpicalarm_alarm_state", "Current alarm state (1).", ("state",),
+                      func=lambda: {} if self.state is None else {self.state.name.lower(): 1})
 
         if not self.data_file_path.parents[0].exists() or not os.access(str(self.data_file_path.parents[0]), os.W_OK):
             raise Exception("Exception {} can not write".format(str(self.data_file_path)))
@@ -113,14 +324,18 @@ class Alarm(object):
     def _register_events_handlers(self):
         events.sensor_started += self.sensors.append
         events.sensor_stopped += lambda x: self.sensors.remove(x) if x in self.sensors else None
-        events.authenticator_started += self.authenticators.append
+        events.authenticator_started += self.on_authenticator_started
         events.authenticator_stopped += lambda x: self.authenticators.remove(
             x) if x in self.authenticators else None
         events.intrusion_detected += self.on_intrusion_detected
         events.authentication_failed += self.on_authentication_failed
         events.authentication_succeeded += self.on_authentication_successful
 
-    def update_state(self, state, persist=True):
+    def update_state(self, state, persist=True, trace=None, follow=False):
+        """
+        Changes the state, follow applies the state of the cluster leader: any transition
+        is allowed and its authenticating session has neither authenticators nor timeout
+        """
         with self.lock:
 
             new_state = next((x for x in list(AlarmState) if x.name == str(state)), None)
@@ -131,38 +346,82 @@ class Alarm(object):
                 LOGGER.debug("state is already %s", new_state)
                 return False
 
-            if self.state and not new_state.name in self.state.next_states:
+            if not follow and self.state and not new_state.name in self.state.next_states:
                 raise Exception("Forbidden transition from {0} to {1}".format(
                     self.state, new_state))
 
             # Erase current authentication session
             if self.state == AlarmState.AUTHENTICATING:
+                if self.current_session is not None:
+                    self.current_session.trace.mark("alarm." + new_state.name.lower())
+                    self.current_session.cancel_authenticators()
                 self.current_session = None
 
             if new_state == AlarmState.AUTHENTICATING:
                 self.auth_failures_count = 0
             LOGGER.info("Changing alarm state from %s to %s", self.state, new_state)
+            STATE_CHANGES.labels(state=new_state.name.lower()).inc()
 
             self.state = new_state
+            self.followed = follow
             if persist:
                 self._persist_alarm_state()
 
         if self.state == AlarmState.AUTHENTICATING:
-            session = AuthSession(self.password, 3)
+            session = AuthSession(self.password, 3, trace=trace)
+            session.trace.mark("alarm.authenticating")
             self.current_session = session
-
-            def on_auth_timer_expired():
-                if self.state == AlarmState.AUTHENTICATING and not session.is_authenticated:
-                    self.on_authentication_failed(self, session, AuthFailureReason.TIMEOUT)
-
-            timer = Timer(self.max_auth_time, on_auth_timer_expired)
-            timer.start()
             events.alarm_authenticating(self, session)
+            if not follow:
+                self._authenticate(session)
         else:
             getattr(events, "alarm_"+self.state.name.lower())(self)
 
         return True
 
+    def _authenticate(self, session):
+        def on_auth_timer_expired():
+            if self.state == AlarmState.AUTHENTICATING and not session.is_authenticated:
+                self.on_authentication_failed(self, session, AuthFailureReason.TIMEOUT)
+
+        timer = Timer(self.max_auth_time, on_auth_timer_expired)
+        timer.start()
+        session.start_authenticators(self._sorted_authenticators())
+
+    def follow_state(self, state):
+        """
+        Applies the state of the cluster leader. A session of this node keeps running
+        unless the leader was disarmed or disabled meanwhile.
+        """
+        with self.lock:
+            if not self.followed and self.state in (AlarmState.AUTHENTICATING, AlarmState.ALARMING) and \
+                    state not in (AlarmState.DISARMED, AlarmState.DISABLED):
+                LOGGER.debug("Not following leader state %s while %s", state, self.state)
+                return False
+            return self.update_state(state, follow=True)
+
+    def set_leader(self, is_leader):
+        """
+        Called when the cluster elects a leader, a new leader authenticates the session
+        it was following
+        """
+        with self.lock:
+            self.is_leader = is_leader
+            session = None
+            if is_leader and self.followed:
+                self.followed = False
+                if self.state == AlarmState.AUTHENTICATING:
+                    session = self.current_session
+        if session is not None:
+            LOGGER.info("Taking over authentication session %s", session.id)
+            self._authenticate(session)
+
+    def _sorted_authenticators(self):
+        def escalation_rank(authenticator):
+            name = get_authenticator_name(authenticator)
+            return self.auth_order.index(name) if name in self.auth_order else len(self.auth_order)
+        return sorted(self.authenticators, key=escalation_rank)
+
     def on_disarm_time_configuration_expired(self):
         LOGGER.debug("Disarm time configuration expired, disabling the alarm")    
         self.update_state(AlarmState.DISABLED)
@@ -203,21 +462,64 @@ class Alarm(object):
         else:
             return human_time(seconds=self.disarm_time)
 
-    def on_intrusion_detected(self, *_):
+    def on_authenticator_started(self, authenticator):
+        with self.lock:
+            self.authenticators.append(authenticator)
+            session = self.current_session
+        # started in the background after an intrusion was detected
+        if session is not None and session.orchestrator is not None:
+            session.orchestrator.add_authenticator(authenticator)
+
+    def get_state_handlers(self):
+        """
+        Returns the handlers of the state events by state
+        """
+        return {state: list(getattr(events, "alarm_" + state.name.lower()).targets) for state in AlarmState}
+
+    def replay_state(self, known_handlers):
+        """
+        Notifies the current state to the handlers registered since known_handlers were
+        returned by get_state_handlers, so that agents created after the alarm started
+        do not miss its state
+        """
+        with self.lock:
+            state = self.state
+            session = self.current_session
+        if state is None:
+            return
+        args = (self, session) if state == AlarmState.AUTHENTICATING else (self,)
+        for handler in getattr(events, "alarm_" + state.name.lower()).targets:
+            if handler not in known_handlers[state]:
+                try:
+                    handler(*args)
+                except Exception:
+                    LOGGER.exception("Failed notifying state %s to %s", state, handler)
+
+    def on_intrusion_detected(self, origin=None, score=None, details=None, trace=None):
+        # a follower handles the intrusion itself only if the leader could not
+        forwarder = self.intrusion_forwarder
+        if not self.is_leader and forwarder is not None and forwarder(origin, score, details, trace):
+            return
+        self.handle_intrusion(trace)
+
+    def handle_intrusion(self, trace=None):
         try:
-            if not self.update_state(AlarmState.AUTHENTICATING):
+            if not self.update_state(AlarmState.AUTHENTICATING, trace=trace):
                 return
         except Exception as ex:
             LOGGER.error("Could not update state to %s, got exception %s",
                          AlarmState.AUTHENTICATING, ex)
             return
 
-    def on_authentication_successful(self, *_):
+    def on_authentication_successful(self, origin, session):
+        for name, auth_time in session.auth_times.items():
+            self.auth_times.setdefault(name, deque(maxlen=20)).append(auth_time)
         self.disarm_timeout_thread = Timer(60, self.on_disarm_time_configuration_expired)
         self.disarm_timeout_thread.start()
 
     def on_authentication_failed(self, origin, session, reason):
         self.auth_failures_count += 1
+        AUTHENTICATIONS.labels(authenticator=get_authenticator_name(origin), outcome=reason.name.lower()).inc()
         if reason == AuthFailureReason.MAX_AUTH_TRIES or reason == AuthFailureReason.TIMEOUT:
             LOGGER.debug("authentication failure %s", reason)
             events.authentication_ended(origin, session)
@@ -229,6 +531,8 @@ class Alarm(object):
                 self.update_state(AlarmState.ALARMING)
             else:
                 LOGGER.info("Waiting for other authenticators")
+                if session is not None and session.orchestrator is not None:
+                    session.orchestrator.on_authenticator_failed(origin)
 
     def start(self):
         if self.data_file_path.exists():
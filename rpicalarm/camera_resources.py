@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+import io
+from collections import deque
+from enum import Enum
+from threading import Condition, Thread
+from time import monotonic
+
+from .metrics import metrics
+from .util import getLogger
+
+LOGGER = getLogger(__name__)
+
+# video port splitter ports of the camera
+SPLITTER_PORTS = (0, 1, 2, 3)
+
+PORT_WAIT_SECONDS = metrics.histogram("rpicalarm_camera_port_wait_seconds", "Time waited for a camera port by type.",
+                                      ("port",))
+STREAM_FRAMES = metrics.counter("rpicalarm_camera_stream_frames",
+                                "Frames encoded by the shared streams by camera and size.", ("camera", "size"))
+
+
+class CameraError(Exception):
+    pass
+
+
+class CameraBusyError(CameraError):
+    pass
+
+
+class CameraPort(Enum):
+    STILL = 1
+    VIDEO = 2
+
+
+def format_size(size):
+    return "{0}x{1}".format(*size)
+
+
+class PortLease(object):
+    """
+    Exclusive use of the still port or of a splitter port of the video port
+    """
+
+    def __init__(self, resources, owner, port, splitter_port=None):
+        self.resources = resources
+        self.owner = owner
+        self.port = port
+        self.splitter_port = splitter_port
+
+    def release(self):
+        self.resources.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.release()
+
+    def __repr__(self):
+        if self.port == CameraPort.STILL:
+            return "{0} on still port".format(self.owner)
+        return "{0} on port {1}".format(self.owner, self.splitter_port)
+
+
+class StreamSubscription(object):
+    """
+    Reader of a shared stream, next_frame returns the frames it reads at its own rate
+    """
+
+    def __init__(self, stream, owner):
+        self.stream = stream
+        self.owner = owner
+        # frames encoded before the subscription are not handed out
+        self.last_seq = stream.seq
+        self.min_frame_time = None
+        self.closed = False
+
+    @property
+    def size(self):
+        return self.stream.size
+
+    def _accepts(self, stream):
+        return stream.seq > self.last_seq and stream.frame_time >= self.min_frame_time
+
+    def next_frame(self, max_age=0.0, timeout=None):
+        """
+        Returns the next encoded frame, the latest one if encoded less than max_age seconds ago
+        and not already returned, waiting up to timeout seconds for it
+        """
+        condition = self.stream.resources.condition
+        timeout = self.stream.resources.timeout if timeout is None else timeout
+        with condition:
+            self.min_frame_time = monotonic() - max_age
+            # wakes the stream up if it is waiting for a reader
+            condition.notify_all()
+            try:
+                condition.wait_for(lambda: self.closed or self.stream.stopped or self._accepts(self.stream), timeout)
+                accepted = not self.closed and self._accepts(self.stream)
+            finally:
+                self.min_frame_time = None
+            if accepted:
+                self.last_seq = self.stream.seq
+                return self.stream.frame
+            if self.closed or self.stream.stopped:
+                raise CameraError("Stream {0} stopped".format(format_size(self.size)))
+            raise CameraBusyError("No frame of stream {0} within {1}s".format(format_size(self.size), timeout))
+
+    def close(self):
+        self.stream.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class SharedStream(object):
+    """
+    Frames encoded at size on a splitter port and shared by its subscribers. A frame is
+    encoded only when a subscriber waits for one and the latest is too old for it, so
+    the stream runs at the rate of its most demanding subscriber. It stops and releases
+    its port when its last subscriber leaves.
+    """
+
+    def __init__(self, resources, lease, size, image_format="jpeg"):
+        self.resources = resources
+        self.lease = lease
+        self.size = tuple(size)
+        self.image_format = image_format
+        self.subscriptions = []
+        self.frame = None
+        self.frame_time = None
+        self.seq = 0
+        self.stopped = False
+        self.thread = Thread(name="camera_stream_{0}{1}".format(
+            resources.name + "_" if resources.name else "", lease.splitter_port), target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def accepts(self, size, image_format, exact=False):
+        """
+        Returns whether readers of frames of size can read this stream, the frames being
+        at least as large in both dimensions or, if exact, of that size
+        """
+        if self.stopped or image_format != self.image_format:
+            return False
+        if exact:
+            return self.size == tuple(size)
+        return self.size[0] >= size[0] and self.size[1] >= size[1]
+
+    def subscribe(self, owner):
+        subscription = StreamSubscription(self, owner)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.resources.condition:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+            subscription.closed = True
+            self.resources.condition.notify_all()
+
+    def _wait_for_demand(self):
+        """
+        Waits for a subscriber needing a new frame, returns False if there are no more subscribers
+        """
+        with self.resources.condition:
+            while True:
+                if not self.subscriptions:
+                    # no more subscription may join the stream
+                    self.stopped = True
+                    return False
+                if any(s.min_frame_time is not None and not s._accepts(self) for s in self.subscriptions):
+                    return True
+                self.resources.condition.wait()
+
+    def _run(self):
+        LOGGER.debug("Starting stream %s on port %d", format_size(self.size), self.lease.splitter_port)
+        output = io.BytesIO()
+        frames = None
+        try:
+            if not self._wait_for_demand():
+                return
+            frames = self.resources.camera.capture_continuous(
+                output, format=self.image_format, use_video_port=True, resize=self.size,
+                splitter_port=self.lease.splitter_port)
+            for _ in frames:
+                frame = output.getvalue()
+                STREAM_FRAMES.labels(camera=self.resources.name, size=format_size(self.size)).inc()
+                with self.resources.condition:
+                    self.frame = frame
+                    self.frame_time = monotonic()
+                    self.seq += 1
+                    self.resources.condition.notify_all()
+                output.seek(0)
+                output.truncate()
+                if not self._wait_for_demand():
+                    break
+        except Exception:
+            LOGGER.exception("Stream %s failed", format_size(self.size))
+        finally:
+            if frames is not None:
+                # stops the encoder
+                frames.close()
+            with self.resources.condition:
+                self.stopped = True
+                self.resources.streams.remove(self)
+                self.resources.condition.notify_all()
+            self.lease.release()
+            LOGGER.debug("Stream %s stopped", format_size(self.size))
+
+
+class CameraResources(object):
+    """
+    Schedules the camera ports: the still port and the splitter ports of the video port.
+    Ports are leased exclusively, requests waiting in turn up to timeout seconds for a port
+    to be released. Readers of frames subscribe to shared streams instead, a stream being
+    shared by the readers of frames of the same format no larger than its own.
+    """
+
+    def __init__(self, camera, timeout=10.0, name=""):
+        self.camera = camera
+        self.name = name
+        self.timeout = timeout
+        self.condition = Condition()
+        self.leases = {}
+        self.waiters = {CameraPort.STILL: deque(), CameraPort.VIDEO: deque()}
+        self.streams = []
+
+    def _find_free_port(self, port):
+        if port == CameraPort.STILL:
+            return None if CameraPort.STILL in self.leases else CameraPort.STILL
+        return next((p for p in SPLITTER_PORTS if p not in self.leases), None)
+
+    def acquire(self, owner, port=CameraPort.VIDEO, timeout=None):
+        """
+        Returns a lease of the still port or of a splitter port, raises CameraBusyError if
+        none got free within timeout seconds
+        """
+        timeout = self.timeout if timeout is None else timeout
+        start_time = monotonic()
+        ticket = object()
+        with self.condition:
+            waiters = self.waiters[port]
+            waiters.append(ticket)
+            try:
+                while True:
+                    # first come first served
+                    free_port = self._find_free_port(port) if waiters[0] is ticket else None
+                    if free_port is not None:
+                        break
+                    remaining = start_time + timeout - monotonic()
+                    if remaining <= 0:
+                        raise CameraBusyError("{0} waited {1}s for a {2} port, camera is used by {3}".format(
+                            owner, timeout, port.name.lower(), self.describe()))
+                    self.condition.wait(remaining)
+            finally:
+                waiters.remove(ticket)
+                self.condition.notify_all()
+            lease = PortLease(self, owner, port, None if port == CameraPort.STILL else free_port)
+            self.leases[free_port] = lease
+        PORT_WAIT_SECONDS.labels(port=port.name.lower()).observe(monotonic() - start_time)
+        return lease
+
+    def release(self, lease):
+        with self.condition:
+            key = CameraPort.STILL if lease.port == CameraPort.STILL else lease.splitter_port
+            if self.leases.get(key) is lease:
+                del self.leases[key]
+            self.condition.notify_all()
+
+    def _find_stream(self, size, image_format, exact=False):
+        streams = [s for s in self.streams if s.accepts(size, image_format, exact)]
+        # the smallest frames are the fastest to decode
+        return min(streams, key=lambda s: s.size[0] * s.size[1]) if streams else None
+
+    def subscribe(self, owner, size=None, image_format="jpeg", timeout=None, exact=False):
+        """
+        Returns a subscription to a stream of frames at least as large as size, the camera
+        resolution if not set, starting a stream if none can be shared. Readers serving the
+        frames as is, rather than resizing them, set exact to get frames of size.
+        """
+        size = tuple(size or self.camera.resolution)
+        with self.condition:
+            stream = self._find_stream(size, image_format, exact)
+            if stream is not None:
+                return stream.subscribe(owner)
+        lease = self.acquire("stream " + format_size(size), CameraPort.VIDEO, timeout)
+        with self.condition:
+            # started by another reader while waiting for the port
+            stream = self._find_stream(size, image_format, exact)
+            if stream is None:
+                stream = SharedStream(self, lease, size, image_format)
+                self.streams.append(stream)
+                subscription = stream.subscribe(owner)
+                stream.start()
+                return subscription
+            subscription = stream.subscribe(owner)
+        lease.release()
+        return subscription
+
+    def get_users(self):
+        """
+        Returns the owners of the ports and the stream subscribers
+        """
+        with self.condition:
+            users = [l.owner for l in self.leases.values() if not any(s.lease is l for s in self.streams)]
+            users.extend(sub.owner for s in self.streams for sub in s.subscriptions)
+        return users
+
+    def describe(self):
+        with self.condition:
+            descriptions = []
+            for lease in self.leases.values():
+                stream = next((s for s in self.streams if s.lease is lease), None)
+                if stream is None:
+                    descriptions.append(repr(lease))
+                else:
+                    descriptions.append("{0} on port {1} ({2})".format(
+                        "+".join(sub.owner for sub in stream.subscriptions) or "nobody",
+                        lease.splitter_port, format_size(stream.size)))
+        return ", ".join(sorted(descriptions)) or "nobody"
+
+    def get_ports_usage(self):
+        with self.condition:
+            usage = {"still": int(CameraPort.STILL in self.leases)}
+            usage.update({str(p): int(p in self.leases) for p in SPLITTER_PORTS})
+        return usage
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import queue
+from threading import Thread
+
+import cv2
+
+from .metrics import metrics
+from .util import getLogger
+
+LOGGER = getLogger(__name__)
+
+FRAMES_CLASSIFIED = metrics.counter("rpicalarm_classifier_frames", "Motion frames by classification result.",
+                                    ("result",))
+INFERENCE_SECONDS = metrics.histogram("rpicalarm_classifier_inference_seconds",
+                                      "Classification time of the motion boxes of a frame.")
+
+# classes of the MobileNet-SSD Caffe model trained on PASCAL VOC
+VOC_CLASSES = ("background", "aeroplane", "bicycle", "bird", "boat", "bottle", "bus", "car", "cat", "chair",
+               "cow", "diningtable", "dog", "horse", "motorbike", "person", "pottedplant", "sheep", "sofa",
+               "train", "tvmonitor")
+
+STOP = None
+
+
+class Detection(object):
+
+    def __init__(self, label, confidence, box):
+        self.label = label
+        self.confidence = confidence
+        self.box = box
+
+    def to_dict(self):
+        return {"label": self.label, "confidence": round(self.confidence, 3), "box": self.box}
+
+    def __repr__(self):
+        return str(self.__dict__)
+
+
+class ObjectClassifier(object):
+    """
+    Runs an OpenCV DNN SSD detector, e.g. MobileNet-SSD, on the motion boxes of a frame.
+    Each box is enlarged by margin, cropped and the crops are detected as a single batch,
+    the rest of the frame is never analyzed. Detections of the labels of interest are
+    returned in frame coordinates.
+    """
+
+    def __init__(self, model_path, config_path=None, labels=("person",), classes=VOC_CLASSES,
+                 min_confidence=0.5, input_size=(300, 300), scale=0.007843, mean=127.5, margin=0.2,
+                 max_boxes=4, net=None):
+        self.labels = frozenset(labels)
+        self.classes = tuple(classes)
+        self.min_confidence = min_confidence
+        self.input_size = input_size
+        self.scale = scale
+        self.mean = mean
+        self.margin = margin
+        self.max_boxes = max_boxes
+        if net is None:
+            net = cv2.dnn.readNet(model_path, config_path or "")
+            # the Pi has no usable accelerator, the default backend is the fastest on its CPU
+            net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self.net = net
+
+    def _crop_box(self, box, frame_width, frame_height):
+        x, y, width, height = box
+        # objects are often larger than their moving part, e.g. a moving arm
+        margin = int(max(width, height) * self.margin)
+        x1, y1 = max(0, x - margin), max(0, y - margin)
+        x2, y2 = min(frame_width, x + width + margin), min(frame_height, y + height + margin)
+        return x1, y1, x2, y2
+
+    def classify(self, frame, boxes):
+        """
+        Returns the detections of the labels of interest in the boxes of the frame, most confident first
+        """
+        frame_height, frame_width = frame.shape[:2]
+        # the largest moving areas are the most likely intruders
+        boxes = sorted(boxes, key=lambda b: b[2] * b[3], reverse=True)[:self.max_boxes]
+        crops = [self._crop_box(box, frame_width, frame_height) for box in boxes]
+        crops = [c for c in crops if c[2] > c[0] and c[3] > c[1]]
+        if not crops:
+            return []
+        blob = cv2.dnn.blobFromImages(
+            [frame[y1:y2, x1:x2] for x1, y1, x2, y2 in crops], self.scale, self.input_size, self.mean)
+        self.net.setInput(blob)
+        # SSD output rows are (image index, class id, confidence, x1, y1, x2, y2), coordinates in [0, 1]
+        output = self.net.forward().reshape(-1, 7)
+        detections = []
+        for image_index, class_id, confidence, left, top, right, bottom in output:
+            if confidence < self.min_confidence or not 0 <= int(class_id) < len(self.classes):
+                continue
+            label = self.classes[int(class_id)]
+            if label not in self.labels:
+                continue
+            x1, y1, x2, y2 = crops[int(image_index)]
+            box = (int(x1 + left * (x2 - x1)), int(y1 + top * (y2 - y1)),
+                   int((right - left) * (x2 - x1)), int((bottom - top) * (y2 - y1)))
+            detections.append(Detection(label, float(confidence), box))
+        return sorted(detections, key=lambda d: d.confidence, reverse=True)
+
+
+class ClassifierStage(object):
+    """
+    Classifies motion frames on its own thread so that motion detection never waits for the
+    model. At most queue_size frames wait to be classified, the oldest one being dropped
+    for a new one, as the latest frame is the most relevant. on_result is called with the
+    motion result and the detections of each classified frame.
+    """
+
+    def __init__(self, classifier, on_result, queue_size=1):
+        self.classifier = classifier
+        self.on_result = on_result
+        self.queue_size = queue_size
+        self.frames = None
+
+    def start(self):
+        if self.frames is not None:
+            return
+        # each run has its own queue, a run being stopped never takes the frames of the next one
+        self.frames = queue.Queue(self.queue_size)
+        Thread(name="classifier", target=self._run, args=(self.frames,), daemon=True).start()
+
+    def stop(self):
+        frames, self.frames = self.frames, None
+        if frames is not None:
+            self._put(frames, STOP)
+
+    def submit(self, frame, motion_result):
+        frames = self.frames
+        if frames is not None:
+            self._put(frames, (frame, motion_result))
+
+    @staticmethod
+    def _put(frames, item):
+        while True:
+            try:
+                frames.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            try:
+                frames.get_nowait()
+                FRAMES_CLASSIFIED.labels(result="dropped").inc()
+            except queue.Empty:
+                pass
+
+    def _run(self, frames):
+        LOGGER.debug("Starting classifier")
+        while True:
+            item = frames.get()
+            if item is STOP:
+                break
+            frame, motion_result = item
+            try:
+                with INFERENCE_SECONDS.time():
+                    detections = self.classifier.classify(frame, motion_result.boxes)
+            except Exception:
+                LOGGER.exception("Failed classifying motion frame")
+                continue
+            FRAMES_CLASSIFIED.labels(result="detected" if detections else "rejected").inc()
+            try:
+                self.on_result(motion_result, detections)
+            except Exception:
+                LOGGER.exception("Failed handling classification result")
+        LOGGER.debug("Classifier stopped")
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import hmac
+import json
+import queue
+import socket
+import struct
+import time
+from threading import Event, Lock, Thread
+from time import monotonic
+
+import urllib3
+from flask import jsonify, request, Response
+
+from .alarm import AlarmState
+from .event import emit_published, events
+from .metrics import metrics
+from .tracing import tracer
+from .util import getLogger, parse_duration, run_async
+from .web_server import METRICS_REALM
+
+LOGGER = getLogger(__name__)
+
+CLUSTER_REALM = "Cluster"
+CLUSTER_USERNAME = "cluster"
+# heartbeats are a few hundred bytes
+MAX_PACKET_SIZE = 4096
+# intrusions waiting to be handed to the leader, the followers handle the next ones
+MAX_PENDING_FORWARDS = 16
+
+INTRUSIONS = metrics.counter("rpicalarm_cluster_intrusions",
+                             "Intrusions forwarded to the leader or received from followers by outcome.", ("outcome",))
+FORWARD_SECONDS = metrics.histogram("rpicalarm_cluster_forward_seconds",
+                                    "Time to hand an intrusion to the leader.")
+LEADER_CHANGES = metrics.counter("rpicalarm_cluster_leader_changes", "Leaders elected by this node.")
+INVALID_PACKETS = metrics.counter("rpicalarm_cluster_invalid_packets",
+                                  "Heartbeats dropped as not signed, malformed or too old.")
+
+
+class ClusterPeer(object):
+    """
+    Other node of the cluster, as announced by its latest heartbeat
+    """
+
+    def __init__(self, node_id):
+        self.node_id = node_id
+        self.host = None
+        self.port = None
+        self.priority = 0
+        self.leading = False
+        self.last_seen = None
+
+    def update(self, host, port, priority, leading):
+        self.host = host
+        self.port = int(port)
+        self.priority = int(priority)
+        self.leading = leading
+        self.last_seen = monotonic()
+
+    @property
+    def url(self):
+        return "http://{0}:{1}".format(self.host, self.port)
+
+    def to_dict(self, now):
+        return {"node": self.node_id, "url": self.url, "priority": self.priority, "leading": self.leading,
+                "last_seen_s": round(now - self.last_seen, 3)}
+
+
+class ClusterNode(object):
+    """
+    Member of a cluster of alarms acting as one. Nodes announce themselves with signed
+    multicast heartbeats every heartbeat_interval and leave when not heard from for
+    node_timeout. The live node of highest priority, the node id breaking ties, leads:
+    it owns the alarm state machine and the authenticators. A leader keeps leading while
+    alive, a node joining later follows it. Followers hand their intrusions to the leader
+    over the webServer, handling them themselves if it can not be reached, and mirror
+    the state the leader pushes, also carried by its heartbeats. State changes are
+    numbered by (epoch, seq), the epoch being the leader boot time, so that a restarted
+    leader is followed again. Heartbeats are timestamped and dropped when older than
+    max_clock_skew, which bounds their replay.
+    """
+
+    def __init__(self, alarm, web_server, secret=None, node_id=None, priority="0", multicast_group="239.255.42.99",
+                 multicast_port="4243", multicast_ttl="1", interface=None, advertise_host=None,
+                 heartbeat_interval="1s", node_timeout="3.5s", forward_timeout="2s", max_clock_skew="10s"):
+        if not secret:
+            raise Exception("A cluster secret shared by the nodes is required")
+        self.alarm = alarm
+        self.web_server = web_server
+        self.secret = secret.encode("utf-8")
+        self.node_id = node_id or "{0}:{1}".format(socket.gethostname(), web_server.port)
+        self.priority = int(priority)
+        self.group = (multicast_group, int(multicast_port))
+        self.multicast_ttl = int(multicast_ttl)
+        self.interface = interface
+        # the peers use the heartbeats source address when not set
+        self.advertise_host = advertise_host
+        self.heartbeat_interval = parse_duration(heartbeat_interval).total_seconds()
+        self.node_timeout = parse_duration(node_timeout).total_seconds()
+        self.forward_timeout = parse_duration(forward_timeout).total_seconds()
+        self.max_clock_skew = parse_duration(max_clock_skew).total_seconds()
+        self.peers = {}
+        self.leader_id = None
+        self.lock = Lock()
+        # state changes pushed while leading and the latest one applied while following
+        self.epoch = int(time.time() * 1000)
+        self.seq = 0
+        self.applied = (None, (0, 0))
+        self.apply_lock = Lock()
+        self.start_time = None
+        self.sock = None
+        self.stop_event = Event()
+        self.thread = None
+        # the sensors threads only queue their intrusions
+        self.forwards = queue.Queue(MAX_PENDING_FORWARDS)
+        self.forwarder_thread = None
+        self.http = urllib3.PoolManager()
+        self.headers = urllib3.make_headers(basic_auth="{0}:{1}".format(CLUSTER_USERNAME, secret))
+        self.headers["Content-Type"] = "application/json"
+
+        web_server.add_realm(CLUSTER_REALM, CLUSTER_USERNAME, secret)
+        web_server.add_route("/cluster", "cluster", self.handle_cluster, realm=METRICS_REALM)
+        web_server.add_route("/cluster/intrusion", "cluster_intrusion", self.handle_intrusion, realm=CLUSTER_REALM,
+                             methods=["POST"])
+        web_server.add_route("/cluster/state", "cluster_state", self.handle_state, realm=CLUSTER_REALM,
+                             methods=["POST"])
+        alarm.intrusion_forwarder = self.forward_intrusion
+        for state in AlarmState:
+            state_event = getattr(events, "alarm_" + state.name.lower())
+            state_event += self.on_alarm_state
+        metrics.gauge("rpicalarm_cluster_nodes", "Live nodes of the cluster, this one included.",
+                      func=lambda: len(self.peers) + 1)
+        metrics.gauge("rpicalarm_cluster_leader", "Whether this node leads the cluster (1) or not (0).",
+                      func=lambda: int(self.is_leader))
+
+    @property
+    def is_leader(self):
+        return self.leader_id == self.node_id
+
+    def start(self):
+        self.sock = self._open_socket()
+        self.start_time = monotonic()
+        # keeps a follower running, its agents threads being daemons
+        self.thread = Thread(name="cluster", target=self._run)
+        self.thread.start()
+        self.forwarder_thread = Thread(name="cluster_forwarder", target=self._run_forwarder, daemon=True)
+        self.forwarder_thread.start()
+        LOGGER.info("Node %s joining cluster on %s:%d", self.node_id, *self.group)
+
+    def stop(self):
+        self.stop_event.set()
+        self.forwards.put(None)
+        if self.thread is not None:
+            self.thread.join(self.heartbeat_interval + 1)
+        if self.sock is not None:
+            self.sock.close()
+
+    def _open_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        # several nodes may run on one machine
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(("", self.group[1]))
+        interface = socket.inet_aton(self.interface or "0.0.0.0")
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, struct.pack("4s4s", socket.inet_aton(
+            self.group[0]), interface))
+        if self.interface:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, interface)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.multicast_ttl)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        return sock
+
+    def _sign(self, payload):
+        return hmac.new(self.secret, payload, hashlib.sha256).hexdigest().encode("ascii")
+
+    def _decode(self, packet):
+        """
+        Returns the message of a heartbeat signed with the secret, None if it is not
+        """
+        signature, _, payload = packet.partition(b" ")
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+        try:
+            message = json.loads(payload.decode("utf-8"))
+            if "node" not in message or "port" not in message:
+                return None
+            # bounds the replay of a captured heartbeat
+            return message if abs(time.time() - float(message["time"])) <= self.max_clock_skew else None
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _heartbeat(self):
+        with self.lock:
+            message = {"node": self.node_id, "priority": self.priority, "host": self.advertise_host,
+                       "port": int(self.web_server.port), "leader": self.leader_id, "time": time.time()}
+            # followers catch up with the pushes they missed
+            if self.is_leader and self.alarm.state is not None:
+                message.update(state=str(self.alarm.state), epoch=self.epoch, seq=self.seq)
+        payload = json.dumps(message).encode("utf-8")
+        self.sock.sendto(self._sign(payload) + b" " + payload, self.group)
+
+    def _run(self):
+        next_heartbeat = monotonic()
+        while not self.stop_event.is_set():
+            if monotonic() >= next_heartbeat:
+                try:
+                    self._heartbeat()
+                except Exception:
+                    LOGGER.exception("Failed sending heartbeat")
+                next_heartbeat = monotonic() + self.heartbeat_interval
+                self._elect()
+            self.sock.settimeout(max(0.01, next_heartbeat - monotonic()))
+            try:
+                packet, address = self.sock.recvfrom(MAX_PACKET_SIZE)
+            except socket.timeout:
+                continue
+            except OSError:
+                if not self.stop_event.is_set():
+                    LOGGER.exception("Failed receiving heartbeat")
+                    self.stop_event.wait(self.heartbeat_interval)
+                continue
+            message = self._decode(packet)
+            if message is None:
+                INVALID_PACKETS.inc()
+                LOGGER.debug("Dropped invalid or outdated heartbeat from %s", address[0])
+            elif message["node"] != self.node_id:
+                self._on_heartbeat(message, address)
+
+    def _on_heartbeat(self, message, address):
+        node_id = message["node"]
+        with self.lock:
+            peer = self.peers.get(node_id)
+            if peer is None:
+                LOGGER.info("Node %s joined the cluster", node_id)
+                peer = self.peers[node_id] = ClusterPeer(node_id)
+            peer.update(message.get("host") or address[0], message["port"], message.get("priority", 0),
+                        message.get("leader") == node_id)
+        self._elect()
+        if "state" in message:
+            self._apply_state(node_id, message["state"], message.get("epoch", 0), message.get("seq", 0))
+
+    def _elect(self):
+        now = monotonic()
+        with self.lock:
+            for node_id, peer in list(self.peers.items()):
+                if now - peer.last_seen > self.node_timeout:
+                    LOGGER.info("Node %s left the cluster", node_id)
+                    del self.peers[node_id]
+            # the nodes and their leader are discovered first
+            if now - self.start_time < self.node_timeout:
+                return
+            candidates = [(p.priority, p.node_id) for p in self.peers.values() if p.leading]
+            if self.is_leader:
+                candidates.append((self.priority, self.node_id))
+            if not candidates:
+                candidates = [(p.priority, p.node_id) for p in self.peers.values()]
+                candidates.append((self.priority, self.node_id))
+            # two leaders after a network partition: the lowest one steps down
+            leader_id = max(candidates)[1]
+            if leader_id == self.leader_id:
+                return
+            self.leader_id = leader_id
+            self.applied = (None, (0, 0))
+            is_leader = self.is_leader
+        LOGGER.info("Node %s is the cluster leader", leader_id)
+        LEADER_CHANGES.inc()
+        self.alarm.set_leader(is_leader)
+        events.cluster_leader_changed(self, leader_id)
+
+    def _apply_state(self, node_id, state_name, epoch, seq):
+        with self.apply_lock:
+            with self.lock:
+                if node_id != self.leader_id or self.is_leader:
+                    return
+                # a restarted leader numbers its changes from 0 again in a later epoch
+                applied_node_id, applied_version = self.applied
+                if applied_node_id == node_id and (int(epoch), int(seq)) <= applied_version:
+                    return
+                self.applied = (node_id, (int(epoch), int(seq)))
+            state = AlarmState.from_str(state_name)
+            if state is None:
+                LOGGER.error("Unknown state %s of leader %s", state_name, node_id)
+                return
+            try:
+                self.alarm.follow_state(state)
+            except Exception:
+                LOGGER.exception("Failed following state %s of leader %s", state, node_id)
+
+    def on_alarm_state(self, *_):
+        with self.lock:
+            if not self.is_leader:
+                return
+            self.seq += 1
+            message = {"node": self.node_id, "state": str(self.alarm.state), "epoch": self.epoch, "seq": self.seq}
+            peers = list(self.peers.values())
+        for peer in peers:
+            self._push_state(peer, message)
+
+    @run_async
+    def _push_state(self, peer, message):
+        try:
+            response = self.http.request("POST", peer.url + "/cluster/state", body=json.dumps(message),
+                                         headers=self.headers,
+                                         timeout=self.forward_timeout, retries=False)
+            if response.status != 200:
+                LOGGER.warning("Node %s answered %d to state %s", peer.node_id, response.status, message["state"])
+        except Exception as e:
+            # the heartbeats carry the state too
+            LOGGER.warning("Failed pushing state %s to node %s: %s", message["state"], peer.node_id, e)
+
+    def forward_intrusion(self, _origin, score, details, trace=None):
+        """
+        Queues an intrusion for the leader, returns whether it got queued. The alarm
+        handles it if the leader does not take it.
+        """
+        with self.lock:
+            if self.peers.get(self.leader_id) is None:
+                return False
+        try:
+            self.forwards.put_nowait((score, details, trace))
+        except queue.Full:
+            LOGGER.error("Too many intrusions waiting for the leader, handling it")
+            INTRUSIONS.labels(outcome="failed").inc()
+            return False
+        return True
+
+    def _run_forwarder(self):
+        while True:
+            intrusion = self.forwards.get()
+            if intrusion is None:
+                return
+            score, details, trace = intrusion
+            try:
+                forwarded = self._forward_intrusion(score, details, trace)
+            except Exception:
+                LOGGER.exception("Failed forwarding intrusion")
+                forwarded = False
+            if not forwarded:
+                self.alarm.handle_intrusion(trace)
+
+    def _forward_intrusion(self, score, details, trace):
+        with self.lock:
+            leader = self.peers.get(self.leader_id)
+        if leader is None or leader.node_id == self.node_id:
+            LOGGER.error("Leader lost before forwarding intrusion, handling it")
+            INTRUSIONS.labels(outcome="failed").inc()
+            return False
+        message = {"node": self.node_id, "score": score, "details": details,
+                   "trace_id": trace.id if trace is not None else None,
+                   # monotonic clocks of the nodes differ, the leader trace starts as long ago
+                   "age": monotonic() - trace.start_time if trace is not None else 0}
+        start_time = monotonic()
+        try:
+            response = self.http.request("POST", leader.url + "/cluster/intrusion",
+                                         body=json.dumps(message, default=str),
+                                         headers=self.headers,
+                                         timeout=self.forward_timeout, retries=False)
+        except Exception as e:
+            LOGGER.error("Failed forwarding intrusion to leader %s, handling it: %s", leader.node_id, e)
+            INTRUSIONS.labels(outcome="failed").inc()
+            return False
+        if response.status != 200:
+            LOGGER.error("Leader %s answered %d to intrusion, handling it", leader.node_id, response.status)
+            INTRUSIONS.labels(outcome="failed").inc()
+            return False
+        FORWARD_SECONDS.observe(monotonic() - start_time)
+        INTRUSIONS.labels(outcome="forwarded").inc()
+        if trace is not None:
+            trace.mark("cluster.forwarded", leader=leader.node_id)
+        LOGGER.info("Forwarded intrusion to leader %s", leader.node_id)
+        return True
+
+    def handle_intrusion(self):
+        message = request.get_json(force=True)
+        if not self.is_leader:
+            INTRUSIONS.labels(outcome="rejected").inc()
+            return Response("{0} is not the leader".format(self.node_id), 409)
+        node_id = message["node"]
+        age = min(max(float(message.get("age") or 0), 0.0), self.node_timeout + self.forward_timeout)
+        trace = tracer.start_trace(start_time=monotonic() - age)
+        trace.mark("cluster.intrusion_received", node=node_id, trace_id=message.get("trace_id"))
+        INTRUSIONS.labels(outcome="received").inc()
+        LOGGER.info("Intrusion from node %s", node_id)
+        details = {"{0}/{1}".format(node_id, name): d for name, d in (message.get("details") or {}).items()}
+        emit_published("intrusion_detected", self, float(message.get("score") or 0), details, trace)
+        return jsonify({"trace_id": trace.id})
+
+    def handle_state(self):
+        message = request.get_json(force=True)
+        self._apply_state(message["node"], message["state"], message.get("epoch", 0), message["seq"])
+        return jsonify({"node": self.node_id, "state": str(self.alarm.state)})
+
+    def handle_cluster(self):
+        now = monotonic()
+        with self.lock:
+            return jsonify({
+                "node": self.node_id,
+                "priority": self.priority,
+                "leader": self.leader_id,
+                "state": str(self.alarm.state),
+                "peers": [p.to_dict(now) for p in self.peers.values()],
+            })
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+import cv2
+import numpy as np
+
+from .metrics import metrics
+from .util import getLogger
+
+LOGGER = getLogger(__name__)
+
+FRAMES_DROPPED = metrics.counter("rpicalarm_dedup_frames_dropped", "Near duplicate frames neither stored nor uploaded.")
+BYTES_SAVED = metrics.counter("rpicalarm_dedup_bytes_saved", "Bytes of the near duplicate frames dropped.")
+
+# sessions whose savings are exposed as metrics
+MAX_REPORTED_SESSIONS = 10
+
+# deduplicators by camera, the latest created one of a camera is reported
+DEDUPLICATORS = {}
+
+# 256 bits hashes, 64 bits ones miss a person covering a few percents of the frame
+HASH_SIZE = 16
+
+
+def dhash(gray, hash_size=HASH_SIZE):
+    """
+    Returns the difference hash of a grayscale image, a hash_size * hash_size bits int whose
+    bits tell whether each pixel of the downscaled image is brighter than its left neighbour
+    """
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = np.packbits((small[:, 1:] > small[:, :-1]).ravel())
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+def jpeg_dhash(jpeg_data, hash_size=HASH_SIZE):
+    # decoded at 1/8 of the resolution in grayscale, a fraction of a full decode
+    gray = cv2.imdecode(np.frombuffer(jpeg_data, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if gray is None:
+        raise Exception("Invalid jpeg data")
+    return dhash(gray, hash_size)
+
+
+def hamming_distance(hash1, hash2):
+    return bin(hash1 ^ hash2).count("1")
+
+
+def collect_savings(attribute):
+    return {(name, session_id): getattr(savings, attribute)
+            for name, deduplicator in list(DEDUPLICATORS.items())
+            for session_id, savings in list(deduplicator.savings.items())}
+
+
+metrics.gauge("rpicalarm_dedup_session_frames_dropped", "Near duplicate frames dropped of the latest sessions.",
+              ("camera", "session"), func=lambda: collect_savings("frames_dropped"))
+metrics.gauge("rpicalarm_dedup_session_bytes_saved", "Bytes of the near duplicate frames of the latest sessions.",
+              ("camera", "session"), func=lambda: collect_savings("bytes_saved"))
+
+
+class SessionSavings(object):
+
+    def __init__(self):
+        self.frames_kept = 0
+        self.frames_dropped = 0
+        self.bytes_saved = 0
+
+
+class FrameDeduplicator(object):
+    """
+    Drops the frames of a session whose hash differs from the last kept frame one by less
+    than threshold bits. A frame is kept at least every keyframe_interval seconds, as a
+    keyframe if it is a duplicate.
+    """
+
+    def __init__(self, threshold=3, keyframe_interval=30, name=""):
+        self.name = name
+        self.threshold = threshold
+        self.keyframe_interval = keyframe_interval
+        self.session_id = None
+        self.last_hash = None
+        self.last_kept_time = None
+        self.savings = OrderedDict()
+        self.lock = Lock()
+        DEDUPLICATORS[name] = self
+
+    def _start_session(self, session_id):
+        self._end_session()
+        self.session_id = session_id
+        self.last_hash = None
+        self.last_kept_time = None
+        self.savings[session_id] = SessionSavings()
+        while len(self.savings) > MAX_REPORTED_SESSIONS:
+            self.savings.popitem(last=False)
+
+    def end_session(self):
+        with self.lock:
+            self._end_session()
+
+    def _end_session(self):
+        savings = self.savings.get(self.session_id)
+        if savings is not None and savings.frames_dropped:
+            LOGGER.info("Dropped %d near duplicate frames of %d bytes, kept %d frames of session %s",
+                        savings.frames_dropped, savings.bytes_saved, savings.frames_kept, self.session_id)
+        self.session_id = None
+
+    def keep(self, session_id, jpeg_data):
+        """
+        Returns whether the frame differs enough from the last kept one or is a keyframe
+        """
+        with self.lock:
+            if session_id != self.session_id or session_id not in self.savings:
+                self._start_session(session_id)
+            savings = self.savings[session_id]
+            try:
+                frame_hash = jpeg_dhash(jpeg_data)
+            except Exception:
+                LOGGER.exception("Failed hashing frame, kept")
+                return True
+            now = monotonic()
+            if self.last_hash is not None and now - self.last_kept_time < self.keyframe_interval \
+                    and hamming_distance(frame_hash, self.last_hash) < self.threshold:
+                savings.frames_dropped += 1
+                savings.bytes_saved += len(jpeg_data)
+                FRAMES_DROPPED.inc()
+                BYTES_SAVED.inc(len(jpeg_data))
+                return False
+            self.last_kept_time = now
+            self.last_hash = frame_hash
+            savings.frames_kept += 1
+            return True
@@ -7,6 +7,8 @@
 
 from events import Events
 
+from .metrics import metrics
+
 
 class AlarmSystemEvents(Events):
     __events__ = (
@@ -14,6 +16,7 @@ class AlarmSystemEvents(Events):
         'sensor_stopped',
         'authenticator_started',
         'authenticator_stopped',  # not used
+        'sensor_triggered',
         'intrusion_detected',
         'authentication_failed',
         'authentication_succeeded',
@@ -23,7 +26,37 @@ class AlarmSystemEvents(Events):
         'alarm_disarmed',
         'alarm_disabled',
         'alarm_armed',
+        'frame_captured',
+        'file_saved',
+        'file_removed',
+        'file_backed_up',
+        'cluster_leader_changed',
     )
 
 
 events = AlarmSystemEvents()
+
+EVENTS_EMITTED = metrics.counter("rpicalarm_events_emitted", "Events emitted on the event bus.", ("event",))
+
+
+def _count_emitted(event_name):
+    counter = EVENTS_EMITTED.labels(event=event_name)
+    return lambda *_, **__: counter.inc()
+
+
+for _event_name in AlarmSystemEvents.__events__:
+    _event_slot = getattr(events, _event_name)
+    _event_slot += _count_emitted(_event_name)
+
+# called with the event name and arguments by emit_published
+event_publishers = []
+
+
+def emit_published(event_name, *args, **kwargs):
+    """
+    Hands the event to the publishers then emits it, so they get it before the events
+    its handlers cause, e.g. an intrusion before the state change it triggers
+    """
+    for publisher in list(event_publishers):
+        publisher(event_name, *args, **kwargs)
+    getattr(events, event_name)(*args, **kwargs)
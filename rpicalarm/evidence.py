@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+import os
+import queue
+import sqlite3
+import threading
+import time
+from threading import Lock, Thread, Timer
+
+from flask import jsonify, request, send_file, abort
+from PIL import Image
+
+from .event import events
+from .storage import get_file_session_id, get_file_camera_id
+from .util import getLogger, parse_duration
+
+LOGGER = getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    start_time REAL NOT NULL,
+    end_time REAL,
+    frames INTEGER NOT NULL DEFAULT 0,
+    score REAL,
+    authenticated INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS sessions_start_time ON sessions (start_time);
+CREATE TABLE IF NOT EXISTS frames (
+    name TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    camera_id TEXT,
+    time REAL NOT NULL,
+    size INTEGER NOT NULL,
+    score REAL,
+    uploaded INTEGER NOT NULL DEFAULT 0,
+    local INTEGER NOT NULL DEFAULT 1,
+    thumbnail INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS frames_session_time ON frames (session_id, time);
+CREATE INDEX IF NOT EXISTS frames_time ON frames (time);
+"""
+
+MAX_PAGE_SIZE = 200
+
+
+def row_to_dict(cursor, row):
+    return {column[0]: row[i] for i, column in enumerate(cursor.description)}
+
+
+class EvidenceIndex(object):
+    """
+    SQLite index of the sessions and their frames, fed by the storage and backup events,
+    browsed through the web server. The events are indexed in order by a worker thread,
+    the threads emitting them, e.g. the timelapse one, do not wait for the database.
+    Thumbnails are generated once by the worker when indexing a saved frame, usually
+    before it is backed up and deleted, so that deleted frames can still be reviewed.
+    """
+
+    def __init__(self, storage, web_server=None, db_path="/var/lib/rpicalarm/evidence.db",
+                 thumbnails_path="/var/lib/rpicalarm/thumbnails", thumbnail_size="160x120", retention="720h"):
+        self.storage = storage
+        self.db_path = db_path
+        self.thumbnails_path = thumbnails_path
+        self.thumbnail_size = tuple([int(x) for x in thumbnail_size.split('x')])
+        self.retention = parse_duration(retention).total_seconds()
+        os.makedirs(thumbnails_path, exist_ok=True)
+        # a single writer connection, readers have their own connections which WAL does not block
+        self.write_lock = Lock()
+        self.write_connection = self._connect()
+        self.write_connection.executescript(SCHEMA)
+        self._migrate()
+        self.local = threading.local()
+        self.tasks = queue.Queue()
+        self.thread = Thread(name="evidence", target=self._run_tasks, daemon=True)
+        self.thread.start()
+        self._register_events_handlers()
+        if web_server is not None:
+            self._add_routes(web_server)
+        self._schedule_prune()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # durable at checkpoints only, limits the SD card writes
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _migrate(self):
+        columns = [row[1] for row in self.write_connection.execute("PRAGMA table_info(frames)")]
+        if "camera_id" not in columns:
+            # indexes created before multiple cameras
+            self.write_connection.execute("ALTER TABLE frames ADD COLUMN camera_id TEXT")
+
+    def _get_read_connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = self._connect()
+            connection.row_factory = row_to_dict
+        return connection
+
+    def _write(self, *statements):
+        """
+        Executes the statements in a transaction, returns False if it failed. Errors are only
+        logged, they must not stop the events handlers of the other agents.
+        """
+        with self.write_lock:
+            try:
+                self.write_connection.execute("BEGIN")
+                for statement, params in statements:
+                    self.write_connection.execute(statement, params)
+                self.write_connection.execute("COMMIT")
+                return True
+            except Exception:
+                LOGGER.exception("Failed updating evidence index")
+                if self.write_connection.in_transaction:
+                    self.write_connection.execute("ROLLBACK")
+                return False
+
+    def _run_tasks(self):
+        while True:
+            func, args = self.tasks.get()
+            try:
+                func(*args)
+            except Exception:
+                LOGGER.exception("Failed updating evidence index")
+
+    def _queue_write(self, *statements):
+        self.tasks.put((self._write, statements))
+
+    def _register_events_handlers(self):
+        events.intrusion_detected += self.on_intrusion_detected
+        events.alarm_authenticating += self.on_alarm_authenticating
+        events.authentication_succeeded += self.on_authentication_succeeded
+        events.file_saved += self.on_file_saved
+        events.file_removed += self.on_file_removed
+        events.file_backed_up += self.on_file_backed_up
+
+    def _upsert_session(self, session_id, start_time, score=None):
+        # UPSERT requires SQLite 3.24
+        statements = [("INSERT OR IGNORE INTO sessions (id, start_time, score) VALUES (?, ?, ?)",
+                       (session_id, start_time, score))]
+        if score is not None:
+            statements.append(("UPDATE sessions SET score = ? WHERE id = ?", (score, session_id)))
+        return statements
+
+    def on_intrusion_detected(self, _origin, score, _details, trace=None):
+        if trace is not None:
+            self._queue_write(*self._upsert_session(trace.id, time.time(), score))
+
+    def on_alarm_authenticating(self, _alarm, session):
+        self._queue_write(*self._upsert_session(session.id, time.time()))
+
+    def on_authentication_succeeded(self, _origin, session):
+        self._queue_write(("UPDATE sessions SET authenticated = 1 WHERE id = ?", (session.id,)))
+
+    def on_file_saved(self, _storage, file_name, size):
+        if get_file_session_id(file_name) is not None:
+            self.tasks.put((self._index_frame, (file_name, size, time.time())))
+
+    def _index_frame(self, file_name, size, saved_time):
+        session_id = get_file_session_id(file_name)
+        if not self._write(
+                *self._upsert_session(session_id, saved_time),
+                ("INSERT OR REPLACE INTO frames (name, session_id, camera_id, time, size, score) "
+                 "VALUES (?, ?, ?, ?, ?, (SELECT score FROM sessions WHERE id = ?))",
+                 (file_name, session_id, get_file_camera_id(file_name), saved_time, size, session_id)),
+                ("UPDATE sessions SET frames = frames + 1, end_time = ? WHERE id = ?", (saved_time, session_id))):
+            return
+        if not os.path.exists(os.path.join(self.storage.save_path, file_name)):
+            LOGGER.debug("Frame %s deleted before its thumbnail got generated", file_name)
+            return
+        try:
+            self._make_thumbnail(file_name)
+        except Exception:
+            LOGGER.exception("Failed generating thumbnail of %s", file_name)
+
+    def on_file_removed(self, _storage, file_name, _reason):
+        if get_file_session_id(file_name) is not None:
+            self._queue_write(("UPDATE frames SET local = 0 WHERE name = ?", (file_name,)))
+
+    def on_file_backed_up(self, _backuper, file_name, _backuper_name):
+        if get_file_session_id(file_name) is not None:
+            self._queue_write(("UPDATE frames SET uploaded = 1 WHERE name = ?", (file_name,)))
+
+    def _make_thumbnail(self, file_name):
+        image = Image.open(os.path.join(self.storage.save_path, file_name))
+        # jpeg frames are decoded downscaled, much faster than decoding them fully
+        image.draft("RGB", self.thumbnail_size)
+        image.thumbnail(self.thumbnail_size)
+        image.convert("RGB").save(os.path.join(self.thumbnails_path, file_name), "JPEG", quality=70)
+        self._write(("UPDATE frames SET thumbnail = 1 WHERE name = ?", (file_name,)))
+
+    def list_sessions(self, before=None, limit=20):
+        """
+        Returns the sessions started before the before time, latest first
+        """
+        return self._get_read_connection().execute(
+            "SELECT * FROM sessions WHERE start_time < ? ORDER BY start_time DESC LIMIT ?",
+            (float("inf") if before is None else before, limit)).fetchall()
+
+    def list_frames(self, session_id, after=None, limit=50):
+        """
+        Returns the frames of the session saved after the after time, oldest first
+        """
+        return self._get_read_connection().execute(
+            "SELECT * FROM frames WHERE session_id = ? AND time > ? ORDER BY time LIMIT ?",
+            (session_id, float("-inf") if after is None else after, limit)).fetchall()
+
+    def get_frame(self, file_name):
+        return self._get_read_connection().execute(
+            "SELECT * FROM frames WHERE name = ?", (file_name,)).fetchone()
+
+    def _add_routes(self, web_server):
+        web_server.add_route("/evidence/sessions", "evidence_sessions", self.handle_sessions)
+        web_server.add_route("/evidence/sessions/<session_id>/frames", "evidence_frames", self.handle_frames)
+        web_server.add_route("/evidence/frames/<file_name>", "evidence_frame", self.handle_frame)
+        web_server.add_route("/evidence/frames/<file_name>/thumbnail", "evidence_thumbnail", self.handle_thumbnail)
+
+    def _get_limit(self, default):
+        return max(1, min(MAX_PAGE_SIZE, request.args.get("limit", default, type=int)))
+
+    def handle_sessions(self):
+        """
+        Pages of sessions, the next page starting before the start_time of the last one
+        """
+        sessions = self.list_sessions(request.args.get("before", type=float), self._get_limit(20))
+        return jsonify(sessions=sessions, next_before=sessions[-1]["start_time"] if sessions else None)
+
+    def handle_frames(self, session_id):
+        frames = self.list_frames(session_id, request.args.get("after", type=float), self._get_limit(50))
+        return jsonify(frames=frames, next_after=frames[-1]["time"] if frames else None)
+
+    def handle_frame(self, file_name):
+        frame = self.get_frame(file_name)
+        if frame is None or not frame["local"]:
+            abort(404)
+        return send_file(os.path.join(self.storage.save_path, frame["name"]), mimetype="image/jpeg")
+
+    def handle_thumbnail(self, file_name):
+        frame = self.get_frame(file_name)
+        if frame is None or not (frame["thumbnail"] or frame["local"]):
+            abort(404)
+        if not frame["thumbnail"]:
+            # saved before the index existed
+            self._make_thumbnail(frame["name"])
+        return send_file(os.path.join(self.thumbnails_path, frame["name"]), mimetype="image/jpeg")
+
+    def prune(self):
+        """
+        Forgets the sessions older than the retention and deletes their thumbnails
+        """
+        min_time = time.time() - self.retention
+        with self.write_lock:
+            names = [row[0] for row in self.write_connection.execute(
+                "SELECT name FROM frames WHERE time < ? AND thumbnail = 1", (min_time,))]
+        self._write(("DELETE FROM frames WHERE time < ?", (min_time,)),
+                    ("DELETE FROM sessions WHERE coalesce(end_time, start_time) < ?", (min_time,)))
+        for name in names:
+            try:
+                os.unlink(os.path.join(self.thumbnails_path, name))
+            except OSError:
+                pass
+        if names:
+            LOGGER.info("Pruned %d frames older than %s", len(names), self.retention)
+
+    def _schedule_prune(self):
+        timer = Timer(3600, self._prune_from_timer)
+        timer.daemon = True
+        timer.start()
+
+    def _prune_from_timer(self):
+        try:
+            self.prune()
+        except Exception:
+            LOGGER.exception("Failed pruning evidence index")
+        self._schedule_prune()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import abc
+from pathlib import Path
+from threading import Lock
+from time import monotonic, sleep
+
+import cv2
+
+from .util import getLogger
+
+LOGGER = getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+class FrameSource(abc.ABC):
+    """
+    Source of BGR frames, read(size) returns the next frame at the given (width, height)
+    size or None when there are no more frames
+    """
+
+    @abc.abstractmethod
+    def read(self, size=None):
+        pass
+
+    def close(self):
+        pass
+
+    def __call__(self, size=None):
+        return self.read(size)
+
+    def __iter__(self):
+        while True:
+            frame = self.read()
+            if frame is None:
+                return
+            yield frame
+
+
+class CameraFrameSource(FrameSource):
+    """
+    Frames captured by a camera agent
+    """
+
+    def __init__(self, camera, size=(320, 240)):
+        self.camera = camera
+        self.size = size
+
+    def read(self, size=None):
+        return self.camera.capture_frame(size or self.size)
+
+
+class ReplayFrameSource(FrameSource):
+    """
+    Replays the frames of a directory of images, in file name order, or of a video file.
+    With fps set, frames are paced like a live camera, with loop set replay starts over at the end.
+    """
+
+    def __init__(self, path, fps=None, loop=False):
+        self.path = Path(path)
+        self.fps = fps
+        self.loop = loop
+        self.lock = Lock()
+        self.image_paths = None
+        self.capture = None
+        self.index = 0
+        self.next_frame_time = None
+        if self.path.is_dir():
+            self.image_paths = sorted(p for p in self.path.iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS)
+            if not self.image_paths:
+                raise Exception("No image found in {0}".format(path))
+        else:
+            self.capture = cv2.VideoCapture(str(self.path))
+            if not self.capture.isOpened():
+                raise Exception("Could not open video {0}".format(path))
+
+    @property
+    def names(self):
+        """
+        Names identifying the frames, the image file names or the frame index of a video
+        """
+        if self.image_paths is not None:
+            return [p.name for p in self.image_paths]
+        return [str(i) for i in range(int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT)))]
+
+    def _next_frame(self):
+        if self.image_paths is not None:
+            if self.index >= len(self.image_paths):
+                if not self.loop:
+                    return None
+                self.index = 0
+            frame = cv2.imread(str(self.image_paths[self.index]))
+            self.index += 1
+            return frame
+
+        ok, frame = self.capture.read()
+        if not ok and self.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self.capture.read()
+        return frame if ok else None
+
+    def read(self, size=None):
+        with self.lock:
+            if self.fps:
+                now = monotonic()
+                if self.next_frame_time is not None and now < self.next_frame_time:
+                    sleep(self.next_frame_time - now)
+                self.next_frame_time = max(now, self.next_frame_time or now) + 1.0 / self.fps
+            frame = self._next_frame()
+        if frame is not None and size is not None and (frame.shape[1], frame.shape[0]) != tuple(size):
+            frame = cv2.resize(frame, tuple(size), interpolation=cv2.INTER_AREA)
+        return frame
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.release()
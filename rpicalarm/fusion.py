@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+from threading import Lock
+from time import monotonic
+
+from .event import emit_published, events
+from .tracing import tracer
+from .util import getLogger, parse_duration
+
+LOGGER = getLogger(__name__)
+
+
+def get_sensor_name(sensor):
+    return getattr(sensor, "sensor_name", type(sensor).__name__.lower())
+
+
+class FusionRule(object):
+    """
+    Sensors that must all have triggered within the fusion window, with a combined
+    score of at least min_score
+    """
+
+    def __init__(self, sensor_names, min_score=0.0):
+        self.sensor_names = sensor_names
+        self.min_score = min_score
+
+    @staticmethod
+    def parse(rule_str, min_score=0.0):
+        return FusionRule(frozenset(x.strip() for x in rule_str.split("+") if x.strip()), min_score)
+
+    def __repr__(self):
+        return "+".join(sorted(self.sensor_names))
+
+
+class SensorFusion(object):
+    """
+    Turns raw sensor signals into intrusions. Each sensor signal is kept as evidence for
+    window seconds and an intrusion is emitted, with its score, only when one of the rules
+    holds. The score combines the confidences c of the rule sensors as 1 - prod(1 - c).
+    The intrusion trace starts at the earliest evidence of the rule sensors.
+    """
+
+    def __init__(self, rules="pirsensor,camera", window="3s", min_score="0", cooldown="5s"):
+        min_score = float(min_score)
+        self.rules = [FusionRule.parse(x, min_score) for x in rules.split(",") if x.strip()]
+        self.window = parse_duration(window).total_seconds()
+        self.cooldown = parse_duration(cooldown).total_seconds()
+        self.evidences = {}
+        self.last_intrusion_time = None
+        self.lock = Lock()
+        LOGGER.info("Fusion rules are %s within %ss", self.rules, self.window)
+        events.sensor_triggered += self.on_sensor_triggered
+
+    def on_sensor_triggered(self, sensor, confidence=1.0, details=None):
+        now = monotonic()
+        sensor_name = get_sensor_name(sensor)
+        with self.lock:
+            evidence = self.evidences.setdefault(sensor_name, deque(maxlen=16))
+            evidence.append((now, confidence, details))
+            rule, score = self._match(now)
+            if rule is None:
+                return
+            if self.last_intrusion_time is not None and now - self.last_intrusion_time < self.cooldown:
+                return
+            self.last_intrusion_time = now
+            evidences = {name: self.evidences[name][-1] for name in rule.sensor_names}
+        details = {name: evidence[2] for name, evidence in evidences.items()}
+        trace = self._start_trace(evidences)
+        trace.mark("fusion.intrusion_detected", score=score)
+        LOGGER.debug("Rule %s matched with score %.2f, trace %s", rule, score, trace.id)
+        emit_published("intrusion_detected", self, score, details, trace)
+
+    def _start_trace(self, evidences):
+        # sensors may report when the signal started, e.g. the first PIR edge
+        starts = {name: min(t, (d or {}).get("first_edge_time") or t) for name, (t, _, d) in evidences.items()}
+        trace = tracer.start_trace(start_time=min(starts.values()))
+        for name, (evidence_time, confidence, _) in evidences.items():
+            trace.record("sensor." + name, starts[name], evidence_time, confidence=confidence)
+        return trace
+
+    def _best_confidence(self, sensor_name, now):
+        evidence = self.evidences.get(sensor_name)
+        if not evidence:
+            return None
+        confidences = [c for t, c, _ in evidence if now - t <= self.window]
+        return max(confidences) if confidences else None
+
+    def _match(self, now):
+        best_rule, best_score = None, 0.0
+        for rule in self.rules:
+            miss_probability = 1.0
+            for sensor_name in rule.sensor_names:
+                confidence = self._best_confidence(sensor_name, now)
+                if confidence is None:
+                    break
+                miss_probability *= 1.0 - confidence
+            else:
+                score = 1.0 - miss_probability
+                if score >= rule.min_score and score >= best_score:
+                    best_rule, best_score = rule, score
+        return best_rule, best_score
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import atexit
+import copy
+import datetime
+import logging
+import os
+import queue
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+from threading import Lock
+
+from .metrics import metrics
+from .util import getLogger, TokenBucket
+
+LOGGER = getLogger(__name__)
+
+RECORDS_DROPPED = metrics.counter("rpicalarm_log_records_dropped", "Log records not output by reason.", ("reason",))
+
+LOG_FORMAT = "%(asctime)s %(levelname)-7s %(filename)s:%(lineno)-12s %(threadName)-25s %(message)s"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Limits the records below warning of each logger to rate per second with bursts of burst
+    records, rates of some loggers and their children being overridden by rates. The count of
+    suppressed records is appended to the next record let through.
+    """
+
+    def __init__(self, rate=20.0, burst=50, rates=None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.rates = rates or {}
+        self.buckets = {}
+        self.suppressed = {}
+        self.lock = Lock()
+
+    def _get_rate(self, name):
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition(".")[0]
+        return self.rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        bucket = self.buckets.get(record.name)
+        if bucket is None:
+            with self.lock:
+                rate = self._get_rate(record.name)
+                bucket = self.buckets.setdefault(record.name, TokenBucket(rate, max(1, min(self.burst, rate * 10))))
+        if bucket.try_consume():
+            RECORDS_DROPPED.labels(reason="rate_limited").inc()
+            with self.lock:
+                self.suppressed[record.name] = self.suppressed.get(record.name, 0) + 1
+            return False
+        suppressed = self.suppressed.pop(record.name, 0)
+        if suppressed:
+            record.msg = "{0} ({1} previous messages suppressed)".format(record.getMessage(), suppressed)
+            record.args = None
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Enqueues the records of the logging threads in a bounded queue, records are dropped
+    rather than blocking when the listener falls behind
+    """
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            RECORDS_DROPPED.labels(reason="queue_full").inc()
+
+    def prepare(self, record):
+        # the message is formatted by the listener, only the exception text is computed while
+        # the traceback is still available
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class LogRing(logging.Handler):
+    """
+    Keeps the latest records in memory to be dumped after an incident
+    """
+
+    def __init__(self, capacity=1000):
+        super().__init__()
+        self.records = deque(maxlen=capacity)
+        self.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+
+    def configure(self, capacity):
+        self.records = deque(self.records, maxlen=int(capacity))
+
+    def emit(self, record):
+        # copied since the stdout rate limiting rewrites the message of the records it lets through
+        self.records.append(copy.copy(record))
+
+    def dump(self):
+        lines = []
+        for record in list(self.records):
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                lines.append("Failed formatting record {0}".format(record.msg))
+        return "\n".join(lines) + "\n"
+
+    def dump_to_dir(self, dump_dir):
+        """
+        Writes the records to a new file of dump_dir and returns its path
+        """
+        dump_path = os.path.join(dump_dir, "rpicalarm-{0}.log".format(
+            datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')))
+        with open(dump_path, "w") as dump_file:
+            dump_file.write(self.dump())
+        return dump_path
+
+
+log_ring = LogRing()
+
+
+def parse_rates(rates_str):
+    """
+    Parses logger=rate pairs separated by commas
+    """
+    rates = {}
+    for pair in rates_str.split(","):
+        if pair.strip():
+            name, rate = pair.split("=")
+            rates[name.strip()] = float(rate)
+    return rates
+
+
+def setup_queue_logging(level="info", ring_level=None, ring_size="1000", queue_size="10000", rate="20",
+                        burst="50", rates=""):
+    """
+    Moves the records formatting and output to a listener thread, the root logger only
+    enqueues them. Records output to stdout are rate limited per logger, the latest ones of at
+    least ring_level are all kept in log_ring. Returns the started listener.
+    """
+    level = getattr(logging, level.upper())
+    ring_level = level if ring_level is None else getattr(logging, ring_level.upper())
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.setLevel(min(level, ring_level))
+
+    stdout_handler = logging.StreamHandler()
+    stdout_handler.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+    stdout_handler.setLevel(level)
+    stdout_handler.addFilter(RateLimitFilter(float(rate), int(burst), parse_rates(rates)))
+    log_ring.configure(ring_size)
+    log_ring.setLevel(ring_level)
+
+    queue_handler = DroppingQueueHandler(queue.Queue(int(queue_size)))
+    root_logger.addHandler(queue_handler)
+    listener = QueueListener(queue_handler.queue, log_ring, stdout_handler, respect_handler_level=True)
+    listener.start()
+    # outputs the queued records at exit
+    atexit.register(listener.stop)
+    return listener
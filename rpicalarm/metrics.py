@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+import os
+import resource
+import threading
+import time
+from threading import Lock
+
+from .util import getLogger
+
+LOGGER = getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+SOC_TEMPERATURE_PATH = "/sys/class/thermal/thermal_zone0/temp"
+
+
+def get_rss():
+    """
+    Returns the current resident memory of the process in bytes
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # peak rather than current memory where /proc is not available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_soc_temperature():
+    """
+    Returns the SoC temperature in celsius degrees or None where sysfs does not expose it
+    """
+    try:
+        with open(SOC_TEMPERATURE_PATH) as temp_file:
+            return int(temp_file.read().strip()) / 1000.0
+    except (OSError, ValueError):
+        return None
+
+
+def format_labels(labelnames, labelvalues):
+    if not labelnames:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(
+        n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                          for n, v in zip(labelnames, labelvalues)) + "}"
+
+
+class ThreadCells(object):
+    """
+    Per thread accumulators, each thread only updates its own cell so updates need no lock.
+    Cells of dead threads are folded into a base cell when collected or when a thread
+    registers its cell, so short lived threads do not pile up cells between collections.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.cells = []
+        self.base = [0] * size
+        self.lock = Lock()
+
+    def get(self):
+        try:
+            return self.local.cell
+        except AttributeError:
+            cell = self.local.cell = [0] * self.size
+            with self.lock:
+                self._fold_dead_cells()
+                self.cells.append((threading.current_thread(), cell))
+            return cell
+
+    def _fold_dead_cells(self):
+        alive_cells = []
+        for thread, cell in self.cells:
+            if thread.is_alive():
+                alive_cells.append((thread, cell))
+            else:
+                # the thread is done updating its cell
+                for i, value in enumerate(cell):
+                    self.base[i] += value
+        self.cells = alive_cells
+
+    def collect(self):
+        with self.lock:
+            self._fold_dead_cells()
+            totals = list(self.base)
+            for _, cell in self.cells:
+                for i, value in enumerate(cell):
+                    totals[i] += value
+            return totals
+
+
+class Metric(object):
+
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=(), labelvalues=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.labelvalues = tuple(labelvalues)
+        self.children = {}
+        self.lock = Lock()
+
+    def labels(self, *labelvalues, **labelkwargs):
+        """
+        Returns the child metric of the label values, created on first use
+        """
+        if labelkwargs:
+            labelvalues = tuple(labelkwargs[n] for n in self.labelnames)
+        labelvalues = tuple(str(v) for v in labelvalues)
+        child = self.children.get(labelvalues)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(labelvalues, self._new_child(labelvalues))
+        return child
+
+    def _new_child(self, labelvalues):
+        return type(self)(self.name, self.documentation, self.labelnames, labelvalues)
+
+    def _samples(self):
+        return []
+
+    def samples(self):
+        """
+        Returns the (suffix, labelnames, labelvalues, value) samples of the metric and its children
+        """
+        if self.labelnames and not self.labelvalues:
+            samples = []
+            for child in list(self.children.values()):
+                samples.extend(child._samples())
+            return samples
+        return self._samples()
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.documentation),
+                 "# TYPE {0} {1}".format(self.name, self.TYPE)]
+        for suffix, labelnames, labelvalues, value in self.samples():
+            lines.append("{0}{1}{2} {3}".format(self.name, suffix, format_labels(labelnames, labelvalues), value))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    Counter incremented by its owner or read at collection time by func, for totals
+    kept elsewhere, e.g. by the OS
+    """
+
+    TYPE = "counter"
+
+    def __init__(self, name, documentation, labelnames=(), labelvalues=(), func=None):
+        super().__init__(name, documentation, labelnames, labelvalues)
+        self.cells = ThreadCells(1)
+        self.func = func
+
+    def inc(self, amount=1):
+        self.cells.get()[0] += amount
+
+    @property
+    def value(self):
+        if self.func is not None:
+            return self.func()
+        return self.cells.collect()[0]
+
+    def _samples(self):
+        try:
+            value = self.value
+        except Exception:
+            LOGGER.exception("Failed collecting counter %s", self.name)
+            return []
+        return [("_total", self.labelnames, self.labelvalues, value)]
+
+
+class Gauge(Metric):
+    """
+    Gauge set by its owner or computed at collection time by func, which returns the
+    value or, for labeled gauges, a dict of label values tuples to values
+    """
+
+    TYPE = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), labelvalues=(), func=None):
+        super().__init__(name, documentation, labelnames, labelvalues)
+        self.func = func
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def _samples(self):
+        if self.func is None:
+            return [("", self.labelnames, self.labelvalues, self.value)]
+        try:
+            value = self.func()
+        except Exception:
+            LOGGER.exception("Failed collecting gauge %s", self.name)
+            return []
+        if isinstance(value, dict):
+            return [("", self.labelnames, k if isinstance(k, tuple) else (k,), v) for k, v in value.items()]
+        return [] if value is None else [("", self.labelnames, self.labelvalues, value)]
+
+    def samples(self):
+        if self.func is not None:
+            return self._samples()
+        return super().samples()
+
+
+class Histogram(Metric):
+
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), labelvalues=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames, labelvalues)
+        self.buckets = tuple(buckets)
+        # one cell per bucket, then the +Inf bucket, the sum and the count
+        self.cells = ThreadCells(len(self.buckets) + 3)
+
+    def _new_child(self, labelvalues):
+        return Histogram(self.name, self.documentation, self.labelnames, labelvalues, self.buckets)
+
+    def observe(self, value):
+        cell = self.cells.get()
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                cell[i] += 1
+                break
+        else:
+            cell[len(self.buckets)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    def time(self):
+        return HistogramTimer(self)
+
+    def _samples(self):
+        totals = self.cells.collect()
+        samples = []
+        cumulated = 0
+        for bound, count in zip(self.buckets + ("+Inf",), totals):
+            cumulated += count
+            samples.append(("_bucket", self.labelnames + ("le",), self.labelvalues + (bound,), cumulated))
+        samples.append(("_sum", self.labelnames, self.labelvalues, totals[-2]))
+        samples.append(("_count", self.labelnames, self.labelvalues, totals[-1]))
+        return samples
+
+
+class HistogramTimer(object):
+    """
+    Context manager observing the duration of its block
+    """
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *_):
+        self.histogram.observe(time.monotonic() - self.start)
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = Lock()
+
+    def _get_or_create(self, metric_class, name, documentation, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(name, documentation, **kwargs)
+            elif not isinstance(metric, metric_class):
+                raise Exception("Metric {0} is already registered as a {1}".format(name, metric.TYPE))
+            return metric
+
+    def counter(self, name, documentation, labelnames=(), func=None):
+        counter = self._get_or_create(Counter, name, documentation, labelnames=labelnames)
+        if func is not None:
+            counter.func = func
+        return counter
+
+    def gauge(self, name, documentation, labelnames=(), func=None):
+        gauge = self._get_or_create(Gauge, name, documentation, labelnames=labelnames)
+        if func is not None:
+            # the latest registered function wins, e.g. for a re-created agent
+            gauge.func = func
+        return gauge
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames=labelnames, buckets=buckets)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+
+metrics = MetricsRegistry()
+
+PROCESS_START_TIME = time.time()
+
+metrics.gauge("process_resident_memory_bytes", "Resident memory size in bytes.", func=get_rss)
+metrics.counter("process_cpu_seconds", "Total user and system CPU time spent in seconds.",
+                func=lambda: sum(os.times()[:2]))
+metrics.gauge("process_start_time_seconds", "Start time of the process since unix epoch in seconds.",
+              func=lambda: PROCESS_START_TIME)
+metrics.gauge("process_threads", "Number of live threads.", func=threading.active_count)
+metrics.gauge("rpicalarm_soc_temperature_celsius", "SoC temperature.", func=get_soc_temperature)
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+from threading import Event, Lock, Thread
+from time import monotonic
+
+import cv2
+import imutils
+
+from .metrics import metrics
+from .util import getLogger
+
+LOGGER = getLogger(__name__)
+
+FRAMES_ANALYZED = metrics.counter("rpicalarm_motion_frames", "Frames analyzed by camera and detection mode.",
+                                  ("camera", "mode"))
+ANALYSIS_SECONDS = metrics.histogram(
+    "rpicalarm_motion_analysis_seconds", "Motion analysis time of a frame by detection mode.", ("mode",))
+
+
+class MotionResult(object):
+
+    def __init__(self, boxes, largest_area, changed_ratio):
+        self.boxes = boxes
+        self.largest_area = largest_area
+        self.changed_ratio = changed_ratio
+
+    def __repr__(self):
+        return str(self.__dict__)
+
+
+class MotionAnalyzer(object):
+    """
+    Detects motion by differencing each frame with the previous one
+    """
+
+    def __init__(self, min_area=500, delta_threshold=50, width=500):
+        self.min_area = min_area
+        self.delta_threshold = delta_threshold
+        self.width = width
+        self.past_frame = None
+
+    def reset(self):
+        self.past_frame = None
+
+    def resize(self, frame):
+        (height, width) = frame.shape[:2]
+        if width == self.width:
+            return frame
+        ratio = self.width / float(width)
+        return cv2.resize(frame, (self.width, int(height * ratio)), interpolation=cv2.INTER_AREA)
+
+    def blur(self, frame):
+        # We apply a black & white filter
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        # Then we blur the picture
+        return cv2.GaussianBlur(gray, (21, 21), 0)
+
+    def diff(self, past_frame, gray):
+        # compute the absolute difference between the current frame and first frame
+        frame_delta = cv2.absdiff(past_frame, gray)
+        # then apply a threshold to remove camera motion and other false positives (like light changes)
+        return cv2.threshold(frame_delta, self.delta_threshold, 255, cv2.THRESH_BINARY)[1]
+
+    def contours(self, thresh):
+        # dilate the thresholded image to fill in holes, then find contours on thresholded image
+        thresh = cv2.dilate(thresh, None, iterations=2)
+        return imutils.grab_contours(cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE))
+
+    def prepare(self, frame):
+        return self.blur(self.resize(frame))
+
+    def analyze(self, frame):
+        """
+        Returns the MotionResult of the frame compared to the previous one, None for the first frame
+        """
+        return self.analyze_prepared(self.prepare(frame), frame.shape[1])
+
+    def analyze_prepared(self, gray, frame_width):
+        """
+        Same as analyze for a frame already prepared, frame_width is the width of the original frame
+        """
+        past_frame, self.past_frame = self.past_frame, gray
+
+        # if the first frame is None, initialize it because there is no frame for comparing the current one with a previous one
+        if past_frame is None or past_frame.shape != gray.shape:
+            return None
+
+        thresh = self.diff(past_frame, gray)
+        changed_ratio = cv2.countNonZero(thresh) / float(thresh.size)
+        if not changed_ratio:
+            return MotionResult([], 0, 0.0)
+
+        scale = frame_width / float(gray.shape[1])
+        boxes = []
+        largest_area = 0
+        for c in self.contours(thresh):
+            # if the contour is too small, ignore it
+            area = cv2.contourArea(c)
+            if area < self.min_area:
+                continue
+            # compute the bounding box for the contour, scaled back to the frame size
+            boxes.append(tuple(int(v * scale) for v in cv2.boundingRect(c)))
+            largest_area = max(largest_area, area)
+        return MotionResult(boxes, largest_area, changed_ratio)
+
+
+class FrameBudget(object):
+    """
+    Frames per second the motion detectors of all the cameras may analyze together. The
+    budget is shared max-min fairly: detectors asking for less than an equal share get
+    what they ask for, e.g. idle ones, and the rest is split equally between the others,
+    so that cameras seeing motion cannot starve each other.
+    """
+
+    def __init__(self, max_fps=10.0):
+        self.max_fps = max_fps
+        self.demands = {}
+        self.shares = {}
+        self.lock = Lock()
+        metrics.gauge("rpicalarm_motion_budget_fps", "Frames per second granted to the motion detector of a camera.",
+                      ("camera",), func=lambda: {d.name: share for d, share in list(self.shares.items())})
+
+    def _allocate(self):
+        remaining = self.max_fps
+        demands = sorted(self.demands.items(), key=lambda x: x[1])
+        shares = {}
+        for i, (detector, demand) in enumerate(demands):
+            shares[detector] = min(demand, remaining / (len(demands) - i))
+            remaining -= shares[detector]
+        self.shares = shares
+
+    def request(self, detector, interval):
+        """
+        Returns the interval the detector must wait before its next frame, at least the
+        interval it asks for
+        """
+        if not self.max_fps:
+            return interval
+        demand = 1.0 / interval if interval > 0 else self.max_fps
+        with self.lock:
+            if self.demands.get(detector) != demand:
+                self.demands[detector] = demand
+                self._allocate()
+            share = self.shares[detector]
+        return max(interval, 1.0 / share) if share > 0 else interval
+
+    def leave(self, detector):
+        with self.lock:
+            if self.demands.pop(detector, None) is not None:
+                self._allocate()
+
+
+class MotionDetector(object):
+    """
+    Runs motion detection on its own thread. It samples small frames at a low rate while
+    idle and escalates to full size and rate when the changed area of a frame reaches
+    wake_ratio or when escalate is called, e.g. because another sensor triggered.
+    It goes back to idle after escalation_time without motion. on_motion is called with
+    the motion result and the analyzed frame, None if the pipeline no longer holds it.
+    The frame rate is capped by max_fps and by its share of the budget of all the cameras.
+    """
+
+    def __init__(self, capture, on_motion, active_size=(320, 240), idle_size=(160, 120),
+                 active_interval=0.3, idle_interval=2.0, wake_ratio=0.005, escalation_time=30,
+                 min_area=500, workers=0, name="", max_fps=0.0, budget=None):
+        self.name = name
+        self.min_interval = 1.0 / max_fps if max_fps else 0.0
+        self.budget = budget
+        self.capture = capture
+        self.on_motion = on_motion
+        self.active_size = active_size
+        self.idle_size = idle_size
+        self.active_interval = active_interval
+        self.idle_interval = idle_interval
+        self.wake_ratio = wake_ratio
+        self.escalation_time = escalation_time
+        self.active_analyzer = MotionAnalyzer(min_area=min_area)
+        # idle frames are only checked for a changed area, with a lower threshold to catch faint changes
+        self.idle_analyzer = MotionAnalyzer(min_area=min_area, delta_threshold=25, width=idle_size[0])
+        self.workers = workers
+        self.pipeline = None
+        self.active_until = 0
+        self.stop_event = Event()
+        self.wake_event = Event()
+        self.lock = Lock()
+        self.thread = None
+
+    @property
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    @property
+    def is_active(self):
+        return monotonic() < self.active_until
+
+    def start(self):
+        with self.lock:
+            if self.is_running:
+                return
+            self.stop_event.clear()
+            self.thread = Thread(name="motion_detector_" + self.name if self.name else "motion_detector",
+                                 target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout=5):
+        with self.lock:
+            thread = self.thread
+            self.stop_event.set()
+            self.wake_event.set()
+        if thread is not None:
+            thread.join(timeout)
+
+    def escalate(self):
+        if not self.is_active:
+            LOGGER.debug("Escalating motion detection to full rate")
+        self.active_until = monotonic() + self.escalation_time
+        self.wake_event.set()
+
+    def _start_pipeline(self):
+        # imported here since the pipeline module depends on this one
+        from .motion_pipeline import MotionPipeline
+        self.pipeline = MotionPipeline(
+            (self.active_size[1], self.active_size[0], 3),
+            self._on_pipeline_result,
+            workers=self.workers, analyzer_kwargs={"min_area": self.active_analyzer.min_area})
+        self.pipeline.start()
+
+    def _on_pipeline_result(self, seq, result):
+        # the frame is read back from the pipeline ring only when needed
+        pipeline = self.pipeline
+        frame = pipeline.ring.read(seq) if pipeline is not None and result is not None and result.boxes else None
+        self._on_active_result(result, frame)
+
+    def _run(self):
+        LOGGER.debug("Starting motion detection")
+        self.active_analyzer.reset()
+        self.idle_analyzer.reset()
+        if self.workers > 0:
+            self._start_pipeline()
+        while not self.stop_event.is_set():
+            self.wake_event.clear()
+            is_active = self.is_active
+            try:
+                frame = self.capture(self.active_size if is_active else self.idle_size)
+                if frame is None:
+                    LOGGER.error("No more frame")
+                elif is_active:
+                    self._analyze_active(frame)
+                else:
+                    self._analyze_idle(frame)
+            except Exception:
+                LOGGER.exception("Failed analyzing frame")
+            self.wake_event.wait(self._get_interval())
+        if self.budget is not None:
+            self.budget.leave(self)
+        if self.pipeline is not None:
+            self.pipeline.stop()
+            self.pipeline = None
+        LOGGER.debug("Motion detection stopped")
+
+    def _get_interval(self):
+        interval = max(self.min_interval, self.active_interval if self.is_active else self.idle_interval)
+        return interval if self.budget is None else self.budget.request(self, interval)
+
+    def _analyze_idle(self, frame):
+        with ANALYSIS_SECONDS.labels(mode="idle").time():
+            result = self.idle_analyzer.analyze(frame)
+        FRAMES_ANALYZED.labels(camera=self.name, mode="idle").inc()
+        if result is not None and result.changed_ratio >= self.wake_ratio:
+            self.escalate()
+
+    def _analyze_active(self, frame):
+        if self.pipeline is not None:
+            # results come back through _on_active_result from the pipeline result thread
+            self.pipeline.submit(frame)
+        else:
+            with ANALYSIS_SECONDS.labels(mode="active").time():
+                result = self.active_analyzer.analyze(frame)
+            self._on_active_result(result, frame)
+
+    def _on_active_result(self, result, frame=None):
+        FRAMES_ANALYZED.labels(camera=self.name, mode="active").inc()
+        if result is not None and result.boxes:
+            LOGGER.debug("Motion detected!")
+            self.active_until = monotonic() + self.escalation_time
+            self.on_motion(result, frame)
+        elif not self.is_active:
+            LOGGER.debug("No motion, back to idle motion detection")
+            self.active_analyzer.reset()
+            self.idle_analyzer.reset()
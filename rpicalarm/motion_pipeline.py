@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+import heapq
+import multiprocessing
+import queue
+from multiprocessing import shared_memory
+from threading import Lock, Thread
+from time import monotonic
+
+import numpy as np
+
+from .metrics import metrics
+from .motion import MotionAnalyzer
+from .util import getLogger
+
+LOGGER = getLogger(__name__)
+
+FRAMES_DROPPED = metrics.counter("rpicalarm_motion_pipeline_dropped_frames", "Frames dropped by the motion pipeline.")
+WORKERS_RESTARTED = metrics.counter("rpicalarm_motion_pipeline_restarted_workers",
+                                    "Motion pipeline worker processes restarted after dying.")
+
+STOP = None
+# max wait for a stopping worker to take its stop task and to exit
+STOP_TIMEOUT = 5
+
+
+class FrameRing(object):
+    """
+    Ring of frame slots in shared memory. Each slot is stamped with the sequence number
+    of the frame it holds, so that readers detect frames overwritten while reading them.
+    The creator owns the shared memory, other processes attach to it by name.
+    """
+
+    def __init__(self, frame_shape, slots, name=None, dtype=np.uint8):
+        self.frame_shape = tuple(frame_shape)
+        self.slots = slots
+        frame_size = int(np.prod(self.frame_shape)) * np.dtype(dtype).itemsize
+        seqs_size = slots * np.dtype(np.int64).itemsize
+        self.is_owner = name is None
+        if self.is_owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=seqs_size + slots * frame_size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.seqs = np.ndarray((slots,), dtype=np.int64, buffer=self.shm.buf)
+        self.frames = np.ndarray((slots,) + self.frame_shape, dtype=dtype, buffer=self.shm.buf, offset=seqs_size)
+        if self.is_owner:
+            self.seqs[:] = -1
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write(self, seq, frame):
+        slot = seq % self.slots
+        self.seqs[slot] = -1
+        self.frames[slot] = frame
+        self.seqs[slot] = seq
+
+    def read(self, seq):
+        """
+        Returns a copy of the frame or None if it is no longer in the ring
+        """
+        slot = seq % self.slots
+        if self.seqs[slot] != seq:
+            return None
+        frame = self.frames[slot].copy()
+        # the writer may have overwritten the slot while copying
+        return frame if self.seqs[slot] == seq else None
+
+    def close(self):
+        # views on the buffer must be released before closing it
+        del self.seqs
+        del self.frames
+        self.shm.close()
+        if self.is_owner:
+            self.shm.unlink()
+
+
+def analysis_worker(ring_name, gray_ring_name, frame_shape, gray_shape, slots, analyzer_kwargs, tasks, results):
+    """
+    Worker process, prepares the frame of each task sequence number into the gray ring.
+    Preparing is most of the analysis, the frames are differenced in order by the pipeline.
+    """
+    ring = FrameRing(frame_shape, slots, name=ring_name)
+    gray_ring = FrameRing(gray_shape, slots, name=gray_ring_name)
+    analyzer = MotionAnalyzer(**analyzer_kwargs)
+    try:
+        while True:
+            seq = tasks.get()
+            if seq is STOP:
+                break
+            frame = ring.read(seq)
+            if frame is None:
+                results.put((seq, True))
+                continue
+            gray_ring.write(seq, analyzer.prepare(frame))
+            results.put((seq, False))
+    finally:
+        ring.close()
+        gray_ring.close()
+
+
+class MotionPipeline(object):
+    """
+    Analyzes frames in worker processes. Frames submitted are written to a shared memory
+    ring and prepared (resized, grayed and blurred) by the workers, each frame once. The
+    prepared frames are differenced with the previous one in submission order by the
+    result thread, and their results handed to on_result.
+    The oldest queued frames are dropped when the workers lag behind so that latency stays
+    bounded. A result missing for result_timeout while later ones are in, e.g. of a worker
+    that died, is skipped and the dead workers are restarted.
+    """
+
+    def __init__(self, frame_shape, on_result, workers=2, max_pending=None, analyzer_kwargs=None,
+                 result_timeout=2.0):
+        self.frame_shape = tuple(frame_shape)
+        self.on_result = on_result
+        self.workers_count = workers
+        self.max_pending = max_pending or workers * 2
+        self.analyzer_kwargs = analyzer_kwargs or {}
+        self.result_timeout = result_timeout
+        self.slots = self.max_pending + workers + 2
+        self.ring = None
+        self.gray_ring = None
+        self.gray_shape = None
+        # differences the prepared frames in order
+        self.analyzer = None
+        self.context = None
+        self.tasks = None
+        self.results = None
+        self.processes = []
+        self.result_thread = None
+        self.next_seq = 1
+        self.dropped_count = 0
+        self.stopped = False
+        self.lock = Lock()
+
+    def start(self):
+        self.context = multiprocessing.get_context("spawn")
+        self.analyzer = MotionAnalyzer(**self.analyzer_kwargs)
+        self.gray_shape = self.analyzer.prepare(np.zeros(self.frame_shape, dtype=np.uint8)).shape
+        self.ring = FrameRing(self.frame_shape, self.slots)
+        self.gray_ring = FrameRing(self.gray_shape, self.slots)
+        self.tasks = self.context.Queue(self.max_pending)
+        self.results = self.context.Queue()
+        self.next_seq = 1
+        self.stopped = False
+        self.processes = [self._start_worker(i) for i in range(self.workers_count)]
+        self.result_thread = Thread(name="motion_results", target=self._collect_results, daemon=True)
+        self.result_thread.start()
+
+    def _start_worker(self, index):
+        process = self.context.Process(
+            name="motion_worker_{0}".format(index), target=analysis_worker, daemon=True,
+            args=(self.ring.name, self.gray_ring.name, self.frame_shape, self.gray_shape, self.slots,
+                  self.analyzer_kwargs, self.tasks, self.results))
+        process.start()
+        return process
+
+    def _restart_dead_workers(self):
+        """
+        Restarts the workers if one of them died. As it may have died holding a lock of
+        the queues, all the workers are restarted with new queues, their tasks are lost.
+        """
+        with self.lock:
+            dead_processes = [p for p in self.processes if not p.is_alive()]
+            if self.stopped or not dead_processes:
+                return
+            for process in dead_processes:
+                LOGGER.error("Motion worker %s died with exit code %s", process.name, process.exitcode)
+            WORKERS_RESTARTED.inc(len(dead_processes))
+            for process in self.processes:
+                if process.is_alive():
+                    process.terminate()
+                    process.join(STOP_TIMEOUT)
+            self.tasks = self.context.Queue(self.max_pending)
+            self.results = self.context.Queue()
+            self.processes = [self._start_worker(i) for i in range(self.workers_count)]
+            LOGGER.info("Restarted %d motion workers", self.workers_count)
+
+    def submit(self, frame, block=False):
+        """
+        Returns False if the frame got dropped because the workers are busy, unless
+        block is set in which case it waits for a worker to be available
+        """
+        if frame.shape != self.frame_shape:
+            LOGGER.error("Frame shape %s does not match pipeline shape %s", frame.shape, self.frame_shape)
+            return False
+        with self.lock:
+            if self.stopped:
+                return False
+            seq = self.next_seq
+            self.ring.write(seq, frame)
+            if not block and not self._drop_oldest_if_full():
+                self.dropped_count += 1
+                FRAMES_DROPPED.inc()
+                return False
+            try:
+                self.tasks.put(seq, block=block)
+            except queue.Full:
+                self.dropped_count += 1
+                FRAMES_DROPPED.inc()
+                return False
+            self.next_seq += 1
+            return True
+
+    def _drop_oldest_if_full(self):
+        """
+        Makes room for a new task by dropping the oldest queued one, its frame being the
+        stalest. Returns False if the queue is still full.
+        """
+        if not self.tasks.full():
+            return True
+        try:
+            stale_seq = self.tasks.get_nowait()
+        except queue.Empty:
+            # the queue being full, a worker just took the oldest task or it is being flushed
+            return not self.tasks.full()
+        # its result is skipped in order like the one of an overwritten frame
+        self.results.put((stale_seq, True))
+        return True
+
+    def _collect_results(self):
+        expected_seq = 1
+        pending = []
+        # since when the result of expected_seq is awaited
+        stalled_since = None
+        while True:
+            try:
+                # the queue is replaced when the workers are restarted
+                item = self.results.get(timeout=self.result_timeout)
+            except queue.Empty:
+                item = None
+            else:
+                if item is STOP:
+                    break
+                # a result skipped as missing may still come in late
+                if item[0] >= expected_seq:
+                    heapq.heappush(pending, item)
+            if (pending and pending[0][0] != expected_seq) or (not pending and expected_seq < self.next_seq):
+                now = monotonic()
+                stalled_since = stalled_since or now
+                if now - stalled_since >= self.result_timeout:
+                    # the results of the frames submitted next, if none came in
+                    skipped = (pending[0][0] if pending else self.next_seq) - expected_seq
+                    LOGGER.error("Skipping %d motion results missing for %.1fs", skipped, now - stalled_since)
+                    self.dropped_count += skipped
+                    FRAMES_DROPPED.inc(skipped)
+                    expected_seq += skipped
+                    stalled_since = None
+                    self._restart_dead_workers()
+            while pending and pending[0][0] == expected_seq:
+                stalled_since = None
+                seq, is_stale = heapq.heappop(pending)
+                expected_seq += 1
+                gray = None if is_stale else self.gray_ring.read(seq)
+                if gray is None:
+                    # frame was dropped or overwritten before a worker or this thread got to it
+                    self.dropped_count += 1
+                    FRAMES_DROPPED.inc()
+                    continue
+                try:
+                    self.on_result(seq, self.analyzer.analyze_prepared(gray, self.frame_shape[1]))
+                except Exception:
+                    LOGGER.exception("Failed handling motion result %d", seq)
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            processes = list(self.processes)
+        for _ in processes:
+            try:
+                self.tasks.put(STOP, timeout=STOP_TIMEOUT)
+            except queue.Full:
+                # the workers are stuck, they get terminated
+                LOGGER.error("Motion workers do not take tasks anymore, terminating them")
+                break
+        for process in processes:
+            process.join(STOP_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+        self.results.put(STOP)
+        self.result_thread.join(STOP_TIMEOUT)
+        self.processes = []
+        self.ring.close()
+        self.gray_ring.close()
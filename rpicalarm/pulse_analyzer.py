@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+from array import array
+from threading import Event, Thread
+from time import monotonic
+
+from .util import getLogger
+
+LOGGER = getLogger(__name__)
+
+
+class EdgeRing(object):
+    """
+    Fixed size ring of (timestamp, level) edges backed by arrays.
+    It has a single writer, the edge counter is published after the edge is written
+    so that readers never see a partially written edge.
+    """
+
+    def __init__(self, size=64):
+        self.size = size
+        self.timestamps = array('d', [0.0] * size)
+        self.levels = array('b', [0] * size)
+        self.count = 0
+
+    def append(self, timestamp, level):
+        index = self.count % self.size
+        self.timestamps[index] = timestamp
+        self.levels[index] = level
+        self.count += 1
+
+    def edges(self):
+        """
+        Returns the edges still in the ring, oldest first
+        """
+        count = self.count
+        start = max(0, count - self.size)
+        return [(self.timestamps[i % self.size], self.levels[i % self.size]) for i in range(start, count)]
+
+
+class PulsePattern(object):
+    """
+    Matches when at least min_pulses pulses, each high for at least min_high_duration
+    seconds, started within the last window seconds.
+    """
+
+    def __init__(self, min_pulses=2, window=15, min_high_duration=0):
+        self.min_pulses = min_pulses
+        self.window = window
+        self.min_high_duration = min_high_duration
+
+    def __repr__(self):
+        return str(self.__dict__)
+
+
+def edges_to_pulses(edges, now):
+    """
+    Pairs rising and falling edges into (start, duration) pulses, a pulse still high lasts until now
+    """
+    pulses = []
+    rising_time = None
+    for timestamp, level in edges:
+        if level:
+            # consecutive rising edges means the falling one was missed, restart the pulse
+            rising_time = timestamp
+        elif rising_time is not None:
+            pulses.append((rising_time, timestamp - rising_time))
+            rising_time = None
+    if rising_time is not None:
+        pulses.append((rising_time, now - rising_time))
+    return pulses
+
+
+class PulseTrainAnalyzer(object):
+    """
+    Records PIR sensor edges and evaluates them against a pulse pattern.
+    record_edge only writes to the ring and wakes up the worker thread, so it is
+    cheap enough to be called from the GPIO callback.
+    """
+
+    def __init__(self, pattern, on_match, ring_size=64):
+        self.pattern = pattern
+        self.on_match = on_match
+        self.ring = EdgeRing(ring_size)
+        self.last_match_time = None
+        # start of the first pulse of the latest match
+        self.match_start_time = None
+        self.edge_event = Event()
+        self.stop_event = Event()
+        self.thread = None
+
+    def record_edge(self, level, timestamp=None):
+        self.ring.append(monotonic() if timestamp is None else timestamp, 1 if level else 0)
+        self.edge_event.set()
+
+    def evaluate(self, now=None):
+        """
+        Returns True when the recorded edges match the pattern, edges that took part
+        in a match are not considered again.
+        """
+        now = monotonic() if now is None else now
+        window_start = now - self.pattern.window
+        if self.last_match_time is not None:
+            window_start = max(window_start, self.last_match_time)
+        pulses = [p for p in edges_to_pulses(self.ring.edges(), now)
+                  if p[0] > window_start and p[1] >= self.pattern.min_high_duration]
+        if len(pulses) < self.pattern.min_pulses:
+            return False
+        self.last_match_time = now
+        self.match_start_time = pulses[0][0]
+        return True
+
+    def is_high(self):
+        edges = self.ring.edges()
+        return bool(edges) and edges[-1][1] == 1
+
+    def start(self):
+        self.stop_event.clear()
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = Thread(name="pulse_analyzer", target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.edge_event.set()
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            # while the sensor is high the pulse may reach min_high_duration without new edges
+            timeout = self.pattern.min_high_duration / 2 if self.is_high() and self.pattern.min_high_duration else None
+            self.edge_event.wait(timeout)
+            self.edge_event.clear()
+            if self.stop_event.is_set():
+                break
+            try:
+                if self.evaluate():
+                    self.on_match()
+            except Exception:
+                LOGGER.exception("Failed evaluating pulse train")
+
+
+def replay_trace(analyzer, trace):
+    """
+    Feeds a recorded trace of (timestamp, level) edges to the analyzer and returns the
+    timestamps at which the pattern matched, for evaluating patterns off-device
+    """
+    matches = []
+    for timestamp, level in trace:
+        analyzer.record_edge(level, timestamp)
+        if analyzer.evaluate(timestamp):
+            matches.append(timestamp)
+    return matches
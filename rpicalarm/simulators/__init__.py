@@ -0,0 +1,5 @@
+from .camera import SimulatedCamera
+from .gpio import SimulatedGPIO, load_gpio_script
+from .services import BotApiStub, CloudinaryStub, SmtpStub, SimulatedTwilioHttpClient
+from .simulation import Simulation
+from .soak import SoakTest
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import time
+from threading import Lock
+
+import cv2
+import numpy as np
+
+from ..frame_source import ReplayFrameSource
+from ..util import getLogger
+
+LOGGER = getLogger(__name__)
+
+
+class SimulatedCamera(object):
+    """
+    Stands in for picamera.PiCamera. Frames are replayed from a directory of images or a
+    video file, or drawn from a still synthetic scene crossed by a moving block while
+    start_motion is in effect.
+    """
+
+    def __init__(self, frames_path=None, fps=10, resolution=(1920, 1080)):
+        self.vflip = False
+        self.hflip = False
+        self.led = False
+        self.resolution = resolution
+        self.framerate = 30
+        self.awb_mode = 'auto'
+        self.exposure_mode = 'auto'
+        self.fps = fps
+        self.source = ReplayFrameSource(frames_path, loop=True) if frames_path else None
+        self.lock = Lock()
+        self.frames_count = 0
+        self.motion_until = 0
+        # splitter ports encoding frames or recording
+        self.video_ports = set()
+
+    def start_motion(self, duration):
+        """
+        Moves a block across the synthetic scene for duration seconds
+        """
+        self.motion_until = time.monotonic() + duration
+
+    def _synthetic_frame(self, size):
+        (width, height) = size
+        frame = np.full((height, width, 3), 96, dtype=np.uint8)
+        cv2.rectangle(frame, (width // 8, height // 2), (width // 3, height - 1), (60, 60, 60), -1)
+        if time.monotonic() < self.motion_until:
+            block = max(8, width // 6)
+            x = (self.frames_count * block // 2) % max(1, width - block)
+            cv2.rectangle(frame, (x, height // 4), (x + block, height // 4 + block * 2), (230, 230, 230), -1)
+        return frame
+
+    def _next_frame(self, size):
+        with self.lock:
+            self.frames_count += 1
+            if self.source is None:
+                return self._synthetic_frame(size)
+            return self.source.read(size)
+
+    def _write(self, output, size, image_format):
+        frame = self._next_frame(tuple(size or self.resolution))
+        if self.vflip:
+            frame = cv2.flip(frame, 0)
+        if self.hflip:
+            frame = cv2.flip(frame, 1)
+        ok, data = cv2.imencode("." + ("jpg" if image_format in ("jpeg", "mjpeg") else image_format), frame)
+        if not ok:
+            raise Exception("Could not encode frame as {0}".format(image_format))
+        if isinstance(output, str):
+            with open(output, "wb") as output_file:
+                output_file.write(data.tobytes())
+        else:
+            output.write(data.tobytes())
+
+    def capture(self, output, format="jpeg", use_video_port=False, resize=None, splitter_port=0, **_):
+        # pylint: disable=redefined-builtin,unused-argument
+        if not use_video_port:
+            # still port captures are slow on the real camera
+            time.sleep(1.0 / self.fps)
+        self._write(output, resize, format)
+
+    def _use_video_port(self, splitter_port):
+        with self.lock:
+            # like picamera, a splitter port has a single encoder
+            if splitter_port in self.video_ports:
+                raise Exception("Port {0} is already in use".format(splitter_port))
+            self.video_ports.add(splitter_port)
+
+    def capture_continuous(self, output, format="jpeg", use_video_port=False, resize=None, splitter_port=0, **_):
+        # pylint: disable=redefined-builtin,unused-argument
+        if use_video_port:
+            self._use_video_port(splitter_port)
+        try:
+            while True:
+                time.sleep(1.0 / self.fps)
+                self._write(output, resize, format)
+                yield output
+        finally:
+            if use_video_port:
+                self.video_ports.discard(splitter_port)
+
+    def start_recording(self, output, format="h264", splitter_port=1, **_):
+        # pylint: disable=redefined-builtin,unused-argument
+        self._use_video_port(splitter_port)
+        LOGGER.info("Simulated camera does not encode video, %s recording is a no-op", format)
+
+    def stop_recording(self, splitter_port=1):
+        if splitter_port not in self.video_ports:
+            raise Exception("Port {0} is not recording".format(splitter_port))
+        self.video_ports.discard(splitter_port)
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import queue
+import time
+from threading import Lock, Thread
+
+from ..util import getLogger
+
+LOGGER = getLogger(__name__)
+
+
+def load_gpio_script(path):
+    """
+    Reads a script of edges, one "<delay in seconds> <channel> <level>" line per edge,
+    the delay being relative to the previous edge. Lines starting with # are ignored.
+    """
+    edges = []
+    with open(path) as script_file:
+        for line in script_file:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            delay, channel, level = line.split()
+            edges.append((float(delay), int(channel), int(level)))
+    return edges
+
+
+class SimulatedGPIO(object):
+    """
+    Stands in for the RPi.GPIO module. Input levels are driven by set_input, pulse or
+    scripted edges and edge detection callbacks run in their own thread like RPi.GPIO ones.
+    """
+
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self.mode = None
+        self.levels = {}
+        self.detections = {}
+        self.last_callback_times = {}
+        self.lock = Lock()
+        self.callbacks = queue.Queue()
+        Thread(name="gpio_callbacks", target=self._run_callbacks, daemon=True).start()
+
+    def getmode(self):
+        return self.mode
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, channel, direction, pull_up_down=PUD_OFF, initial=LOW):
+        # pylint: disable=unused-argument
+        with self.lock:
+            self.levels[channel] = self.HIGH if pull_up_down == self.PUD_UP else initial
+
+    def input(self, channel):
+        return self.levels.get(channel, self.LOW)
+
+    def output(self, channel, level):
+        self.set_input(channel, level)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        with self.lock:
+            if channel in self.detections:
+                raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+            self.detections[channel] = (edge, callback, (bouncetime or 0) / 1000.0)
+
+    def remove_event_detect(self, channel):
+        with self.lock:
+            self.detections.pop(channel, None)
+
+    def cleanup(self, channel=None):
+        with self.lock:
+            if channel is None:
+                self.detections.clear()
+                self.levels.clear()
+            else:
+                self.detections.pop(channel, None)
+                self.levels.pop(channel, None)
+
+    def set_input(self, channel, level):
+        with self.lock:
+            previous_level = self.levels.get(channel, self.LOW)
+            self.levels[channel] = level
+            detection = self.detections.get(channel)
+            if detection is None or level == previous_level:
+                return
+            edge, callback, bouncetime = detection
+            if callback is None or edge == (self.FALLING if level else self.RISING):
+                return
+            now = time.monotonic()
+            # like RPi.GPIO, edges within bouncetime of the last reported one are ignored
+            if now - self.last_callback_times.get(channel, -bouncetime) < bouncetime:
+                return
+            self.last_callback_times[channel] = now
+        self.callbacks.put((callback, channel))
+
+    def pulse(self, channel, count=1, high_time=0.5, low_time=0.5):
+        """
+        Drives count high pulses on the channel, blocks until done
+        """
+        for i in range(count):
+            self.set_input(channel, self.HIGH)
+            time.sleep(high_time)
+            self.set_input(channel, self.LOW)
+            if i < count - 1:
+                time.sleep(low_time)
+
+    def play(self, edges, loop=False):
+        """
+        Plays scripted edges (see load_gpio_script) in a background thread
+        """
+
+        def player():
+            while True:
+                for delay, channel, level in edges:
+                    time.sleep(delay)
+                    self.set_input(channel, level)
+                if not loop:
+                    break
+
+        thread = Thread(name="gpio_script", target=player, daemon=True)
+        thread.start()
+        return thread
+
+    def _run_callbacks(self):
+        while True:
+            callback, channel = self.callbacks.get()
+            try:
+                callback(channel)
+            except Exception:
+                LOGGER.exception("GPIO callback failed on channel %s", channel)
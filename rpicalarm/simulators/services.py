@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-ins of the remote services, they record what they receive and answer like
+the real ones as far as the agents are concerned
+"""
+import email
+import json
+import re
+import socketserver
+import time
+import uuid
+from collections import deque
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Lock, Thread, Timer
+from urllib.parse import parse_qsl, urlparse, urlunparse
+from xml.etree import ElementTree
+
+import requests
+from twilio.http import HttpClient
+from twilio.http.response import Response
+from twilio.request_validator import RequestValidator
+
+from ..util import getLogger
+
+LOGGER = getLogger(__name__)
+
+
+def parse_body(content_type, body):
+    """
+    Returns the parameters of a JSON, url encoded or multipart request body,
+    multipart file parts are returned as bytes
+    """
+    content_type = content_type or ""
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body.decode("utf-8"))
+    if content_type.startswith("multipart/form-data"):
+        message = email.message_from_bytes(
+            "Content-Type: {0}\r\n\r\n".format(content_type).encode("utf-8") + body, policy=HTTP)
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            payload = part.get_payload(decode=True)
+            params[name] = payload if part.get_filename() else payload.decode("utf-8")
+        return params
+    return dict(parse_qsl(body.decode("utf-8")))
+
+
+class RecordedRequest(object):
+
+    def __init__(self, method, path, params):
+        self.time = time.time()
+        self.method = method
+        self.path = path
+        self.params = params
+
+    def __repr__(self):
+        return "{0} {1}".format(self.method, self.path)
+
+
+class StubHttpServer(object):
+    """
+    HTTP stand-in listening on localhost, requests are recorded and answered by
+    handle(method, path, params) which returns (status, json_data)
+    """
+
+    def __init__(self, name, port=0):
+        self.name = name
+        self.requests = deque(maxlen=1000)
+        stub = self
+
+        class StubRequestHandler(BaseHTTPRequestHandler):
+
+            def _dispatch(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                params = dict(parse_qsl(url.query))
+                params.update(parse_body(self.headers.get("Content-Type"), self.rfile.read(length)))
+                stub.requests.append(RecordedRequest(self.command, url.path, params))
+                try:
+                    status, data = stub.handle(self.command, url.path, params)
+                except Exception:
+                    LOGGER.exception("%s stand-in failed handling %s %s", stub.name, self.command, url.path)
+                    status, data = 500, {"error": {"message": "internal error"}}
+                body = json.dumps(data).encode("utf-8")
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # e.g. long polling client that gave up waiting
+                    LOGGER.debug("%s stand-in client of %s went away", stub.name, url.path)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+            def log_message(self, format, *args):
+                # pylint: disable=redefined-builtin
+                LOGGER.debug("%s stand-in: " + format, stub.name, *args)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), StubRequestHandler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.httpd.server_address[1])
+
+    def handle(self, method, path, params):
+        raise NotImplementedError()
+
+    def start(self):
+        Thread(name="{0}_stub".format(self.name), target=self.httpd.serve_forever, daemon=True).start()
+        LOGGER.info("%s stand-in listening on %s", self.name, self.url)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class BotApiStub(StubHttpServer):
+    """
+    Telegram Bot API stand-in. The user of user_id talks to the bot through say, and can
+    answer bot messages automatically with add_auto_reply. add_flood_control makes the
+    next sends fail like the Telegram flood control does
+    """
+
+    def __init__(self, user_id, user_name="user", port=0):
+        super().__init__("telegram", port)
+        self.user_id = int(user_id)
+        self.user_name = user_name
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.updates_cond = Condition()
+        self.webhook_url = None
+        self.auto_replies = []
+        self.sent_messages = deque(maxlen=1000)
+        self.flood_controlled = 0
+        self.flood_retry_after = 1
+
+    def add_auto_reply(self, pattern, reply, delay=0):
+        self.auto_replies.append((re.compile(pattern), reply, delay))
+
+    def add_flood_control(self, count, retry_after=1):
+        """
+        Answers the next count sends with a flood control error asking to retry after
+        retry_after seconds
+        """
+        with self.updates_cond:
+            self.flood_controlled = count
+            self.flood_retry_after = retry_after
+
+    def _is_flood_controlled(self):
+        with self.updates_cond:
+            if self.flood_controlled <= 0:
+                return False
+            self.flood_controlled -= 1
+            return True
+
+    def _message(self, chat_id, **kwargs):
+        with self.updates_cond:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+        message = {"message_id": message_id, "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"}}
+        message.update(kwargs)
+        return message
+
+    def say(self, text):
+        """
+        Sends a message of the user to the bot
+        """
+        message = self._message(self.user_id, text=text,
+                                **{"from": {"id": self.user_id, "is_bot": False, "first_name": self.user_name}})
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        with self.updates_cond:
+            update = {"update_id": self.next_update_id, "message": message}
+            self.next_update_id += 1
+            webhook_url = self.webhook_url
+            if webhook_url is None:
+                self.updates.append(update)
+                self.updates_cond.notify_all()
+        if webhook_url is not None:
+            try:
+                requests.post(webhook_url, json=update, timeout=10)
+            except Exception:
+                LOGGER.exception("Failed posting update to webhook %s", webhook_url)
+
+    def _get_updates(self, offset, timeout):
+        deadline = time.monotonic() + timeout
+        with self.updates_cond:
+            # updates before offset are confirmed
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.updates_cond.wait(deadline - time.monotonic())
+            return list(self.updates)
+
+    def _on_bot_message(self, text):
+        self.sent_messages.append((time.time(), text))
+        for pattern, reply, delay in self.auto_replies:
+            if pattern.search(text or ""):
+                Timer(delay, self.say, args=(reply,)).start()
+
+    def handle(self, method, path, params):
+        api_method = path.rsplit("/", 1)[-1]
+        chat_id = params.get("chat_id")
+        if isinstance(chat_id, str) and chat_id.startswith("@"):
+            # channel usernames resolve to numeric ids
+            chat_id = -1000000000000 - sum(ord(c) for c in chat_id)
+        if api_method.startswith("send") and self._is_flood_controlled():
+            return 429, {"ok": False, "error_code": 429,
+                         "description": "Too Many Requests: retry after {0}".format(self.flood_retry_after),
+                         "parameters": {"retry_after": self.flood_retry_after}}
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bot", "username": "bot"}
+        elif api_method == "getUpdates":
+            result = self._get_updates(int(params.get("offset") or 0), float(params.get("timeout") or 0))
+        elif api_method == "setWebhook":
+            self.webhook_url = params.get("url") or None
+            result = True
+        elif api_method == "deleteWebhook":
+            self.webhook_url = None
+            result = True
+        elif api_method == "sendMessage":
+            self._on_bot_message(params.get("text"))
+            result = self._message(chat_id, text=params.get("text"))
+        elif api_method == "sendPhoto":
+            self._on_bot_message(None)
+            result = self._message(chat_id, photo=[{"file_id": str(uuid.uuid4()), "width": 640, "height": 480}])
+        elif api_method == "sendMediaGroup":
+            self._on_bot_message(None)
+            media = params.get("media")
+            media = json.loads(media) if isinstance(media, str) else media
+            result = [self._message(chat_id, photo=[{"file_id": str(uuid.uuid4()), "width": 640, "height": 480}])
+                      for _ in media]
+        else:
+            result = True
+        return 200, {"ok": True, "result": result}
+
+
+class CloudinaryStub(StubHttpServer):
+    """
+    Cloudinary upload and admin API stand-in, keeps the public id and tags of uploaded images
+    """
+
+    def __init__(self, port=0):
+        super().__init__("cloudinary", port)
+        self.lock = Lock()
+        self.resources = {}
+
+    def handle(self, method, path, params):
+        if method == "POST" and path.endswith("/image/upload"):
+            tags = [x for x in (params.get("tags") or "").split(",") if x]
+            data = params.get("file") or b""
+            with self.lock:
+                self.resources[params.get("public_id")] = tags
+            return 200, {"public_id": params.get("public_id"), "version": int(time.time()),
+                         "resource_type": "image", "type": params.get("type", "upload"),
+                         "bytes": len(data), "tags": tags}
+        match = re.search(r"/resources/image/tags/([^/]+)$", path)
+        if method == "DELETE" and match:
+            with self.lock:
+                deleted = [k for k, tags in self.resources.items() if match.group(1) in tags]
+                for public_id in deleted:
+                    del self.resources[public_id]
+            return 200, {"deleted": {k: "deleted" for k in deleted}, "partial": False}
+        return 404, {"error": {"message": "Resource not found"}}
+
+
+class SmtpStub(socketserver.ThreadingTCPServer):
+    """
+    Minimal SMTP server keeping the (time, message) of the messages it receives, any
+    login is accepted
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0):
+        self.messages = deque(maxlen=100)
+        self.messages_cond = Condition()
+
+        class SmtpHandler(socketserver.StreamRequestHandler):
+
+            def reply(self, line):
+                self.wfile.write((line + "\r\n").encode("utf-8"))
+
+            def handle(self):
+                self.reply("220 localhost stand-in ESMTP")
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command = line.decode("utf-8", "replace").strip().split(" ")[0].upper()
+                    if command == "EHLO":
+                        self.reply("250-localhost")
+                        self.reply("250 AUTH PLAIN LOGIN")
+                    elif command == "AUTH":
+                        self.reply("235 Authentication successful")
+                    elif command == "DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        lines = []
+                        for data_line in iter(self.rfile.readline, b""):
+                            if data_line in (b".\r\n", b".\n"):
+                                break
+                            # undo dot stuffing
+                            lines.append(data_line[1:] if data_line.startswith(b"..") else data_line)
+                        self.server.on_message(email.message_from_bytes(b"".join(lines)))
+                        self.reply("250 OK")
+                    elif command == "QUIT":
+                        self.reply("221 Bye")
+                        return
+                    elif command in ("HELO", "MAIL", "RCPT", "RSET", "NOOP"):
+                        self.reply("250 OK")
+                    else:
+                        self.reply("502 Command not implemented")
+
+        super().__init__(("127.0.0.1", port), SmtpHandler)
+
+    @property
+    def url(self):
+        return "smtp://127.0.0.1:{0}".format(self.server_address[1])
+
+    def on_message(self, message):
+        with self.messages_cond:
+            self.messages.append((time.time(), message))
+            self.messages_cond.notify_all()
+
+    def wait_for_messages(self, count, timeout):
+        """
+        Returns the messages received once there are count of them or timeout seconds passed
+        """
+        with self.messages_cond:
+            self.messages_cond.wait_for(lambda: len(self.messages) >= count, timeout)
+            return list(self.messages)
+
+    def start(self):
+        Thread(name="smtp_stub", target=self.serve_forever, daemon=True).start()
+        LOGGER.info("smtp stand-in listening on %s", self.url)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class SimulatedCall(object):
+    """
+    Phone call answered after answer_delay by a user who types the digits in turn at each
+    prompt and hangs up when none is left. Without digits the call is not answered.
+    """
+
+    def __init__(self, sid, params, auth_token, digits, answer_delay):
+        self.sid = sid
+        self.params = params
+        self.validator = RequestValidator(auth_token)
+        self.digits = list(digits)
+        self.answer_delay = answer_delay
+        self.status = "queued"
+        self.hung_up = False
+
+    def to_json(self):
+        return {"sid": self.sid, "status": self.status, "to": self.params.get("To"),
+                "from": self.params.get("From"), "direction": "outbound-api"}
+
+    def _post(self, url, params):
+        url_parts = urlparse(url)
+        # Twilio signs the url without its credentials
+        signed_url = urlunparse(url_parts._replace(netloc=url_parts.netloc.rsplit("@", 1)[-1]))
+        params = dict(params, CallSid=self.sid, From=self.params.get("From"), To=self.params.get("To"))
+        headers = {"X-Twilio-Signature": self.validator.compute_signature(signed_url, params),
+                   "I-Twilio-Idempotency-Token": str(uuid.uuid4())}
+        response = requests.post(url, data=params, headers=headers, timeout=10)
+        response.raise_for_status()
+        return response.text
+
+    def run(self):
+        time.sleep(self.answer_delay)
+        try:
+            if self.hung_up:
+                return
+            if not self.digits:
+                self.status = "no-answer"
+                return
+            self.status = "in-progress"
+            url, params = self.params.get("Url"), {"CallStatus": self.status}
+            while url and not self.hung_up:
+                twiml = ElementTree.fromstring(self._post(url, params))
+                gather = twiml.find("Gather")
+                if gather is None or not self.digits:
+                    break
+                url = gather.get("action") or url
+                params = {"CallStatus": self.status, "Digits": self.digits.pop(0)}
+            self.status = "completed"
+        except Exception:
+            LOGGER.exception("Simulated call %s failed", self.sid)
+            self.status = "failed"
+        finally:
+            self.hang_up()
+
+    def hang_up(self):
+        if self.hung_up:
+            return
+        self.hung_up = True
+        if self.status in ("queued", "ringing"):
+            self.status = "canceled"
+        status_callback = self.params.get("StatusCallback")
+        if status_callback:
+            try:
+                self._post(status_callback, {"CallStatus": self.status})
+            except Exception:
+                LOGGER.exception("Failed posting status callback of call %s", self.sid)
+
+
+class SimulatedTwilioHttpClient(HttpClient):
+    """
+    Twilio REST client transport that simulates the calls instead of placing them, the
+    simulated calls drive the Twilio webhooks of the web server
+    """
+
+    def __init__(self, digits=None, answer_delay=1.0):
+        self.digits = digits or []
+        self.answer_delay = answer_delay
+        self.lock = Lock()
+        self.calls = {}
+        self.requests = deque(maxlen=1000)
+
+    def request(self, method, url, params=None, data=None, headers=None, auth=None,
+                timeout=None, allow_redirects=False):
+        path = urlparse(url).path
+        self.requests.append(RecordedRequest(method, path, data))
+        match = re.search(r"/Calls(?:/([^/]+))?\.json$", path)
+        if match is None:
+            return Response(404, json.dumps({"code": 20404, "message": "Not found", "status": 404}))
+        data = data or {}
+        if match.group(1) is None and method == "POST":
+            call = SimulatedCall("CA" + uuid.uuid4().hex, data, auth[1], self.digits, self.answer_delay)
+            with self.lock:
+                self.calls[call.sid] = call
+            Thread(name="twilio_call", target=call.run, daemon=True).start()
+            return Response(201, json.dumps(call.to_json()))
+        with self.lock:
+            call = self.calls.get(match.group(1))
+        if call is None:
+            return Response(404, json.dumps({"code": 20404, "message": "Not found", "status": 404}))
+        if method == "POST" and data.get("Status") in ("completed", "canceled"):
+            Thread(name="twilio_hang_up", target=call.hang_up, daemon=True).start()
+        return Response(200, json.dumps(call.to_json()))
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from ..util import getLogger, parse_duration
+from .camera import SimulatedCamera
+from .gpio import SimulatedGPIO, load_gpio_script
+from .services import BotApiStub, CloudinaryStub, SimulatedTwilioHttpClient, SmtpStub
+
+LOGGER = getLogger(__name__)
+
+
+class Simulation(object):
+    """
+    Replaces the Pi hardware and the remote services with local stand-ins, each one being
+    enabled by its option. The simulated user answers authentications through the
+    answer_with channel (telegram, twilio or none) after answer_delay.
+    """
+
+    def __init__(self, camera="true", gpio="true", telegram="true", twilio="true", email="true",
+                 cloudinary="true", frames_path=None, frames_fps="10", gpio_script=None,
+                 gpio_script_loop="false", answer_with="telegram", answer_delay="1s"):
+        self.answer_with = answer_with
+        self.answer_delay = parse_duration(answer_delay).total_seconds()
+        self.frames_path = frames_path
+        self.frames_fps = float(frames_fps)
+        self.camera = SimulatedCamera(frames_path, fps=self.frames_fps) if camera.lower() == "true" else None
+        self.cameras = {}
+        self.gpio = SimulatedGPIO() if gpio.lower() == "true" else None
+        self.gpio_script = load_gpio_script(gpio_script) if self.gpio is not None and gpio_script else None
+        self.gpio_script_loop = gpio_script_loop.lower() == "true"
+        self.enabled_services = [name for name, enabled in
+                                 (("telegram", telegram), ("twilio", twilio), ("email", email),
+                                  ("cloudinary", cloudinary)) if enabled.lower() == "true"]
+        self.bot_api = None
+        self.cloudinary = None
+        self.smtp = None
+        self.twilio_http_client = None
+
+    def apply(self, cfg):
+        """
+        Starts the service stand-ins and points the configuration sections to them
+        """
+        password = cfg.get("alarm", "password", fallback="")
+        if "telegram" in self.enabled_services and cfg.has_section("telegram"):
+            self.bot_api = BotApiStub(cfg["telegram"]["user_id"], cfg["telegram"].get("user_name", "user"))
+            self.bot_api.start()
+            cfg["telegram"]["api_url"] = self.bot_api.url + "/bot"
+            if self.answer_with == "telegram":
+                # the user talks first so that the bot knows the chat, then answers the prompts
+                self.bot_api.say("/status")
+                self.bot_api.add_auto_reply("What is your password", password, self.answer_delay)
+                self.bot_api.add_auto_reply("Enter the disarm time", "0", self.answer_delay)
+        if "twilio" in self.enabled_services:
+            digits = [password] if self.answer_with == "twilio" else []
+            self.twilio_http_client = SimulatedTwilioHttpClient(digits, self.answer_delay)
+            # the simulated calls post to the local web server
+            cfg["webServer"]["external_host"] = "127.0.0.1"
+        if "email" in self.enabled_services and cfg.has_section("email"):
+            self.smtp = SmtpStub()
+            self.smtp.start()
+            cfg["email"]["smtp_server_url"] = self.smtp.url
+        if "cloudinary" in self.enabled_services and cfg.has_section("cloudinary"):
+            self.cloudinary = CloudinaryStub()
+            self.cloudinary.start()
+            cfg["cloudinary"]["upload_prefix"] = self.cloudinary.url
+        LOGGER.info("Simulating %s", ", ".join(
+            ([x for x, y in (("camera", self.camera), ("gpio", self.gpio)) if y is not None])
+            + self.enabled_services))
+
+    def get_camera(self, camera_id=None):
+        """
+        Returns the simulated camera standing in for a camera, the [camera] one being camera
+        """
+        if self.camera is None or camera_id is None:
+            return self.camera
+        if camera_id not in self.cameras:
+            self.cameras[camera_id] = SimulatedCamera(self.frames_path, fps=self.frames_fps)
+        return self.cameras[camera_id]
+
+    def start(self):
+        if self.gpio_script:
+            self.gpio.play(self.gpio_script, loop=self.gpio_script_loop)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import deque
+from threading import Event
+
+from ..alarm import AlarmState
+from ..event import events
+from ..metrics import get_rss
+from ..util import getLogger
+
+LOGGER = getLogger(__name__)
+
+
+def percentile(values, ratio):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(ratio * len(values)))]
+
+
+class SoakTest(object):
+    """
+    Runs intrusion scenarios back to back on a simulated setup: arms the alarm, pulses the
+    PIR sensor pin and waits for the simulated user to authenticate or for the alarm to go
+    off. Latencies, thread counts and memory are logged every report_interval.
+    """
+
+    def __init__(self, alarm, gpio, pin_num, camera=None, pulses=2, pulse_high_time=0.5, interval=10,
+                 timeout=60, report_interval=60):
+        self.alarm = alarm
+        self.gpio = gpio
+        self.pin_num = int(pin_num)
+        self.camera = camera
+        self.pulses = pulses
+        self.pulse_high_time = pulse_high_time
+        self.interval = interval
+        self.timeout = timeout
+        self.report_interval = report_interval
+        self.scenario_start = None
+        self.scenario_done = Event()
+        self.intrusion_latencies = deque(maxlen=10000)
+        self.auth_latencies = deque(maxlen=10000)
+        self.outcomes = {"authenticated": 0, "alarming": 0, "no_intrusion": 0}
+        self.samples = []
+        events.intrusion_detected += self.on_intrusion_detected
+        events.authentication_succeeded += self.on_authentication_succeeded
+        events.alarm_alarming += self.on_alarm_alarming
+
+    def on_intrusion_detected(self, *_):
+        if self.scenario_start is not None:
+            self.intrusion_latencies.append(time.monotonic() - self.scenario_start)
+
+    def on_authentication_succeeded(self, *_):
+        if self.scenario_start is not None and not self.scenario_done.is_set():
+            self.auth_latencies.append(time.monotonic() - self.scenario_start)
+            self.outcomes["authenticated"] += 1
+            self.scenario_done.set()
+
+    def on_alarm_alarming(self, *_):
+        if self.scenario_start is not None and not self.scenario_done.is_set():
+            self.outcomes["alarming"] += 1
+            self.scenario_done.set()
+
+    def _arm(self):
+        if self.alarm.state == AlarmState.ARMED:
+            return
+        if self.alarm.state == AlarmState.AUTHENTICATING:
+            self.alarm.update_state(AlarmState.DISABLED)
+        self.alarm.update_state(AlarmState.ARMED)
+
+    def _run_scenario(self):
+        self._arm()
+        self.scenario_done.clear()
+        intrusions_count = len(self.intrusion_latencies)
+        self.scenario_start = time.monotonic()
+        if self.camera is not None:
+            self.camera.start_motion(self.pulses)
+        self.gpio.pulse(self.pin_num, count=self.pulses, high_time=self.pulse_high_time)
+        if not self.scenario_done.wait(self.timeout):
+            if len(self.intrusion_latencies) == intrusions_count:
+                self.outcomes["no_intrusion"] += 1
+            LOGGER.warning("Scenario did not complete within %ss, alarm is %s", self.timeout, self.alarm.state)
+        self.scenario_start = None
+
+    def sample(self, elapsed):
+        self.samples.append((elapsed, threading.active_count(), get_rss()))
+
+    def report(self):
+        elapsed, threads_count, rss = self.samples[-1]
+        LOGGER.info(
+            "Soak %ds: %s, intrusion latency p50=%.2fs, authentication latency p50=%.2fs p95=%.2fs max=%.2fs,"
+            " threads=%d (max %d), rss=%.1fMB (max %.1fMB)",
+            elapsed, self.outcomes,
+            percentile(self.intrusion_latencies, 0.5), percentile(self.auth_latencies, 0.5),
+            percentile(self.auth_latencies, 0.95), max(self.auth_latencies, default=float("nan")),
+            threads_count, max(s[1] for s in self.samples),
+            rss / 1048576.0, max(s[2] for s in self.samples) / 1048576.0)
+
+    def run(self, duration):
+        """
+        Runs scenarios for duration seconds, returns the resource samples as
+        (elapsed seconds, threads count, rss bytes) tuples
+        """
+        start = time.monotonic()
+        last_report = start
+        self.sample(0)
+        while time.monotonic() - start < duration:
+            self._run_scenario()
+            now = time.monotonic()
+            if now - last_report >= self.report_interval:
+                self.sample(now - start)
+                self.report()
+                last_report = now
+            time.sleep(self.interval)
+        self.sample(time.monotonic() - start)
+        self.report()
+        return self.samples
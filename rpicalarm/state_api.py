@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+import itertools
+import json
+from collections import deque
+from threading import Condition, Lock
+
+from flask import jsonify, request, Response
+
+from .alarm import AlarmState, get_authenticator_name
+from .event import event_publishers, events
+from .fusion import get_sensor_name
+from .metrics import metrics
+from .util import getLogger, parse_duration
+from .web_server import METRICS_REALM
+
+LOGGER = getLogger(__name__)
+
+# reconnection delay advised to the stream clients
+RETRY_MILLIS = 3000
+MAX_POLL_TIMEOUT = 60
+
+EVENTS_PUBLISHED = metrics.counter("rpicalarm_api_events_published", "Events published to the API clients.",
+                                   ("event",))
+EVENTS_MISSED = metrics.counter("rpicalarm_api_events_missed",
+                                "Events overwritten before slow API clients read them.")
+
+
+def to_json(data):
+    return json.dumps(data, default=str, separators=(",", ":"))
+
+
+class EventBroadcaster(object):
+    """
+    Ring of the latest events shared by all the readers. An event is encoded once when
+    published and readers only keep the id of the last event they read, so a slow reader
+    neither holds memory nor delays the publishers: it misses the events overwritten
+    meanwhile.
+    """
+
+    def __init__(self, capacity=256):
+        self.events = deque(maxlen=capacity)
+        self.last_id = 0
+        self.condition = Condition()
+
+    def publish(self, name, data):
+        payload = to_json(data)
+        with self.condition:
+            self.last_id += 1
+            self.events.append((self.last_id, name, payload))
+            self.condition.notify_all()
+
+    def read(self, cursor, timeout=None):
+        """
+        Returns the (id, name, json data) events published after the event of id cursor
+        and the number of events missed since, waiting up to timeout seconds for one
+        """
+        with self.condition:
+            if cursor > self.last_id:
+                # id of a previous run, all the events are new to the reader
+                cursor = 0
+            self.condition.wait_for(lambda: self.last_id > cursor, timeout)
+            if self.last_id <= cursor:
+                return [], 0
+            first_id = self.events[0][0]
+            missed = max(0, first_id - cursor - 1)
+            return list(itertools.islice(self.events, max(0, cursor + 1 - first_id), None)), missed
+
+
+class StateApi(object):
+    """
+    Alarm state for dashboards: REST routes of the current state, session and cameras and
+    the state transitions, intrusions, sensor signals and authentication outcomes as a
+    Server-Sent Events stream or long polled. Events have increasing ids, a client
+    resumes after the last one it got with the Last-Event-ID header or the cursor query
+    parameter.
+    """
+
+    def __init__(self, alarm, web_server, cameras=None, buffer_size="256", keepalive_interval="15s",
+                 max_clients="16"):
+        self.alarm = alarm
+        self.cameras = [c for c in cameras or [] if c is not None]
+        self.broadcaster = EventBroadcaster(int(buffer_size))
+        self.keepalive_interval = parse_duration(keepalive_interval).total_seconds()
+        # each stream client holds a web server thread
+        self.max_clients = int(max_clients)
+        self.clients = 0
+        self.lock = Lock()
+        metrics.gauge("rpicalarm_api_stream_clients", "Clients of the events stream.", func=lambda: self.clients)
+        self._register_events_handlers()
+        web_server.add_route("/api/state", "api_state", self.handle_state, realm=METRICS_REALM)
+        web_server.add_route("/api/session", "api_session", self.handle_session, realm=METRICS_REALM)
+        web_server.add_route("/api/cameras", "api_cameras", self.handle_cameras, realm=METRICS_REALM)
+        web_server.add_route("/api/events", "api_events", self.handle_events, realm=METRICS_REALM)
+        web_server.add_route("/api/events/stream", "api_events_stream", self.handle_stream, realm=METRICS_REALM)
+
+    def _register_events_handlers(self):
+        for state in AlarmState:
+            state_event = getattr(events, "alarm_" + state.name.lower())
+            state_event += self.on_alarm_state
+        # sensors and intrusions are handed by their emitters before the handlers cause other events
+        event_publishers.append(self.on_published_event)
+        events.authentication_succeeded += self.on_authentication_succeeded
+        events.authentication_failed += self.on_authentication_failed
+        events.cluster_leader_changed += self.on_cluster_leader_changed
+
+    def publish(self, name, data):
+        # runs in the emitter thread, which must not fail because of a client
+        try:
+            self.broadcaster.publish(name, data)
+            EVENTS_PUBLISHED.labels(event=name).inc()
+        except Exception:
+            LOGGER.exception("Failed publishing event %s", name)
+
+    def on_alarm_state(self, alarm, session=None):
+        self.publish("state", {"state": str(alarm.state), "disarm_time": alarm.disarm_time,
+                               "session": session.to_dict() if session is not None else None})
+
+    def on_published_event(self, event_name, *args, **kwargs):
+        if event_name == "intrusion_detected":
+            self.on_intrusion_detected(*args, **kwargs)
+        elif event_name == "sensor_triggered":
+            self.on_sensor_triggered(*args, **kwargs)
+
+    def on_intrusion_detected(self, _origin, score, details, trace=None):
+        self.publish("intrusion", {"score": score, "sensors": sorted(details or {}), "details": details,
+                                   "trace_id": trace.id if trace is not None else None})
+
+    def on_sensor_triggered(self, sensor, confidence=1.0, details=None):
+        self.publish("sensor", {"sensor": get_sensor_name(sensor), "confidence": confidence, "details": details})
+
+    def on_authentication_succeeded(self, origin, session):
+        self.publish("authentication", {"outcome": "succeeded", "authenticator": get_authenticator_name(origin),
+                                        "session_id": session.id})
+
+    def on_authentication_failed(self, origin, session, reason):
+        self.publish("authentication", {"outcome": reason.name.lower(), "authenticator": get_authenticator_name(origin),
+                                        "session_id": session.id if session is not None else None})
+
+    def on_cluster_leader_changed(self, node, leader_id):
+        self.publish("cluster", {"node": node.node_id, "leader": leader_id})
+
+    def get_session(self):
+        session = self.alarm.current_session
+        return session.to_dict() if session is not None else None
+
+    def get_cameras(self):
+        cameras = []
+        for camera in self.cameras:
+            try:
+                cameras.append(camera.get_status())
+            except Exception:
+                LOGGER.exception("Failed getting state of camera %s", camera.camera_id)
+        return cameras
+
+    def get_state(self):
+        # read first, the events published since then are the ones after the cursor
+        cursor = self.broadcaster.last_id
+        with self.alarm.lock:
+            state = self.alarm.state
+            disarm_time = self.alarm.disarm_time
+        return {
+            "state": str(state) if state is not None else None,
+            "disarm_time": disarm_time,
+            "leader": self.alarm.is_leader,
+            "session": self.get_session(),
+            "cameras": self.get_cameras(),
+            "cursor": cursor,
+        }
+
+    def handle_state(self):
+        return jsonify(self.get_state())
+
+    def handle_session(self):
+        return jsonify(session=self.get_session())
+
+    def handle_cameras(self):
+        return jsonify(cameras=self.get_cameras())
+
+    def _get_cursor(self):
+        cursor = request.headers.get("Last-Event-ID") or request.args.get("cursor")
+        try:
+            return int(cursor) if cursor else None
+        except ValueError:
+            return None
+
+    def handle_events(self):
+        """
+        Long poll of the events after cursor, of the next ones if not set, waiting up to
+        timeout seconds
+        """
+        cursor = self._get_cursor()
+        if cursor is None:
+            cursor = self.broadcaster.last_id
+        timeout = max(0.0, min(MAX_POLL_TIMEOUT, request.args.get("timeout", 25.0, type=float)))
+        read_events, missed = self.broadcaster.read(cursor, timeout)
+        if missed:
+            EVENTS_MISSED.inc(missed)
+        # the events data are already encoded
+        body = '{{"cursor":{0},"missed":{1},"events":[{2}]}}'.format(
+            read_events[-1][0] if read_events else cursor, missed,
+            ",".join('{{"id":{0},"event":"{1}","data":{2}}}'.format(*e) for e in read_events))
+        return Response(body, mimetype="application/json")
+
+    def _on_client_closed(self):
+        with self.lock:
+            self.clients -= 1
+        LOGGER.debug("Events stream client left, %d clients", self.clients)
+
+    def handle_stream(self):
+        with self.lock:
+            if self.clients >= self.max_clients:
+                return Response("Too many events stream clients", 503, {"Retry-After": str(RETRY_MILLIS // 1000)})
+            self.clients += 1
+        try:
+            return self._create_stream_response()
+        except Exception:
+            # the response closing never comes
+            self._on_client_closed()
+            raise
+
+    def _create_stream_response(self):
+        cursor = self._get_cursor()
+        state = None
+        if cursor is None:
+            # new clients get the current state first
+            state = self.get_state()
+            cursor = state["cursor"]
+
+        def stream(cursor=cursor):
+            yield "retry: {0}\n\n".format(RETRY_MILLIS)
+            if state is not None:
+                yield "event: snapshot\ndata: {0}\n\n".format(to_json(state))
+            while True:
+                read_events, missed = self.broadcaster.read(cursor, self.keepalive_interval)
+                if missed:
+                    EVENTS_MISSED.inc(missed)
+                    yield "event: lost\ndata: {0}\n\n".format(to_json({"count": missed}))
+                if not read_events:
+                    # also finds out the clients which left
+                    yield ": keepalive\n\n"
+                    continue
+                for event_id, name, payload in read_events:
+                    yield "id: {0}\nevent: {1}\ndata: {2}\n\n".format(event_id, name, payload)
+                cursor = read_events[-1][0]
+
+        response = Response(stream(), mimetype="text/event-stream",
+                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        response.call_on_close(self._on_client_closed)
+        return response
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+import os
+import queue
+import shutil
+import time
+from collections import OrderedDict
+from threading import Lock, Thread, Timer
+
+from .event import events
+from .metrics import metrics
+from .util import getLogger, parse_duration, parse_size
+
+LOGGER = getLogger(__name__)
+
+EVICTED_FILES = metrics.counter("rpicalarm_storage_evicted_files", "Files deleted to enforce quotas by reason.",
+                                ("reason",))
+
+
+def get_file_session_id(file_name):
+    """
+    Returns the session id of a camera_<session id>_<date>[_<camera id>].jpg file name,
+    None for other files
+    """
+    elts = file_name.split("_")
+    if len(elts) < 3 or elts[0] != "camera":
+        return None
+    return elts[1]
+
+
+def get_file_camera_id(file_name):
+    """
+    Returns the camera id of a session file name, None for the files of the default camera
+    """
+    elts = os.path.splitext(file_name)[0].split("_")
+    if len(elts) < 4 or elts[0] != "camera":
+        return None
+    return elts[3]
+
+
+class StoredFile(object):
+
+    __slots__ = ("name", "size", "time")
+
+    def __init__(self, name, size, mtime):
+        self.name = name
+        self.size = size
+        self.time = mtime
+
+
+class StorageManager(object):
+    """
+    Tracks the files saved in save_path and deletes files to keep their total size under
+    max_size, the free space of the file system over min_free_size and their age under max_age.
+    Frames of a session are thinned first, their first keep_first and last keep_last frames
+    being deleted last. Files are optionally written to staging_path, e.g. on a tmpfs, and
+    committed to save_path by a background thread.
+
+    Usage is tracked from the saves and removals done through the manager, save_path is only
+    scanned when it is created.
+    """
+
+    def __init__(self, save_path, max_size="0", min_free_size="64M", max_age="0s", keep_first="3",
+                 keep_last="5", staging_path=None, staging_max_size="32M", check_interval="1m"):
+        self.save_path = save_path
+        self.max_size = parse_size(max_size)
+        self.min_free_size = parse_size(min_free_size)
+        self.max_age = parse_duration(max_age).total_seconds()
+        self.keep_first = int(keep_first)
+        self.keep_last = int(keep_last)
+        self.staging_path = staging_path
+        self.staging_max_size = parse_size(staging_max_size)
+        self.staging_size = 0
+        self.check_interval = parse_duration(check_interval).total_seconds()
+        self.lock = Lock()
+        # files by session id in saving order, files of no session under None
+        self.sessions = OrderedDict()
+        self.used_size = 0
+        self.files_count = 0
+        self.commit_queue = None
+        self.check_timer = None
+
+        for path in [save_path] + ([staging_path] if staging_path else []):
+            os.makedirs(path, exist_ok=True)
+        self._index()
+        if staging_path:
+            self.commit_queue = queue.Queue()
+            Thread(name="storage_commit", target=self._run_commits, daemon=True).start()
+
+        metrics.gauge("rpicalarm_storage_used_bytes", "Size of the saved files.", func=lambda: self.used_size)
+        metrics.gauge("rpicalarm_storage_files", "Number of saved files.", func=lambda: self.files_count)
+        metrics.gauge("rpicalarm_storage_free_bytes", "Free space of the save path file system.",
+                      func=self.get_free_size)
+        metrics.gauge("rpicalarm_storage_staged_bytes", "Size of the files waiting to be committed.",
+                      func=lambda: self.staging_size)
+        self._schedule_check()
+
+    def _index(self):
+        entries = sorted((e for e in os.scandir(self.save_path) if e.is_file() and not e.name.startswith("_")),
+                         key=lambda e: e.stat().st_mtime)
+        with self.lock:
+            for entry in entries:
+                stat = entry.stat()
+                self._add(StoredFile(entry.name, stat.st_size, stat.st_mtime))
+        LOGGER.info("Storage %s holds %d files of %d bytes", self.save_path, self.files_count, self.used_size)
+
+    def _add(self, stored_file):
+        self.sessions.setdefault(get_file_session_id(stored_file.name), []).append(stored_file)
+        self.used_size += stored_file.size
+        self.files_count += 1
+
+    def get_free_size(self):
+        return shutil.disk_usage(self.save_path).free
+
+    def save(self, file_name, data):
+        """
+        Saves the data as file_name in save_path, through the staging path if configured.
+        The file appears in save_path only once completely written. Failures are logged,
+        the capture goes on with the next files.
+        """
+        try:
+            if self.commit_queue is not None and self.staging_size + len(data) <= self.staging_max_size:
+                staged_path = os.path.join(self.staging_path, file_name)
+                with open(staged_path, "wb") as staged_file:
+                    staged_file.write(data)
+                with self.lock:
+                    self.staging_size += len(data)
+                self.commit_queue.put((file_name, len(data)))
+                return
+            # staging is full when save_path is slower than the captures, written directly
+            self._commit(file_name, data)
+        except Exception:
+            LOGGER.exception("Failed saving file %s", file_name)
+
+    def _commit(self, file_name, data=None):
+        tmp_file_path = os.path.join(self.save_path, "_{0}".format(file_name))
+        if data is None:
+            shutil.copyfile(os.path.join(self.staging_path, file_name), tmp_file_path)
+        else:
+            with open(tmp_file_path, "wb") as tmp_file:
+                tmp_file.write(data)
+        os.rename(tmp_file_path, os.path.join(self.save_path, file_name))
+        stored_file = StoredFile(file_name, os.path.getsize(os.path.join(self.save_path, file_name)), time.time())
+        with self.lock:
+            self._add(stored_file)
+        events.file_saved(self, file_name, stored_file.size)
+        self.enforce_quotas()
+
+    def _run_commits(self):
+        while True:
+            file_name, size = self.commit_queue.get()
+            try:
+                self._commit(file_name)
+            except Exception:
+                LOGGER.exception("Failed committing file %s", file_name)
+            finally:
+                try:
+                    os.unlink(os.path.join(self.staging_path, file_name))
+                except OSError:
+                    pass
+                with self.lock:
+                    self.staging_size -= size
+
+    def remove(self, file_path, reason=None):
+        """
+        Deletes a saved file, e.g. once backed up, reason being set when deleted by a quota
+        """
+        file_name = os.path.basename(file_path)
+        with self.lock:
+            files = self.sessions.get(get_file_session_id(file_name), [])
+            stored_file = next((f for f in files if f.name == file_name), None)
+            if stored_file is not None:
+                self._forget(files, stored_file)
+        try:
+            os.unlink(os.path.join(self.save_path, file_name))
+        except FileNotFoundError:
+            return
+        if reason is not None:
+            EVICTED_FILES.labels(reason=reason).inc()
+        events.file_removed(self, file_name, reason)
+
+    def remove_session(self, session_id):
+        with self.lock:
+            files = list(self.sessions.get(session_id, []))
+        for stored_file in files:
+            self.remove(stored_file.name)
+
+    def _forget(self, files, stored_file):
+        files.remove(stored_file)
+        self.used_size -= stored_file.size
+        self.files_count -= 1
+        if not files:
+            self.sessions.pop(get_file_session_id(stored_file.name), None)
+
+    def _select_thinned_files(self):
+        """
+        Returns every other middle frame of the oldest session having middle frames
+        """
+        for session_id, files in self.sessions.items():
+            if session_id is not None and len(files) > self.keep_first + self.keep_last:
+                return files[self.keep_first:len(files) - self.keep_last:2]
+        return []
+
+    def _select_oldest_file(self):
+        oldest_files = [files[0] for files in self.sessions.values() if files]
+        return [min(oldest_files, key=lambda f: f.time)] if oldest_files else []
+
+    def _get_overflow_reason(self):
+        if self.max_size and self.used_size > self.max_size:
+            return "quota"
+        if self.min_free_size and self.files_count and self.get_free_size() < self.min_free_size:
+            return "free_space"
+        return None
+
+    def enforce_quotas(self):
+        while True:
+            with self.lock:
+                reason = self._get_overflow_reason()
+                if reason is None:
+                    return
+                victims = self._select_thinned_files() or self._select_oldest_file()
+            if not victims:
+                return
+            LOGGER.info("Deleting %d files to free storage (%s)", len(victims), reason)
+            for victim in victims:
+                self.remove(victim.name, reason=reason)
+
+    def enforce_max_age(self):
+        if not self.max_age:
+            return
+        min_time = time.time() - self.max_age
+        with self.lock:
+            victims = [f for files in self.sessions.values() for f in files if f.time < min_time]
+        for victim in victims:
+            self.remove(victim.name, reason="age")
+
+    def _schedule_check(self):
+        self.check_timer = Timer(self.check_interval, self._check)
+        self.check_timer.daemon = True
+        self.check_timer.start()
+
+    def _check(self):
+        try:
+            self.enforce_max_age()
+            # the free space also shrinks with the other files of the file system
+            self.enforce_quotas()
+        except Exception:
+            LOGGER.exception("Failed enforcing storage quotas")
+        self._schedule_check()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import json
+import uuid
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+
+from .util import getLogger
+
+LOGGER = getLogger(__name__)
+
+# upper bounds in seconds of the histograms buckets, the last bucket is unbounded
+HISTOGRAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Span(object):
+    """
+    Timed step of a trace, start and end are monotonic times. Marks are spans with no duration.
+    """
+
+    __slots__ = ("trace", "name", "start", "end", "attrs")
+
+    def __init__(self, trace, name, start, end, attrs):
+        self.trace = trace
+        self.name = name
+        self.start = start
+        self.end = end
+        self.attrs = attrs
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace.id,
+            "name": self.name,
+            # offset of the span end from the trace start, the latency of the step
+            "offset_ms": round((self.end - self.trace.start_time) * 1000, 3),
+            "duration_ms": round((self.end - self.start) * 1000, 3),
+            "attrs": self.attrs,
+        }
+
+
+class Trace(object):
+    """
+    Steps of the handling of one intrusion, started at the earliest sensor evidence
+    """
+
+    def __init__(self, tracer, trace_id=None, start_time=None):
+        self.tracer = tracer
+        self.id = trace_id or str(uuid.uuid4())
+        self.start_time = monotonic() if start_time is None else start_time
+        self.marked = set()
+
+    def record(self, name, start, end=None, **attrs):
+        if self.tracer.enabled:
+            self.tracer.spans.append(Span(self, name, start, monotonic() if end is None else end, attrs))
+
+    def mark(self, name, once=False, **attrs):
+        """
+        Records the time of a step, only its first occurrence if once is set
+        """
+        if once:
+            if name in self.marked:
+                return
+            self.marked.add(name)
+        now = monotonic()
+        self.record(name, now, now, **attrs)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        start = monotonic()
+        try:
+            yield attrs
+        finally:
+            self.record(name, start, **attrs)
+
+    def __repr__(self):
+        return self.id
+
+
+class Tracer(object):
+    """
+    Keeps the latest spans in a ring buffer and the latest traces by id, so that agents
+    only knowing a session id find its trace
+    """
+
+    def __init__(self, capacity=2048, max_traces=32):
+        self.enabled = True
+        self.spans = deque(maxlen=capacity)
+        self.max_traces = max_traces
+        self.traces = OrderedDict()
+        self.lock = Lock()
+
+    def configure(self, enabled="true", capacity="2048"):
+        self.enabled = enabled.lower() == "true"
+        self.spans = deque(self.spans, maxlen=int(capacity))
+
+    def start_trace(self, start_time=None):
+        trace = Trace(self, start_time=start_time)
+        with self.lock:
+            self.traces[trace.id] = trace
+            while len(self.traces) > self.max_traces:
+                self.traces.popitem(last=False)
+        return trace
+
+    def get_trace(self, trace_id):
+        return self.traces.get(trace_id)
+
+    @contextmanager
+    def span(self, trace_id, name, **attrs):
+        """
+        Records a span of the trace of trace_id, if any
+        """
+        trace = self.traces.get(trace_id)
+        if trace is None:
+            yield attrs
+            return
+        with trace.span(name, **attrs):
+            yield attrs
+
+    def export_spans(self, trace_id=None):
+        return [s.to_dict() for s in list(self.spans) if trace_id is None or s.trace.id == trace_id]
+
+    def export_json(self, trace_id=None):
+        return json.dumps(self.export_spans(trace_id))
+
+    def histograms(self):
+        """
+        Returns per span name the count of spans ending within each bucket of time
+        since the start of their trace, bucket upper bounds being HISTOGRAM_BUCKETS
+        """
+        histograms = {}
+        for span in list(self.spans):
+            counts = histograms.setdefault(span.name, [0] * (len(HISTOGRAM_BUCKETS) + 1))
+            offset = span.end - span.trace.start_time
+            counts[next((i for i, b in enumerate(HISTOGRAM_BUCKETS) if offset <= b), len(HISTOGRAM_BUCKETS))] += 1
+        labels = ["le_{0}".format(b) for b in HISTOGRAM_BUCKETS] + ["inf"]
+        return {name: dict(zip(labels, counts)) for name, counts in histograms.items()}
+
+
+tracer = Tracer()
@@ -5,11 +5,14 @@ import math
 import types
 import sys
 import re
+import time
 from datetime import timedelta
 from functools import wraps
-from threading import Thread
+from threading import Thread, Lock
 
-duration_regex = re.compile(r'((?P<hours>\d+?)h)?((?P<minutes>\d+?)m)?((?P<seconds>\d+?)s)?')
+duration_regex = re.compile(r'((?P<hours>\d+?)h)?((?P<minutes>\d+?)m)?((?P<seconds>\d+(\.\d+)?)s)?')
+size_regex = re.compile(r'^(?P<value>\d+(\.\d+)?)\s*(?P<unit>[kKmMgG]?)B?$')
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
 
 
 def run_async(func):
@@ -25,6 +28,49 @@ def run_async(func):
 
     return async_func
 
+class TokenBucket(object):
+    """
+    Token bucket rate limiter refilled continuously at rate tokens per second.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def try_consume(self, tokens=1):
+        """
+        Consumes tokens if available and returns 0, otherwise returns the number
+        of seconds to wait before they are.
+        """
+        with self.lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    def consume(self, tokens=1, stop_event=None):
+        """
+        Blocks until tokens are available, returns False if stop_event got set while waiting.
+        """
+        while True:
+            wait_time = self.try_consume(tokens)
+            if not wait_time:
+                return True
+            if stop_event is None:
+                time.sleep(wait_time)
+            elif stop_event.wait(wait_time):
+                return False
+
+
 def human_time(*args, **kwargs):
     secs  = float(timedelta(*args, **kwargs).total_seconds())
     units = [("day", 86400), ("hour", 3600), ("minute", 60), ("second", 1)]
@@ -47,10 +93,20 @@ def parse_duration(time_str):
     time_params = {}
     for (name, param) in parts.items():
         if param:
-            time_params[name] = int(param)
+            time_params[name] = float(param) if name == "seconds" else int(param)
     return timedelta(**time_params)
 
 
+def parse_size(size_str):
+    """
+    Returns the bytes of a size string like 512M, 1.5G, 100k or 4096
+    """
+    parts = size_regex.match(size_str.strip())
+    if not parts:
+        raise Exception("Invalid size string {0}".format(size_str))
+    return int(float(parts.group("value")) * SIZE_UNITS[parts.group("unit").lower()])
+
+
 def time_seconds_to_duration_str(a_time):
     return str(timedelta(seconds=a_time))
 
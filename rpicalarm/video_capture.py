@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import time
+from threading import Condition, Thread
+
+import cv2
+
+from .util import getLogger
+
+LOGGER = getLogger(__name__)
+
+
+class VideoCaptureCamera(object):
+    """
+    Stands in for picamera.PiCamera with an OpenCV VideoCapture, e.g. a V4L2 USB webcam.
+    A grabber thread keeps dequeuing the device frames and only decodes the ones waited
+    for, so that a capture gets a fresh frame rather than one buffered by the driver.
+    VideoCapture is not thread safe, the grabber thread is the only one reading the device
+    once started. The device has no ports, all the captures read the same frames, and it
+    does not record video.
+    """
+
+    def __init__(self, device="/dev/video0", api=cv2.CAP_V4L2):
+        self.vflip = False
+        self.hflip = False
+        self.led = False
+        self.awb_mode = 'auto'
+        self.exposure_mode = 'auto'
+        self.device = int(device) if str(device).isdigit() else device
+        self.capture_device = cv2.VideoCapture(self.device, api)
+        if not self.capture_device.isOpened():
+            raise Exception("Could not open video device {0}".format(device))
+        # compressed frames use less USB bandwidth, a single buffer keeps them fresh
+        self.capture_device.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+        self.capture_device.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        self._resolution = (int(self.capture_device.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                            int(self.capture_device.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self._framerate = self.capture_device.get(cv2.CAP_PROP_FPS) or 30
+        self.grab_seq = 0
+        self.frame = None
+        self.frame_seq = 0
+        self.waiting_count = 0
+        self.cond = Condition()
+        self.closed = False
+        # started on the first capture, once the resolution and frame rate are set
+        self.thread = None
+
+    @property
+    def resolution(self):
+        return self._resolution
+
+    @resolution.setter
+    def resolution(self, resolution):
+        self.capture_device.set(cv2.CAP_PROP_FRAME_WIDTH, resolution[0])
+        self.capture_device.set(cv2.CAP_PROP_FRAME_HEIGHT, resolution[1])
+        # the device picks the closest resolution it supports
+        self._resolution = (int(self.capture_device.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                            int(self.capture_device.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        if tuple(self._resolution) != tuple(resolution):
+            LOGGER.info("Video device %s resolution is %s instead of %s", self.device, self._resolution, resolution)
+
+    @property
+    def framerate(self):
+        return self._framerate
+
+    @framerate.setter
+    def framerate(self, framerate):
+        self.capture_device.set(cv2.CAP_PROP_FPS, framerate)
+        self._framerate = self.capture_device.get(cv2.CAP_PROP_FPS) or framerate
+
+    def _grab_loop(self):
+        while not self.closed:
+            # paced by the device frame rate
+            if not self.capture_device.grab():
+                LOGGER.error("Failed grabbing frame of video device %s, retrying", self.device)
+                time.sleep(1)
+                continue
+            with self.cond:
+                self.grab_seq += 1
+                seq = self.grab_seq
+                if not self.waiting_count:
+                    continue
+            ok, frame = self.capture_device.retrieve()
+            if not ok:
+                LOGGER.error("Failed decoding frame of video device %s", self.device)
+                continue
+            with self.cond:
+                self.frame = frame
+                self.frame_seq = seq
+                self.cond.notify_all()
+
+    def _read(self):
+        """
+        Returns a frame grabbed after the call
+        """
+        with self.cond:
+            if self.thread is None:
+                self.thread = Thread(name="video_capture", target=self._grab_loop, daemon=True)
+                self.thread.start()
+            min_seq = self.grab_seq + 1
+            self.waiting_count += 1
+            try:
+                if not self.cond.wait_for(lambda: self.frame_seq >= min_seq or self.closed, 10):
+                    raise Exception("No frame from video device {0}".format(self.device))
+            finally:
+                self.waiting_count -= 1
+            if self.closed:
+                raise Exception("Video device {0} is closed".format(self.device))
+            return self.frame
+
+    def _write(self, output, frame, resize, image_format):
+        if self.vflip:
+            frame = cv2.flip(frame, 0)
+        if self.hflip:
+            frame = cv2.flip(frame, 1)
+        if resize is not None and (frame.shape[1], frame.shape[0]) != tuple(resize):
+            frame = cv2.resize(frame, tuple(resize), interpolation=cv2.INTER_AREA)
+        ok, data = cv2.imencode("." + ("jpg" if image_format in ("jpeg", "mjpeg") else image_format), frame)
+        if not ok:
+            raise Exception("Could not encode frame as {0}".format(image_format))
+        if isinstance(output, str):
+            with open(output, "wb") as output_file:
+                output_file.write(data.tobytes())
+        else:
+            output.write(data.tobytes())
+
+    def capture(self, output, format="jpeg", use_video_port=False, resize=None, splitter_port=0, **_):
+        # pylint: disable=redefined-builtin,unused-argument
+        self._write(output, self._read(), resize, format)
+
+    def capture_continuous(self, output, format="jpeg", use_video_port=False, resize=None, splitter_port=0, **_):
+        # pylint: disable=redefined-builtin,unused-argument
+        while True:
+            self._write(output, self._read(), resize, format)
+            yield output
+
+    def start_recording(self, output, format="h264", splitter_port=1, **_):
+        # pylint: disable=redefined-builtin,unused-argument
+        raise Exception("Video device {0} does not record {1} video".format(self.device, format))
+
+    def stop_recording(self, splitter_port=1):
+        raise Exception("Video device {0} is not recording".format(self.device))
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(2)
+        self.capture_device.release()
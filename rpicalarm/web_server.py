@@ -2,51 +2,97 @@
 
 from threading import Timer
 
-from flask import Flask, request, Response
+from flask import Flask, jsonify, request, Response
 
-from . import network_utils, getLogger, run_async
+from . import network_utils, getLogger, run_async, tracer, metrics, log_ring
 
 
 LOGGER = getLogger(__name__)
 
+DEFAULT_REALM = "Login Required"
+METRICS_REALM = "Metrics"
+
 
 class WebServer(object):
 
-    def __init__(self, port=3000, log_dir="/var/log/rpicalarm", auth_username=None, auth_password=None):
+    def __init__(self, port=3000, log_dir="/var/log/rpicalarm", auth_username=None, auth_password=None,
+                 external_host=None, metrics_username=None, metrics_password=None):
         self.port = port
         self.log_dir = log_dir
         self.auth_username = auth_username
         self.auth_password = auth_password
+        # monitoring routes have their own credentials, the services ones if not configured
+        self.realms_credentials = {
+            DEFAULT_REALM: (auth_username, auth_password),
+            METRICS_REALM: (metrics_username or auth_username, metrics_password or auth_password),
+        }
         self.external_ip = None
         self.external_ip_update_running = False
         self.app = Flask(".".join(__name__.split(".")[:-1]))
+        self.add_route("/metrics", "metrics", self.handle_metrics, realm=METRICS_REALM)
+        self.add_route("/traces", "traces", self.handle_traces, realm=METRICS_REALM)
+        self.add_route("/traces/histograms", "traces_histograms", self.handle_traces_histograms, realm=METRICS_REALM)
+        self.add_route("/logs", "logs", self.handle_logs, realm=METRICS_REALM)
+
+        if external_host:
+            # host is fixed, no need to look up the external ip
+            self.external_ip = external_host
+        else:
+            # looked up in the background, the lookup may take up to its 20s timeout
+            self.start_external_ip_updater()
+
+    def add_realm(self, realm, username, password):
+        """
+        Adds the credentials of the routes of realm
+        """
+        self.realms_credentials[realm] = (username, password)
 
-        self.start_external_ip_updater()
-
-    def check_auth(self, username, password):
+    def check_auth(self, username, password, realm=DEFAULT_REALM):
         """This function is called to check if a username /
         password combination is valid.
         """
+        auth_username, auth_password = self.realms_credentials[realm]
         LOGGER.debug("Configured username=%s,password=%s; received username=%s,password=%s",
-                     self.auth_username, self.auth_password, username, password)
-        return username == self.auth_username and password == self.auth_password
+                     auth_username, auth_password, username, password)
+        return username == auth_username and password == auth_password
 
-    def add_route(self, route, route_name, handler, **kwargs):
-        self.app.add_url_rule(route, route_name, self.basic_auth_decorate(handler), **kwargs)
+    def add_route(self, route, route_name, handler, basic_auth=True, realm=DEFAULT_REALM, **kwargs):
+        if basic_auth:
+            handler = self.basic_auth_decorate(handler, realm)
+        self.app.add_url_rule(route, route_name, handler, **kwargs)
 
-    def basic_auth_decorate(self, handler):
+    def basic_auth_decorate(self, handler, realm=DEFAULT_REALM):
 
         def basic_auth_decorated(*args, **kwargs):
             auth = request.authorization
-            if not auth or not self.check_auth(auth.username, auth.password):
+            if not auth or not self.check_auth(auth.username, auth.password, realm):
                 LOGGER.debug("Not authenticated")
                 return Response(
                     'Could not verify your access level for that URL.\n'
                     'You have to login with proper credentials', 401,
-                    {'WWW-Authenticate': 'Basic realm="Login Required"'})
+                    {'WWW-Authenticate': 'Basic realm="{0}"'.format(realm)})
             return handler(*args, **kwargs)
         return basic_auth_decorated
 
+    def handle_metrics(self):
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    def handle_traces(self):
+        """
+        Latest spans, of the trace_id query parameter trace only if given
+        """
+        return Response(tracer.export_json(request.args.get("trace_id")), mimetype="application/json")
+
+    def handle_traces_histograms(self):
+        return jsonify(tracer.histograms())
+
+    def handle_logs(self):
+        """
+        Latest log records kept in memory
+        """
+        return Response(log_ring.dump(), mimetype="text/plain")
+
+    @run_async
     def start_external_ip_updater(self):
         if self.external_ip_update_running:
             return
@@ -76,4 +122,6 @@ class WebServer(object):
 
     @property
     def auth_base_url(self):
+        if self.external_ip is None:
+            LOGGER.warning("External ip is not known yet")
         return "http://{2}:{3}@{0}:{1}".format(self.external_ip, self.port, self.auth_username, self.auth_password)
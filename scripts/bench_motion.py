@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Runs a motion detector over a labeled dataset of recorded frames and reports its throughput,
+per stage timings, peak memory and precision/recall.
+
+The dataset is a directory of images or a video file. Labels are read from a CSV file of
+<frame name>,<0|1> lines, 1 meaning the frame shows motion; frame names are the image file
+names or the frame indexes of a video.
+"""
+import argparse
+import csv
+import importlib
+import os
+import resource
+import sys
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint: disable=wrong-import-position
+from rpicalarm.frame_source import ReplayFrameSource
+from rpicalarm.motion import MotionAnalyzer
+
+
+class StageTimer(object):
+
+    def __init__(self):
+        self.timings = OrderedDict()
+
+    def wrap(self, stage, func):
+        self.timings.setdefault(stage, 0.0)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.timings[stage] += time.perf_counter() - start
+        return timed
+
+
+def timed_motion_analyzer(timer, min_area):
+    analyzer = MotionAnalyzer(min_area=min_area)
+    for stage in ("resize", "blur", "diff", "contours"):
+        setattr(analyzer, stage, timer.wrap(stage, getattr(analyzer, stage)))
+    return analyzer
+
+
+DETECTORS = {
+    "motion": timed_motion_analyzer,
+}
+
+
+def load_detector(name, timer, min_area):
+    """
+    Detectors are the ones of DETECTORS or a module:Class path of a class taking no
+    argument with an analyze(frame) method returning a result with boxes or None
+    """
+    if name in DETECTORS:
+        return DETECTORS[name](timer, min_area)
+    module_name, class_name = name.split(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+def load_labels(labels_path):
+    with open(labels_path) as labels_file:
+        return {row[0]: row[1].strip() == "1" for row in csv.reader(labels_file) if row and not row[0].startswith("#")}
+
+
+def parse_arguments():
+    arg_parser = argparse.ArgumentParser(description='Motion detector benchmark.')
+    arg_parser.add_argument('dataset', help='Directory of images or video file.')
+    arg_parser.add_argument('-l', '--labels', help='CSV file of frame labels.')
+    arg_parser.add_argument('-d', '--detector', help='Detector name or module:Class.', default='motion')
+    arg_parser.add_argument('-s', '--size', help='Frame size fed to the detector.', default='320x240')
+    arg_parser.add_argument('-a', '--min_area', help='Min moving area.', type=int, default=500)
+    return arg_parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    size = tuple([int(x) for x in args.size.split('x')])
+    timer = StageTimer()
+    source = ReplayFrameSource(args.dataset)
+    names = source.names
+    read = timer.wrap("decode", source.read)
+    detector = load_detector(args.detector, timer, args.min_area)
+    labels = load_labels(args.labels) if args.labels else {}
+
+    true_positives = false_positives = false_negatives = 0
+    frames_count = 0
+    start = time.perf_counter()
+    while True:
+        frame = read(size)
+        if frame is None:
+            break
+        result = detector.analyze(frame)
+        detected = result is not None and bool(result.boxes)
+        name = names[frames_count] if frames_count < len(names) else str(frames_count)
+        frames_count += 1
+        if name in labels:
+            true_positives += detected and labels[name]
+            false_positives += detected and not labels[name]
+            false_negatives += not detected and labels[name]
+    elapsed = time.perf_counter() - start
+    source.close()
+
+    print("frames:    {0}".format(frames_count))
+    print("fps:       {0:.1f}".format(frames_count / elapsed if elapsed else 0))
+    for stage, stage_time in timer.timings.items():
+        print("{0:<10} {1:8.3f} ms/frame".format(stage + ":", 1000 * stage_time / max(1, frames_count)))
+    # ru_maxrss is in kilobytes on Linux
+    print("peak RSS:  {0:.1f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    if labels:
+        precision = true_positives / float(true_positives + false_positives) if true_positives + false_positives else 0
+        recall = true_positives / float(true_positives + false_negatives) if true_positives + false_negatives else 0
+        print("precision: {0:.3f}".format(precision))
+        print("recall:    {0:.3f}".format(recall))
+
+
+if __name__ == "__main__":
+    main()
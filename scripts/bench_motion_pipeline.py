@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Measures the motion analysis throughput of the process pipeline for several worker counts,
+over recorded frames (a directory of JPEG files) or synthetic ones.
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+from threading import Event
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint: disable=wrong-import-position
+from rpicalarm.motion import MotionAnalyzer
+from rpicalarm.motion_pipeline import MotionPipeline
+
+
+def parse_arguments():
+    arg_parser = argparse.ArgumentParser(description='Motion pipeline throughput benchmark.')
+    arg_parser.add_argument('-f', '--frames', help='Directory of recorded JPEG frames.')
+    arg_parser.add_argument('-s', '--size', help='Frame size.', default='320x240')
+    arg_parser.add_argument('-n', '--count', help='Number of frames to analyze.', type=int, default=500)
+    arg_parser.add_argument('-w', '--workers', help='Worker counts to benchmark.', default='1,2,3,4')
+    return arg_parser.parse_args()
+
+
+def load_frames(frames_dir, size, count):
+    frames = []
+    if frames_dir:
+        for image_path in sorted(Path(frames_dir).glob("*.jpg")):
+            frames.append(cv2.resize(cv2.imread(str(image_path)), size, interpolation=cv2.INTER_AREA))
+        if not frames:
+            raise Exception("No jpg frames found in {0}".format(frames_dir))
+    else:
+        rng = np.random.RandomState(0)
+        background = rng.randint(0, 255, (size[1], size[0], 3)).astype(np.uint8)
+        for i in range(min(count, 100)):
+            frame = background.copy()
+            x = (i * 7) % (size[0] - 60)
+            cv2.rectangle(frame, (x, size[1] // 4), (x + 60, size[1] // 2), (255, 255, 255), -1)
+            frames.append(frame)
+    return [frames[i % len(frames)] for i in range(count)]
+
+
+def bench_inline(frames):
+    analyzer = MotionAnalyzer()
+    start = time.monotonic()
+    for frame in frames:
+        analyzer.analyze(frame)
+    return len(frames) / (time.monotonic() - start)
+
+
+def bench_pipeline(frames, workers):
+    done = Event()
+    results = []
+
+    def on_result(_seq, result):
+        results.append(result)
+        if len(results) == len(frames):
+            done.set()
+
+    pipeline = MotionPipeline(frames[0].shape, on_result, workers=workers)
+    pipeline.start()
+    # warm up the worker processes
+    pipeline.submit(frames[0], block=True)
+    while not results:
+        time.sleep(0.01)
+    results.clear()
+    start = time.monotonic()
+    for frame in frames:
+        pipeline.submit(frame, block=True)
+    done.wait()
+    fps = len(frames) / (time.monotonic() - start)
+    pipeline.stop()
+    return fps
+
+
+def main():
+    args = parse_arguments()
+    size = tuple([int(x) for x in args.size.split('x')])
+    frames = load_frames(args.frames, size, args.count)
+    inline_fps = bench_inline(frames)
+    print("{0:>8} {1:>10} {2:>8}".format("workers", "fps", "scaling"))
+    print("{0:>8} {1:>10.1f} {2:>8.2f}".format("inline", inline_fps, 1.0))
+    for workers in [int(x) for x in args.workers.split(",")]:
+        fps = bench_pipeline(frames, workers)
+        print("{0:>8} {1:>10.1f} {2:>8.2f}".format(workers, fps, fps / inline_fps))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Reports the startup time of the alarm daemon.
+
+The import time of the rpicalarm package and of each agent module is broken down by top
+level package from the output of python -X importtime, each import running in a fresh
+interpreter. With a config file, the daemon is also started and the time until the alarm
+is armed and until all the agents are started is read from its log.
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+sys.path.insert(0, ROOT_DIR)
+
+# pylint: disable=wrong-import-position
+from rpicalarm.agents import AGENTS
+
+IMPORT_TIME_REGEX = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+ALARM_STARTED_REGEX = re.compile(r"Alarm started in")
+AGENTS_STARTED_REGEX = re.compile(r"Agents .* started in")
+
+
+def measure_import(python, module_name):
+    """
+    Returns the self import time in seconds of each module imported by module_name
+    """
+    proc = subprocess.run([python, "-X", "importtime", "-c", "import " + module_name],
+                          cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=False)
+    if proc.returncode != 0:
+        raise Exception("Failed importing {0}: {1}".format(module_name, proc.stderr.strip().splitlines()[-1]))
+    modules = {}
+    for line in proc.stderr.splitlines():
+        match = IMPORT_TIME_REGEX.match(line)
+        if match:
+            modules[match.group(4)] = int(match.group(1)) / 1e6
+    return modules
+
+
+def group_by_package(modules):
+    packages = defaultdict(float)
+    for name, self_time in modules.items():
+        packages[name.split(".")[0]] += self_time
+    return sorted(packages.items(), key=lambda x: x[1], reverse=True)
+
+
+def print_imports(python, top):
+    base_modules = measure_import(python, "rpicalarm")
+    print("rpicalarm: {0:.3f}s".format(sum(base_modules.values())))
+    for package, package_time in group_by_package(base_modules)[:top]:
+        print("  {0:<24} {1:.3f}s".format(package, package_time))
+    for name, (module_name, _, _) in AGENTS.items():
+        try:
+            modules = measure_import(python, "rpicalarm.agents." + module_name)
+        except Exception as ex:
+            print("{0}: {1}".format(name, ex))
+            continue
+        # modules already imported by the rpicalarm package are not the agent ones
+        own_modules = {k: v for k, v in modules.items() if k not in base_modules}
+        print("{0}: {1:.3f}s".format(name, sum(own_modules.values())))
+        for package, package_time in group_by_package(own_modules)[:top]:
+            print("  {0:<24} {1:.3f}s".format(package, package_time))
+
+
+def measure_daemon(python, cli, config, data_file, timeout):
+    """
+    Returns the times in seconds from the process start until the alarm is armed and
+    until the agents are started
+    """
+    start = time.monotonic()
+    proc = subprocess.Popen([python, cli, "-c", config, "-s", data_file], cwd=ROOT_DIR,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    alarm_time = agents_time = None
+    try:
+        for line in proc.stdout:
+            if alarm_time is None and ALARM_STARTED_REGEX.search(line):
+                alarm_time = time.monotonic() - start
+            elif AGENTS_STARTED_REGEX.search(line):
+                agents_time = time.monotonic() - start
+                break
+            if time.monotonic() - start > timeout:
+                break
+    finally:
+        proc.kill()
+        proc.wait()
+    return alarm_time, agents_time
+
+
+def parse_arguments():
+    arg_parser = argparse.ArgumentParser(description='Daemon startup benchmark.')
+    arg_parser.add_argument('-c', '--config', help='Config file the daemon is started with, imports only if not set.')
+    arg_parser.add_argument('-s', '--data_file', help='Data file of the daemon.', default='/tmp/rpicalarm-bench.json')
+    arg_parser.add_argument('-n', '--runs', help='Number of daemon starts.', type=int, default=3)
+    arg_parser.add_argument('-t', '--top', help='Number of packages listed per import.', type=int, default=5)
+    arg_parser.add_argument('--timeout', help='Max startup time in seconds.', type=float, default=60)
+    arg_parser.add_argument('--python', help='Python interpreter.', default=sys.executable)
+    arg_parser.add_argument('--cli', help='Daemon script.', default=os.path.join(ROOT_DIR, 'rpicalarm-cli.py'))
+    return arg_parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    print_imports(args.python, args.top)
+    if not args.config:
+        return
+
+    alarm_times = []
+    agents_times = []
+    for _ in range(args.runs):
+        if os.path.exists(args.data_file):
+            # the alarm starts armed
+            os.unlink(args.data_file)
+        alarm_time, agents_time = measure_daemon(args.python, args.cli, args.config, args.data_file, args.timeout)
+        if alarm_time is None or agents_time is None:
+            print("daemon did not start within {0}s".format(args.timeout))
+            return
+        alarm_times.append(alarm_time)
+        agents_times.append(agents_time)
+    print("armed:     {0:.2f}s (median of {1})".format(statistics.median(alarm_times), args.runs))
+    print("agents:    {0:.2f}s (median of {1})".format(statistics.median(agents_times), args.runs))
+
+
+if __name__ == "__main__":
+    main()
@@ -29,7 +29,8 @@ setup(
     long_description=open('README.md', encoding='utf-8').read(),
     packages=[
         'rpicalarm',
-        'rpicalarm/agents'
+        'rpicalarm/agents',
+        'rpicalarm/simulators'
     ],
     scripts=['rpicalarm-cli.py'],
     data_files=[
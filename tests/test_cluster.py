@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import socket
+import time
+from time import monotonic
+
+import pytest
+import urllib3
+
+from rpicalarm import Alarm, AlarmState, events
+from rpicalarm.cluster import CLUSTER_USERNAME, INTRUSIONS, ClusterNode, ClusterPeer
+from rpicalarm.web_server import WebServer
+
+SECRET = "s3cret"
+# short enough for the test to run in seconds, long enough for a loaded machine
+NODE_TIMINGS = {"heartbeat_interval": "0.2s", "node_timeout": "2s", "forward_timeout": "1s"}
+WAIT_TIMEOUT = 15
+
+
+def free_port(kind=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FollowingAlarm(object):
+    """
+    Stands in for the alarm of a node, records its leadership and the states it follows
+    """
+
+    def __init__(self):
+        self.state = AlarmState.ARMED
+        self.intrusion_forwarder = None
+        self.is_leader = None
+        self.followed_states = []
+
+    def set_leader(self, is_leader):
+        self.is_leader = is_leader
+
+    def follow_state(self, state):
+        self.followed_states.append(state)
+        self.state = state
+
+
+@pytest.fixture
+def cluster_nodes(tmp_path):
+    nodes = []
+
+    def create(node_id, priority=0):
+        web_server = WebServer(port=free_port(), log_dir=str(tmp_path), external_host="127.0.0.1")
+        node = ClusterNode(FollowingAlarm(), web_server, secret=SECRET, node_id=node_id, priority=str(priority),
+                           **NODE_TIMINGS)
+        # the discovery is over, elections are not postponed
+        node.start_time = monotonic() - 10
+        nodes.append(node)
+        return node
+    yield create
+    for node in nodes:
+        for state in AlarmState:
+            state_event = getattr(events, "alarm_" + state.name.lower())
+            state_event -= node.on_alarm_state
+
+
+def add_peer(node, node_id, priority=0, leading=False, age=0):
+    peer = node.peers[node_id] = ClusterPeer(node_id)
+    peer.update("127.0.0.1", 3000, priority, leading)
+    peer.last_seen -= age
+    return peer
+
+
+def test_elect_highest_priority_then_highest_node_id(cluster_nodes):
+    node = cluster_nodes("b", priority=0)
+    add_peer(node, "a", priority=1)
+    add_peer(node, "c", priority=1)
+    node._elect()
+
+    assert node.leader_id == "c"
+    assert node.alarm.is_leader is False
+
+
+def test_elect_keeps_leading_peer(cluster_nodes):
+    # a node of higher priority joining later follows the leader
+    node = cluster_nodes("z", priority=5)
+    add_peer(node, "a", leading=True)
+    node._elect()
+
+    assert node.leader_id == "a"
+
+
+def test_elect_lowest_of_two_leaders_steps_down(cluster_nodes):
+    node = cluster_nodes("b", priority=0)
+    node.leader_id = "b"
+    add_peer(node, "a", priority=1, leading=True)
+    node._elect()
+
+    assert node.leader_id == "a"
+    assert node.alarm.is_leader is False
+
+    other_node = cluster_nodes("b", priority=1)
+    other_node.leader_id = "b"
+    add_peer(other_node, "a", priority=0, leading=True)
+    other_node._elect()
+
+    assert other_node.leader_id == "b"
+
+
+def test_elect_drops_timed_out_leader(cluster_nodes):
+    node = cluster_nodes("a")
+    node.leader_id = "b"
+    add_peer(node, "b", priority=1, leading=True, age=3)
+    node._elect()
+
+    assert node.peers == {}
+    assert node.leader_id == "a"
+    assert node.alarm.is_leader is True
+
+
+def test_no_election_during_discovery(cluster_nodes):
+    node = cluster_nodes("a")
+    node.start_time = monotonic()
+    add_peer(node, "b")
+    node._elect()
+
+    assert node.leader_id is None
+
+
+def test_apply_state_in_epoch_and_seq_order(cluster_nodes):
+    node = cluster_nodes("b")
+    add_peer(node, "a", priority=1)
+    node._elect()
+    for version in ((1, 1), (1, 1), (1, 0), (2, 0), (1, 9), (2, 1)):
+        node._apply_state("a", "DISARMED" if version[1] % 2 else "ARMED", *version)
+    # a node that is not the leader is ignored
+    node._apply_state("c", "DISABLED", 3, 0)
+
+    # the repeated and older changes were dropped, the restarted leader numbering from 0 was followed
+    assert node.alarm.followed_states == [AlarmState.DISARMED, AlarmState.ARMED, AlarmState.DISARMED]
+    assert node.applied == ("a", (2, 1))
+
+
+def test_state_pushed_to_cluster_state_route(cluster_nodes):
+    node = cluster_nodes("b")
+    add_peer(node, "a", priority=1)
+    node._elect()
+    client = node.web_server.app.test_client()
+    message = {"node": "a", "state": "DISARMED", "epoch": 1, "seq": 1}
+
+    response = client.post("/cluster/state", json=message,
+                           headers=urllib3.make_headers(basic_auth="{0}:{1}".format(CLUSTER_USERNAME, SECRET)))
+    assert response.status_code == 200
+    assert response.get_json() == {"node": "b", "state": "DISARMED"}
+
+    message["state"] = "DISABLED"
+    response = client.post("/cluster/state", json=message,
+                           headers=urllib3.make_headers(basic_auth="{0}:wrong".format(CLUSTER_USERNAME)))
+    assert response.status_code == 401
+    assert node.alarm.followed_states == [AlarmState.DISARMED]
+
+
+def run_node(node_id, priority, multicast_port, data_dir, commands, replies):
+    """
+    Runs a cluster node the way the cli does, in its own process, and answers the test commands
+    """
+    alarm = Alarm(os.path.join(data_dir, node_id + ".json"), max_auth_time="60s")
+    web_server = WebServer(port=free_port(), log_dir=data_dir, external_host="127.0.0.1")
+    node = ClusterNode(alarm, web_server, secret=SECRET, node_id=node_id, priority=str(priority),
+                       multicast_port=str(multicast_port), advertise_host="127.0.0.1", **NODE_TIMINGS)
+    alarm.start()
+    web_server.start()
+    node.start()
+    while True:
+        command, arg = commands.get()
+        if command == "status":
+            replies.put({"leader": node.leader_id, "state": str(alarm.state), "intrusions": {
+                outcome: INTRUSIONS.labels(outcome=outcome).value for outcome in ("forwarded", "received", "failed")}})
+        elif command == "update_state":
+            replies.put(alarm.update_state(arg))
+        elif command == "intrusion":
+            events.intrusion_detected(None, 1.0, {"pirsensor": 1.0}, None)
+            replies.put(None)
+
+
+class NodeProcess(object):
+
+    def __init__(self, context, node_id, priority, multicast_port, data_dir):
+        self.node_id = node_id
+        self.commands = context.Queue()
+        self.replies = context.Queue()
+        self.process = context.Process(target=run_node, name="node_" + node_id, daemon=True,
+                                       args=(node_id, priority, multicast_port, data_dir, self.commands, self.replies))
+        self.process.start()
+
+    def call(self, command, arg=None):
+        self.commands.put((command, arg))
+        return self.replies.get(timeout=WAIT_TIMEOUT)
+
+    def status(self):
+        return self.call("status")
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+
+
+def wait_until(predicate):
+    deadline = monotonic() + WAIT_TIMEOUT
+    while not predicate():
+        if monotonic() > deadline:
+            raise AssertionError("Condition not met within {0}s".format(WAIT_TIMEOUT))
+        time.sleep(0.1)
+
+
+@pytest.fixture
+def node_processes(tmp_path):
+    """
+    Starts nodes in their own processes, on a multicast port of their own
+    """
+    context = multiprocessing.get_context("spawn")
+    multicast_port = free_port(socket.SOCK_DGRAM)
+    nodes = []
+
+    def start(node_id, priority=0):
+        node = NodeProcess(context, node_id, priority, multicast_port, str(tmp_path))
+        nodes.append(node)
+        return node
+    yield start
+    for node in nodes:
+        node.kill()
+
+
+def test_followers_mirror_the_leader_and_forward_intrusions(node_processes):
+    leader = node_processes("a", 2)
+    wait_until(lambda: leader.status()["leader"] == "a")
+    followers = [node_processes("b", 1), node_processes("c", 0)]
+    nodes = [leader] + followers
+
+    wait_until(lambda: [n.status()["leader"] for n in nodes] == ["a", "a", "a"])
+    assert leader.call("update_state", "DISARMED")
+    wait_until(lambda: [n.status()["state"] for n in nodes] == ["DISARMED"] * 3)
+    assert leader.call("update_state", "ARMED")
+    wait_until(lambda: [n.status()["state"] for n in nodes] == ["ARMED"] * 3)
+
+    followers[1].call("intrusion")
+    wait_until(lambda: [n.status()["state"] for n in nodes] == ["AUTHENTICATING"] * 3)
+    assert leader.status()["intrusions"]["received"] == 1
+    assert followers[1].status()["intrusions"] == {"forwarded": 1, "received": 0, "failed": 0}
+
+
+def test_follower_handles_intrusion_when_leader_gone(node_processes):
+    leader = node_processes("a", 1)
+    wait_until(lambda: leader.status()["leader"] == "a")
+    follower = node_processes("b", 0)
+    wait_until(lambda: follower.status()["leader"] == "a")
+
+    # the follower has not noticed yet, the forward fails
+    leader.kill()
+    follower.call("intrusion")
+    wait_until(lambda: follower.status()["state"] == "AUTHENTICATING")
+    assert follower.status()["intrusions"]["failed"] == 1
+    # then it leads once the leader timed out
+    wait_until(lambda: follower.status()["leader"] == "b")
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import io
+import time
+
+import pytest
+from PIL import Image
+
+from rpicalarm.agents.email import Emailer
+from rpicalarm.simulators.services import SmtpStub
+
+# a local SMTP server takes a few milliseconds, the bound leaves room for a loaded machine
+MAX_DELIVERY_SECONDS = 1.0
+
+
+@pytest.fixture
+def smtp():
+    stub = SmtpStub()
+    stub.start()
+    yield stub
+    stub.stop()
+
+
+@pytest.fixture
+def emailer(smtp):
+    instance = Emailer(from_email="alarm@example.com", to_email="owner@example.com", smtp_server_url=smtp.url,
+                       digest_window="1s", attached_frames="2")
+    yield instance
+    instance.connection.close()
+
+
+def jpeg_frame(color):
+    out = io.BytesIO()
+    Image.new("RGB", (1280, 720), color).save(out, format="jpeg")
+    return out.getvalue()
+
+
+def test_warning_email_delivery_time(smtp, emailer):
+    for color in ("red", "green", "blue"):
+        emailer.on_frame_captured(None, "session1", jpeg_frame(color))
+    alarm_time = time.time()
+    emailer.send_warning_email()
+    messages = smtp.wait_for_messages(1, timeout=5)
+
+    assert len(messages) == 1
+    received_time, message = messages[0]
+    assert received_time - alarm_time < MAX_DELIVERY_SECONDS
+    assert message["Subject"] == "[rpicalarm] Intrusion detected"
+    assert message["To"] == "owner@example.com"
+    # the latest frames, resized
+    images = [p for p in message.walk() if p.get_content_type() == "image/jpeg"]
+    assert len(images) == 2
+    assert Image.open(io.BytesIO(images[0].get_payload(decode=True))).size == (640, 360)
+
+
+def test_alarms_within_digest_window_delivered_as_one_email(smtp, emailer):
+    start_time = time.time()
+    emailer.send_warning_email()
+    smtp.wait_for_messages(1, timeout=5)
+    emailer.send_warning_email()
+    emailer.send_warning_email()
+    messages = smtp.wait_for_messages(2, timeout=5)
+
+    assert [m["Subject"] for _, m in messages] == ["[rpicalarm] Intrusion detected",
+                                                   "[rpicalarm] 2 intrusions detected"]
+    # the digest goes out at the end of the window following the first email
+    assert 1.0 <= messages[1][0] - start_time < 1.0 + MAX_DELIVERY_SECONDS
+    time.sleep(0.5)
+    assert len(smtp.messages) == 2
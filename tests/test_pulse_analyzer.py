@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+from threading import Event
+
+import pytest
+
+from rpicalarm.pulse_analyzer import EdgeRing, PulsePattern, PulseTrainAnalyzer, replay_trace
+from rpicalarm.simulators.gpio import SimulatedGPIO
+
+CHANNEL = 14
+
+
+def pulse_trace(starts, high_duration):
+    """
+    Returns the (timestamp, level) edges of pulses starting at starts
+    """
+    trace = []
+    for start in starts:
+        trace.extend([(start, 1), (start + high_duration, 0)])
+    return trace
+
+
+def analyzer(min_pulses=3, window=10, min_high_duration=0, ring_size=64):
+    return PulseTrainAnalyzer(PulsePattern(min_pulses, window, min_high_duration), lambda: None, ring_size)
+
+
+def test_pulses_within_window_trigger():
+    pulse_analyzer = analyzer()
+    matches = replay_trace(pulse_analyzer, pulse_trace([100, 102, 104], 0.5))
+
+    # the third rising edge completes the pattern
+    assert matches == [104]
+    assert pulse_analyzer.match_start_time == 100
+
+
+def test_pulses_spread_over_more_than_window_do_not_trigger():
+    assert replay_trace(analyzer(), pulse_trace([100, 106, 112], 0.5)) == []
+
+
+def test_pulse_triggers_once_high_for_min_high_duration():
+    # the third pulse only counts at its falling edge
+    assert replay_trace(analyzer(min_high_duration=1), pulse_trace([100, 102, 104], 1.5)) == [105.5]
+
+
+def test_short_noise_pulse_does_not_trigger():
+    trace = pulse_trace([100, 102], 1.5) + pulse_trace([104], 0.1)
+
+    assert replay_trace(analyzer(min_high_duration=1), trace) == []
+
+
+def test_edges_of_a_match_not_considered_again():
+    matches = replay_trace(analyzer(min_pulses=2), pulse_trace([100, 101, 102, 103, 104], 0.5))
+
+    assert matches == [101, 103]
+
+
+def test_ring_wraps_around():
+    ring = EdgeRing(4)
+    for timestamp, level in pulse_trace([1, 2, 3], 0.5):
+        ring.append(timestamp, level)
+
+    # the oldest pulse was overwritten, the others are returned oldest first
+    assert ring.count == 6
+    assert ring.edges() == [(2, 1), (2.5, 0), (3, 1), (3.5, 0)]
+
+
+def test_matches_after_ring_wrap_around():
+    # the ring holds two pulses only, it wraps around many times over the trace
+    pulse_analyzer = analyzer(min_pulses=2, window=1.5, ring_size=4)
+    matches = replay_trace(pulse_analyzer, pulse_trace([10 * i + d for i in range(10) for d in (0, 1)], 0.5))
+
+    assert matches == [10 * i + 1 for i in range(10)]
+    assert pulse_analyzer.ring.count == 40
+
+
+@pytest.fixture
+def gpio_analyzer():
+    """
+    Returns a started analyzer fed by the edges of the GPIO stand-in channel, the way
+    the PIR sensor feeds it, and the event set on match
+    """
+    gpio = SimulatedGPIO()
+    gpio.setup(CHANNEL, gpio.IN, pull_up_down=gpio.PUD_DOWN)
+    matched = Event()
+    pulse_analyzer = PulseTrainAnalyzer(PulsePattern(2, 5, 0.2), matched.set)
+    gpio.add_event_detect(CHANNEL, gpio.BOTH, callback=lambda channel: pulse_analyzer.record_edge(gpio.input(channel)))
+    pulse_analyzer.start()
+    yield gpio, matched
+    pulse_analyzer.stop()
+    gpio.cleanup()
+
+
+def test_gpio_pulses_trigger(gpio_analyzer):
+    gpio, matched = gpio_analyzer
+    gpio.pulse(CHANNEL, count=2, high_time=0.3, low_time=0.2)
+
+    assert matched.wait(2)
+
+
+def test_gpio_noise_pulses_do_not_trigger(gpio_analyzer):
+    gpio, matched = gpio_analyzer
+    gpio.pulse(CHANNEL, count=3, high_time=0.05, low_time=0.2)
+
+    assert not matched.wait(1)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from rpicalarm import AlarmState
+from rpicalarm.agents.telegram import NO_CAMERA_MSG, Telegram
+from rpicalarm.simulators.services import BotApiStub
+
+USER_ID = 1
+
+
+@pytest.fixture
+def bot_api():
+    stub = BotApiStub(user_id=USER_ID)
+    stub.start()
+    yield stub
+    stub.stop()
+
+
+@pytest.fixture
+def telegram_agent(bot_api):
+    # the camera agent is disabled
+    agent = Telegram(SimpleNamespace(state=AlarmState.ARMED), None, bot_token="123:token", bot_name="bot",
+                     user_id=str(USER_ID), user_name="user", channel="@channel", api_url=bot_api.url + "/bot")
+    try:
+        # the bot knows the chat once the user talked
+        bot_api.say("/status")
+        wait_for_message(bot_api, "status: ARMED")
+        yield agent
+    finally:
+        # its threads keep the tests running otherwise
+        agent.updater.stop()
+
+
+def wait_for_message(bot_api, text, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        # the messages are prefixed by the bot name
+        if any(t.endswith(text) for _, t in list(bot_api.sent_messages)):
+            return
+        time.sleep(0.05)
+    raise AssertionError("Message {0} not sent, got {1}".format(text, [t for _, t in bot_api.sent_messages]))
+
+
+@pytest.mark.parametrize("command", ["/photo", "/photo full", "/cam", "/camstatus"])
+def test_camera_commands_answer_no_camera(bot_api, telegram_agent, command):
+    bot_api.sent_messages.clear()
+    bot_api.say(command)
+
+    wait_for_message(bot_api, NO_CAMERA_MSG)
+
+
+def test_authentication_without_camera_frames(bot_api, telegram_agent):
+    bot_api.sent_messages.clear()
+    telegram_agent.on_authentication_required(None, SimpleNamespace(id="session1"))
+
+    wait_for_message(bot_api, NO_CAMERA_MSG)
+    time.sleep(0.2)
+    # no album follows
+    assert [t for _, t in bot_api.sent_messages] == ["[Alarm] " + NO_CAMERA_MSG]
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+from telegram import Bot
+
+from rpicalarm.agents.telegram import ChatSendQueue
+from rpicalarm.simulators.services import BotApiStub
+
+BOT_TOKEN = "123:token"
+# the timings leave room for the stand-in answering on a loaded machine
+TOLERANCE = 0.15
+
+
+@pytest.fixture
+def bot_api():
+    stub = BotApiStub(user_id=1)
+    stub.start()
+    yield stub
+    stub.stop()
+
+
+@pytest.fixture
+def bot(bot_api):
+    return Bot(BOT_TOKEN, base_url=bot_api.url + "/bot")
+
+
+@pytest.fixture
+def send_queues():
+    queues = []
+
+    def create(chat_id, **kwargs):
+        send_queue = ChatSendQueue(chat_id, **kwargs)
+        queues.append(send_queue)
+        return send_queue
+    yield create
+    for send_queue in queues:
+        send_queue.stop()
+
+
+def sent_messages(bot_api, chat_id=None):
+    """
+    Returns the (time, text) of the messages the stand-in got, of chat_id if set
+    """
+    return [(r.time, r.params.get("text")) for r in bot_api.requests
+            if r.path.endswith("/sendMessage") and (chat_id is None or int(r.params["chat_id"]) == chat_id)]
+
+
+def send(bot, chat_id, text):
+    return lambda: bot.send_message(chat_id, text)
+
+
+def test_coalesced_messages_take_no_token(bot_api, bot, send_queues):
+    send_queue = send_queues(1, rate=2, burst=1)
+    first = send_queue.put(send(bot, 1, "first"))
+    first.result(timeout=5)
+    # the first status waits for the next token, the next ones supersede it meanwhile
+    statuses = [send_queue.put(send(bot, 1, "status 0"), coalesce_key="status")]
+    time.sleep(0.1)
+    statuses.extend(send_queue.put(send(bot, 1, "status {0}".format(i)), coalesce_key="status") for i in (1, 2))
+    last = statuses[-1].result(timeout=5)
+
+    assert last.text == "status 2"
+    assert [f.result(timeout=0) for f in statuses[:-1]] == [None, None]
+    messages = sent_messages(bot_api)
+    assert [text for _, text in messages] == ["first", "status 2"]
+    # the superseded statuses did not use the token of the sent one
+    assert messages[1][0] - messages[0][0] < 0.5 + TOLERANCE
+
+
+def test_flood_control_retried_after_delay(bot_api, bot, send_queues):
+    send_queue = send_queues(1, rate=10, burst=10)
+    bot_api.add_flood_control(2, retry_after=0.5)
+    start_time = time.time()
+    message = send_queue.put(send(bot, 1, "intrusion")).result(timeout=5)
+
+    assert message.text == "intrusion"
+    # refused twice, then delivered
+    assert len(sent_messages(bot_api)) == 3
+    assert time.time() - start_time >= 1.0
+
+
+def test_flood_control_gives_up_after_max_tries(bot_api, bot, send_queues):
+    send_queue = send_queues(1, rate=10, burst=10, max_tries=2)
+    bot_api.add_flood_control(5, retry_after=0.1)
+    future = send_queue.put(send(bot, 1, "intrusion"))
+
+    with pytest.raises(Exception, match="Max tries reached"):
+        future.result(timeout=5)
+    assert len(sent_messages(bot_api)) == 2
+
+
+def test_rate_limited_per_chat(bot_api, bot, send_queues):
+    rate = 5
+    queues = {chat_id: send_queues(chat_id, rate=rate, burst=1) for chat_id in (1, 2)}
+    start_time = time.time()
+    futures = [queues[chat_id].put(send(bot, chat_id, "message {0}".format(i)))
+               for i in range(4) for chat_id in queues]
+    for future in futures:
+        future.result(timeout=5)
+
+    for chat_id in queues:
+        times = [t for t, _ in sent_messages(bot_api, chat_id)]
+        assert len(times) == 4
+        assert all(t2 - t1 >= 1.0 / rate - 0.05 for t1, t2 in zip(times, times[1:]))
+    # the chats do not wait for each other
+    assert time.time() - start_time < 3.0 / rate + 2 * TOLERANCE